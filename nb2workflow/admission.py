@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import os
+import math
+import time
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# durations of this many recently completed jobs are used to estimate when to retry
+n_recent_durations = 50
+
+# assumed job duration before any job has completed
+default_job_duration_s = 30
+
+
+def _get_limit(name, default=0):
+    return float(os.getenv(name, default))
+
+
+def get_admission_limits():
+    """
+    limits on accepted work, 0 means no limit
+    """
+    return dict(
+        max_queued_jobs=int(_get_limit('NB2W_MAX_QUEUED_JOBS')),
+        max_running_jobs=int(_get_limit('NB2W_MAX_RUNNING_JOBS')),
+        min_free_disk_mb=_get_limit('NB2W_MIN_FREE_DISK_MB'),
+        min_free_memory_mb=_get_limit('NB2W_MIN_FREE_MEMORY_MB'),
+    )
+
+
+def resource_status(path="."):
+    statvfs = os.statvfs(path)
+    return dict(
+        fs_space=dict(
+            size_mb=statvfs.f_frsize * statvfs.f_blocks / 1024 / 1024,
+            avail_mb=statvfs.f_frsize * statvfs.f_bavail / 1024 / 1024,
+        ),
+        memory=dict(
+            total_mb=psutil.virtual_memory().total / 1024 / 1024,
+            avail_mb=psutil.virtual_memory().available / 1024 / 1024,
+        ),
+    )
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, status_code, retry_after_s):
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after_s = retry_after_s
+
+
+class Admitted:
+    """
+    a job accepted by the controller, which holds a running slot, or a queue slot until the job is queued
+
+    Used as a context manager around the execution or the enqueuing of the job; released once.
+    """
+    def __init__(self, controller, queued):
+        self.controller = controller
+        self.queued = queued
+        self.started_at = None
+        self.released = False
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    decides if the service accepts new jobs, given the number of queued and running jobs and the free resources
+
+    Queue and concurrency limits are answered with 429, lack of disk or memory with 503.
+    Both carry an estimate of when the request can be retried.
+
+    Running jobs are counted in the memory of each server process: with n_processes of them, each
+    enforces an equal part of max_running_jobs. Queued jobs are counted in the queue, which is shared by
+    the processes when it is persistent. Limits apply to one service instance, not to all its replicas.
+    """
+    def __init__(self, limits=None, n_workers=1, n_processes=1):
+        self._limits = limits
+        self.n_workers = n_workers
+        self.n_processes = n_processes
+
+        self._lock = threading.Lock()
+        self.n_running = 0
+        self.n_queue_reserved = 0
+        self.recent_durations_s = collections.deque(maxlen=n_recent_durations)
+
+    @property
+    def limits(self):
+        """
+        limits enforced by this process
+        """
+        limits = dict(self._limits or get_admission_limits())
+        if self.n_processes > 1 and limits['max_running_jobs'] > 0:
+            limits['max_running_jobs'] = max(1, limits['max_running_jobs'] // self.n_processes)
+        return limits
+
+    def configure(self, n_workers=None, n_processes=None, **limits):
+        if n_workers is not None:
+            self.n_workers = n_workers
+        if n_processes is not None:
+            self.n_processes = n_processes
+
+        limits = {k: v for k, v in limits.items() if v is not None}
+        if limits:
+            self._limits = dict(get_admission_limits(), **limits)
+
+    @contextmanager
+    def running(self):
+        """
+        a running slot taken regardless of the limits, for jobs which were admitted to the queue
+        """
+        with self._lock:
+            self.n_running += 1
+
+        with Admitted(self, queued=False):
+            yield
+
+    def _release(self, admitted: Admitted):
+        with self._lock:
+            if admitted.released:
+                return
+            admitted.released = True
+
+            if admitted.queued:
+                self.n_queue_reserved -= 1
+            else:
+                self.n_running -= 1
+                if admitted.started_at is not None:
+                    self.recent_durations_s.append(time.time() - admitted.started_at)
+
+    @property
+    def mean_duration_s(self):
+        with self._lock:
+            if len(self.recent_durations_s) == 0:
+                return default_job_duration_s
+            return sum(self.recent_durations_s) / len(self.recent_durations_s)
+
+    def retry_after_s(self, qsize) -> int:
+        """
+        time until the jobs queued and running now are expected to be done
+        """
+        capacity = max(self.limits['max_running_jobs'] or self.n_workers, 1)
+        return max(1, math.ceil(self.mean_duration_s * (qsize + self.n_running) / capacity))
+
+    def admit(self, qsize=0, queued=True) -> Admitted:
+        """
+        takes a slot for a new job, or raises AdmissionRejected if it can not be accepted now;
+        queued jobs are limited by the queue size, other jobs by the number of running jobs
+
+        The limit is checked and the slot taken in one step, concurrent requests can not all pass
+        the check before any of them is counted. The slot is released by the caller.
+        """
+        limits = self.limits
+
+        if limits['min_free_disk_mb'] > 0 or limits['min_free_memory_mb'] > 0:
+            status = resource_status()
+
+            if status['fs_space']['avail_mb'] < limits['min_free_disk_mb']:
+                raise AdmissionRejected("not enough free space: %.5lg Mb left" % status['fs_space']['avail_mb'],
+                                        503, self.retry_after_s(qsize))
+
+            if status['memory']['avail_mb'] < limits['min_free_memory_mb']:
+                raise AdmissionRejected("not enough free memory: %.5lg Mb left" % status['memory']['avail_mb'],
+                                        503, self.retry_after_s(qsize))
+
+        reason = None
+        with self._lock:
+            if queued:
+                n_queued = qsize + self.n_queue_reserved
+                if limits['max_queued_jobs'] > 0 and n_queued >= limits['max_queued_jobs']:
+                    reason = f"too many queued jobs: {n_queued}, limit {limits['max_queued_jobs']}"
+                else:
+                    self.n_queue_reserved += 1
+            else:
+                if limits['max_running_jobs'] > 0 and self.n_running >= limits['max_running_jobs']:
+                    reason = f"too many running jobs: {self.n_running}, limit {limits['max_running_jobs']}"
+                else:
+                    self.n_running += 1
+
+        if reason is not None:
+            raise AdmissionRejected(reason, 429, self.retry_after_s(qsize))
+
+        return Admitted(self, queued)
+
+admission = AdmissionController()
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import io
+import os
+import json
+import types
+import pickle
+import hashlib
+import logging
+import importlib
+
+import nbformat
+from diskcache import Cache
+
+from nb2workflow.dataflow import analyze_cell
+
+logger = logging.getLogger(__name__)
+
+# cells with this tag are memoized; system parameter cell_cache = True memoizes all cells which can be,
+# and have no side effects
+cell_cache_tag = 'cached'
+
+# tags of cells which are never memoized
+uncacheable_tags = ['parameters', 'injected-parameters', 'system-parameters', 'outputs', 'injected-gather-outputs']
+
+restored_cells_dir = '.nb2w_cells'
+
+
+def get_cell_cache_dir():
+    return os.getenv('NB2W_CELL_CACHE', os.path.join(os.getenv('HOME', '/tmp'), '.cache/nb2workflow/cells'))
+
+
+def get_cell_cache_size_limit():
+    return int(float(os.getenv('NB2W_CELL_CACHE_SIZE_MB', 1024)) * 1024 * 1024)
+
+
+def _hash(*args) -> str:
+    return hashlib.sha256(json.dumps(args, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class _DeltaPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # pickled by reference, would not be found in another kernel
+        if isinstance(obj, (type, types.FunctionType)) and getattr(obj, '__module__', None) == '__main__':
+            raise pickle.PicklingError(f"{obj!r} is defined in the notebook")
+        return NotImplemented
+
+
+def dump_delta(namespace: dict, names) -> bytes:
+    delta = {}
+    for name in sorted(names):
+        if name not in namespace:
+            continue
+
+        value = namespace[name]
+        if isinstance(value, types.ModuleType):
+            delta[name] = ('module', value.__name__)
+        else:
+            delta[name] = ('value', value)
+
+    f = io.BytesIO()
+    _DeltaPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(delta)
+    return f.getvalue()
+
+
+def load_delta(data: bytes) -> dict:
+    namespace = {}
+    for name, (kind, value) in pickle.loads(data).items():
+        if kind == 'module':
+            value = importlib.import_module(value)
+        namespace[name] = value
+    return namespace
+
+
+def store_cell(directory, key, namespace, names):
+    """
+    called in the kernel after a memoized cell was executed
+    """
+    try:
+        data = dump_delta(namespace, names)
+    except Exception as e:
+        print(f"cell result can not be memoized: {e!r}")
+        return
+
+    with Cache(directory) as cache:
+        cache.set(key, data)
+
+
+def restore_cell(fn, namespace):
+    """
+    called in the kernel instead of a memoized cell
+    """
+    with open(fn, 'rb') as f:
+        namespace.update(load_delta(f.read()))
+
+
+class CellCache:
+    """
+    namespace changes made by notebook cells, keyed by the cell source and everything the cell reads:
+    values of parameters, and keys of the cells which defined other names
+    """
+    def __init__(self, directory=None, size_limit=None):
+        self._directory = directory
+        self._size_limit = size_limit
+
+    @property
+    def directory(self):
+        return self._directory or get_cell_cache_dir()
+
+    def open(self):
+        return Cache(self.directory,
+                     size_limit=self._size_limit or get_cell_cache_size_limit(),
+                     eviction_policy='least-recently-used')
+
+    def plan(self, nb, parameter_values: dict, salt='', cache_all=False) -> list[dict]:
+        """
+        computes keys of the memoized cells of a notebook for given parameter values
+        """
+        definers = {}
+        barrier = None
+        planned = []
+
+        for index, cell in enumerate(nb.cells):
+            if cell.cell_type != 'code':
+                continue
+
+            tags = cell.metadata.get('tags', [])
+            flow = analyze_cell(cell.source)
+
+            if 'parameters' in tags or 'injected-parameters' in tags:
+                for name in flow.writes:
+                    definers[name] = _hash('parameter', name, parameter_values.get(name, cell.source))
+                continue
+
+            key = _hash(salt, barrier, cell.source, {name: definers[name] for name in flow.reads if name in definers})
+
+            for name in flow.writes:
+                definers[name] = key
+
+            if flow.opaque or flow.has_magics:
+                # any name could have been changed
+                barrier = key
+                continue
+
+            if any(tag in tags for tag in uncacheable_tags):
+                continue
+
+            # only the namespace is restored: files the cell writes, or requests it makes, would be missing
+            if cell_cache_tag in tags or (cache_all and not flow.side_effects):
+                planned.append(dict(index=index, key=key, writes=sorted(flow.writes)))
+
+        return planned
+
+    def apply(self, nb, planned, workdir) -> dict:
+        """
+        replaces cached cells with restoring their results, and adds storing results after other memoized cells
+        """
+        hits = 0
+        new_cells = {}
+
+        with self.open() as cache:
+            for entry in planned:
+                data = cache.get(entry['key'])
+                entry['hit'] = data is not None
+
+                cell = nb.cells[entry['index']]
+
+                if entry['hit']:
+                    hits += 1
+                    fn = os.path.join(workdir, restored_cells_dir, entry['key'] + '.pickle')
+                    os.makedirs(os.path.dirname(fn), exist_ok=True)
+                    with open(fn, 'wb') as f:
+                        f.write(data)
+
+                    cell.source = (f"# result restored from cell cache\n"
+                                   f"from nb2workflow.cellcache import restore_cell\n"
+                                   f"restore_cell({fn!r}, globals())")
+                    cell.outputs = []
+                    cell.metadata['tags'] = cell.metadata.get('tags', []) + ['injected-cell-cache-restore']
+                else:
+                    store_cell_source = (f"from nb2workflow.cellcache import store_cell\n"
+                                         f"store_cell({self.directory!r}, {entry['key']!r}, globals(), {entry['writes']!r})")
+                    new_cell = nbformat.v4.new_code_cell(source=store_cell_source)
+                    new_cell.metadata['tags'] = ['injected-cell-cache-store']
+                    new_cells[entry['index']] = new_cell
+
+        nb.cells = [c for i, cell in enumerate(nb.cells) for c in [cell, new_cells.get(i)] if c is not None]
+
+        return dict(
+            hits=hits,
+            misses=len(planned) - hits,
+            hit_rate=hits / len(planned) if len(planned) > 0 else None,
+            cells=[dict(index=e['index'], key=e['key'], hit=e['hit']) for e in planned],
+        )
+
+
+cell_cache = CellCache()
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import ast
+import logging
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+# calls which can read or define any name, analysis of cells using them is not reliable
+dynamic_namespace_calls = ['exec', 'eval', 'globals', 'locals', 'vars', '__import__']
+
+# functions and methods which may have an effect outside of the notebook namespace (files, processes, network)
+side_effect_calls = [
+    'open', 'savefig', 'save', 'savez', 'savetxt', 'writeto', 'write', 'write_text', 'write_bytes', 'dump',
+    'to_csv', 'to_fits', 'to_json', 'to_hdf', 'to_parquet', 'to_pickle', 'to_excel',
+    'mkdir', 'makedirs', 'remove', 'unlink', 'rmtree', 'rename', 'copyfile', 'chdir',
+    'system', 'Popen', 'run', 'call', 'check_call', 'check_output',
+    'urlretrieve', 'post', 'put', 'upload', 'download', 'glue', 'exit',
+]
+
+# calls which only display, a statement consisting of them has no effect
+display_calls = ['print', 'display']
+
+# cells with this tag are never pruned
+keep_tag = 'keep'
+
+# cells with these tags are needed for execution, whatever they define
+required_tags = ['parameters', 'injected-parameters', 'system-parameters', 'outputs', 'injected-gather-outputs']
+
+
+@dataclass
+class CellDataflow:
+    """
+    global names read and written by a code cell; an opaque cell may read or write any name
+    """
+    reads: set[str] = field(default_factory=set)
+    writes: set[str] = field(default_factory=set)
+    has_magics: bool = False
+    opaque: bool = False
+    side_effects: bool = False
+
+
+def strip_magics(source: str) -> tuple[str, bool]:
+    """
+    replaces IPython magics, shell escapes and help requests with `pass`, so that the cell can be parsed
+    """
+    lines = []
+    has_magics = False
+    continued = False
+
+    for line in source.split('\n'):
+        stripped = line.strip()
+        if continued or stripped.startswith(('%', '!')) or (stripped.endswith('?') and not stripped.startswith('#')):
+            has_magics = True
+            continued = stripped.endswith('\\')
+            line = line[:len(line) - len(line.lstrip())] + 'pass'
+        lines.append(line)
+
+    if has_magics and source.lstrip().startswith('%%'):
+        # cell magic, the rest of the cell is not python
+        return '', True
+
+    return '\n'.join(lines), has_magics
+
+
+def _bound_names(node) -> tuple[set[str], set[str]]:
+    """
+    names local to a function (or lambda), and names it declares global or nonlocal
+    """
+    args = node.args
+    local = {a.arg for a in args.posonlyargs + args.args + args.kwonlyargs}
+    local |= {a.arg for a in [args.vararg, args.kwarg] if a is not None}
+
+    declared = set()
+    body = node.body if isinstance(node.body, list) else [node.body]
+    for stmt in body:
+        for n in ast.walk(stmt):
+            if isinstance(n, ast.Name) and isinstance(n.ctx, (ast.Store, ast.Del)):
+                local.add(n.id)
+            elif isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                local.add(n.name)
+            elif isinstance(n, (ast.Import, ast.ImportFrom)):
+                local |= {_import_name(alias) for alias in n.names}
+            elif isinstance(n, (ast.Global, ast.Nonlocal)):
+                declared |= set(n.names)
+
+    return local - declared, declared
+
+
+def _import_name(alias) -> str:
+    return alias.asname or alias.name.split('.')[0]
+
+
+def _call_name(node):
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+
+
+def _root_name(node):
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+
+
+class _Collector(ast.NodeVisitor):
+    def __init__(self, flow: CellDataflow):
+        self.flow = flow
+        self.scopes: list[set[str]] = []
+
+    def _is_local(self, name):
+        return any(name in scope for scope in self.scopes)
+
+    def _read(self, name):
+        if not self._is_local(name):
+            self.flow.reads.add(name)
+
+    def _write(self, name):
+        if not self._is_local(name):
+            self.flow.writes.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self._read(node.id)
+        else:
+            self._write(node.id)
+
+    def _visit_target_root(self, node):
+        # a.x = ..., a[i] = ... modify a
+        if isinstance(node.ctx, (ast.Store, ast.Del)):
+            name = _root_name(node)
+            if name is not None:
+                self._read(name)
+                self._write(name)
+        self.generic_visit(node)
+
+    visit_Attribute = _visit_target_root
+    visit_Subscript = _visit_target_root
+
+    def visit_AugAssign(self, node):
+        name = _root_name(node.target)
+        if name is not None:
+            self._read(name)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._write(_import_name(alias))
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.flow.opaque = True
+            else:
+                self._write(_import_name(alias))
+
+    def visit_Call(self, node):
+        name = _call_name(node)
+        if isinstance(node.func, ast.Name) and name in dynamic_namespace_calls:
+            self.flow.opaque = True
+        if name in side_effect_calls:
+            self.flow.side_effects = True
+        self.generic_visit(node)
+
+    def visit_Expr(self, node):
+        if isinstance(node.value, ast.Call):
+            if isinstance(node.value.func, ast.Attribute):
+                # a.append(x), plt.plot(x) probably modify a or plt
+                name = _root_name(node.value.func.value)
+                if name is not None:
+                    self._read(name)
+                    self._write(name)
+            elif _call_name(node.value) not in display_calls:
+                # function called for its effect, which is unknown
+                self.flow.side_effects = True
+        self.generic_visit(node)
+
+    def _visit_side_effect(self, node):
+        self.flow.side_effects = True
+        self.generic_visit(node)
+
+    visit_Raise = _visit_side_effect
+    visit_Assert = _visit_side_effect
+
+    def _visit_function(self, node):
+        if not isinstance(node, ast.Lambda):
+            self._write(node.name)
+            for decorator in node.decorator_list:
+                self.visit(decorator)
+            if node.returns is not None:
+                self.visit(node.returns)
+
+        for default in node.args.defaults + [d for d in node.args.kw_defaults if d is not None]:
+            self.visit(default)
+
+        local, declared = _bound_names(node)
+        for name in declared:
+            self._write(name)
+
+        self.scopes.append(local)
+        body = node.body if isinstance(node.body, list) else [node.body]
+        for stmt in body:
+            self.visit(stmt)
+        self.scopes.pop()
+
+    visit_FunctionDef = _visit_function
+    visit_AsyncFunctionDef = _visit_function
+    visit_Lambda = _visit_function
+
+    def visit_ClassDef(self, node):
+        self._write(node.name)
+        for n in node.decorator_list + node.bases + [k.value for k in node.keywords]:
+            self.visit(n)
+
+        class_names = {n.id for stmt in node.body for n in ast.walk(stmt)
+                       if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+        self.scopes.append(class_names)
+        for stmt in node.body:
+            self.visit(stmt)
+        self.scopes.pop()
+
+    def _visit_comprehension(self, node):
+        targets = {n.id for gen in node.generators for n in ast.walk(gen.target) if isinstance(n, ast.Name)}
+
+        # the first iterable is evaluated in the enclosing scope
+        self.visit(node.generators[0].iter)
+
+        self.scopes.append(targets)
+        for i, gen in enumerate(node.generators):
+            if i > 0:
+                self.visit(gen.iter)
+            for cond in gen.ifs:
+                self.visit(cond)
+        for elt in [getattr(node, a) for a in ('elt', 'key', 'value') if hasattr(node, a)]:
+            self.visit(elt)
+        self.scopes.pop()
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+
+
+def analyze_cell(source: str) -> CellDataflow:
+    source, has_magics = strip_magics(source)
+
+    flow = CellDataflow(has_magics=has_magics)
+
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        logger.info("unable to parse cell, assuming it may use any name: %s", e)
+        flow.opaque = True
+        return flow
+
+    _Collector(flow).visit(tree)
+
+    return flow
+
+
+def prune_cells(nb) -> list[int]:
+    """
+    removes code cells which can not contribute to the declared outputs; returns indices of removed cells
+
+    Liveness is propagated backward from the cells required for execution. Cells with magics,
+    possible side effects, or opaque use of the namespace are kept, so are the cells tagged `keep`.
+    """
+    flows = {index: analyze_cell(cell.source) for index, cell in enumerate(nb.cells) if cell.cell_type == 'code'}
+
+    live = set()
+    pruned = []
+
+    for index in sorted(flows, reverse=True):
+        flow = flows[index]
+        tags = nb.cells[index].metadata.get('tags', [])
+
+        if flow.opaque:
+            # may define anything, everything above is needed
+            break
+
+        if (flow.has_magics or flow.side_effects or flow.writes & live
+                or keep_tag in tags or any(tag in required_tags for tag in tags)):
+            # reassignment may be partial (a[i] = ...), names written are not removed from live
+            live |= flow.reads
+        else:
+            pruned.append(index)
+
+    pruned = sorted(pruned)
+    nb.cells = [cell for index, cell in enumerate(nb.cells) if index not in pruned]
+
+    logger.info("pruned %s cells not contributing to outputs: %s", len(pruned), pruned)
+
+    return pruned
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import re
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# job keys are sha224 hex digests
+job_key_pattern = re.compile(r'\b[0-9a-f]{56}\b')
+
+
+class WorkflowIncomplete(Exception):
+    """
+    raised in a notebook when an upstream workflow is not done yet, the notebook will be executed again later
+
+    If the key of the upstream job is given, the job is executed again as soon as the upstream job
+    is done, in this service or, through /async/notify/<key>, in a peer service.
+    """
+    def __init__(self, waiting_for=None, comment=""):
+        self.waiting_for = waiting_for
+        self.comment = comment
+        super().__init__(waiting_for, comment)
+
+    def __str__(self):
+        return json.dumps(dict(waiting_for=self.waiting_for, comment=self.comment))
+
+
+def wait_for(job_key, comment=""):
+    """
+    stops the notebook until the upstream job is done
+    """
+    raise WorkflowIncomplete(waiting_for=job_key, comment=comment)
+
+
+def parse_waiting_for(evalue: str) -> str | None:
+    """
+    upstream job key from the value of a WorkflowIncomplete exception raised in the notebook:
+    raised with the helper, or with any message mentioning the key
+    """
+    try:
+        return json.loads(evalue)['waiting_for']
+    except (ValueError, TypeError, KeyError):
+        pass
+
+    m = job_key_pattern.search(evalue or "")
+    if m is not None:
+        return m.group(0)
+
+
+class DependencyRegistry:
+    """
+    jobs blocked by an incomplete upstream job, by the key of the upstream job
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: dict[str, list] = {}
+
+    def wait(self, upstream_key, waiter):
+        with self._lock:
+            waiters = self._waiters.setdefault(upstream_key, [])
+            if waiter not in waiters:
+                waiters.append(waiter)
+        logger.info("%s waits for %s", waiter, upstream_key)
+
+    def forget(self, waiter):
+        with self._lock:
+            for upstream_key, waiters in list(self._waiters.items()):
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if len(waiters) == 0:
+                    del self._waiters[upstream_key]
+
+    def complete(self, upstream_key) -> list:
+        """
+        returns jobs which were waiting for the upstream job
+        """
+        with self._lock:
+            waiters = self._waiters.pop(upstream_key, [])
+        if waiters:
+            logger.info("%s done, waking up %s jobs", upstream_key, len(waiters))
+        return waiters
+
+    def status(self) -> dict:
+        with self._lock:
+            return {upstream_key: len(waiters) for upstream_key, waiters in self._waiters.items()}
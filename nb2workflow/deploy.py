@@ -416,7 +416,12 @@ class NBRepo:
                    rw_many: bool = True,
                    volume_size: int = 20,
                    container_override: dict|None = None,
+                   replicas: int = 1,
                    ):
+        if replicas > 1 and not (with_volume and rw_many):
+            raise ValueError("several replicas share async jobs through a ReadWriteMany volume, "
+                             "they need with_volume and rw_many")
+
         if container_override is None:
             if not hasattr(self, 'built_container_metadata'):
                 self.build_with_kaniko(namespace=namespace)
@@ -443,7 +448,8 @@ class NBRepo:
                 with_volume = with_volume,
                 rw_many = rw_many,
                 secretenv = secretenv,
-                image = use_container_meta['image']
+                image = use_container_meta['image'],
+                replicas = replicas
             ))
 
         tmpl = jenv.get_template('pvc.yaml.jinja')
@@ -563,7 +569,8 @@ def deploy(git_origin,
            build_timestamp=False,
            cleanup=False,
            nb2wversion=version(),
-           ontology_path=default_ontology_path):
+           ontology_path=default_ontology_path,
+           replicas=1):
     with NBRepo(git_origin,
                 registry=registry,
                 ontology_path=ontology_path) as repo:
@@ -579,7 +586,8 @@ def deploy(git_origin,
                                    build_timestamp=build_timestamp,
                                    cleanup=cleanup)
             res = repo.deploy_k8s(deployment_base_name=deployment_base_name,
-                            namespace=namespace)
+                            namespace=namespace,
+                            replicas=replicas)
 
         else:
             raise NotImplementedError('Unknown build_engine')
@@ -597,6 +605,8 @@ def main():
     parser.add_argument('--registry', metavar="build_engine", default="odahub")
     parser.add_argument('--nb2wversion', metavar="nb2wversion", default=version(print_it=False))
     parser.add_argument('--ontology-path', metavar="ontology_path", default=default_ontology_path)
+    parser.add_argument('--replicas', metavar="N", type=int, default=1,
+                        help='number of service replicas, sharing async jobs through the volume')
     
     args = parser.parse_args()
 
@@ -609,7 +619,8 @@ def main():
            ontology_path = args.ontology_path,
            build_engine = args.build_engine,
            local = args.local,
-           nb2wversion=args.nb2wversion
+           nb2wversion=args.nb2wversion,
+           replicas=args.replicas
            )
 
 if __name__ == "__main__":
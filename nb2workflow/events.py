@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import logging
+import threading
+
+from papermill.engines import NBClientEngine, papermill_engines
+
+logger = logging.getLogger(__name__)
+
+# in the job directory, one json event per line
+events_file = '.nb2w_events.jsonl'
+
+engine_name = 'nb2workflow'
+
+
+class JobEvents:
+    """
+    progress of a notebook execution, appended to a file in the job directory as it happens,
+    so that it can be followed by another thread or process
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.t0 = time.time()
+        self._lock = threading.Lock()
+        self._cell_t0 = {}
+
+    def emit(self, event, **data):
+        record = dict(event=event, time=time.time(), elapsed_s=time.time() - self.t0, **data)
+        with self._lock:
+            with open(self.fn, "a") as f:
+                f.write(json.dumps(record, default=repr) + "\n")
+
+    def stream(self, name):
+        return _EventStream(self, name)
+
+    def cell_start(self, cell, cell_index):
+        self._cell_t0[cell_index] = time.time()
+        self.emit('cell-start',
+                  cell_index=cell_index,
+                  tags=cell.metadata.get('tags', []))
+
+    def cell_end(self, cell, cell_index, status):
+        self.emit('cell-end',
+                  cell_index=cell_index,
+                  status=status,
+                  duration_s=time.time() - self._cell_t0.pop(cell_index, self.t0))
+
+
+class _EventStream:
+    # papermill writes stream outputs of the kernel to stdout_file and stderr_file
+    def __init__(self, events, name):
+        self.events = events
+        self.name = name
+
+    def write(self, text):
+        self.events.emit('stream', name=self.name, text=text)
+
+    def flush(self):
+        pass
+
+
+class EventsEngine(NBClientEngine):
+    """
+    papermill engine reporting execution progress to JobEvents
+    """
+    @classmethod
+    def execute_managed_notebook(cls, nb_man, kernel_name, events=None, **kwargs):
+        if events is None:
+            return super().execute_managed_notebook(nb_man, kernel_name, **kwargs)
+
+        cell_start, cell_exception, cell_complete = nb_man.cell_start, nb_man.cell_exception, nb_man.cell_complete
+        failed = set()
+
+        def on_cell_start(cell, cell_index=None, **kw):
+            events.cell_start(cell, cell_index)
+            return cell_start(cell, cell_index, **kw)
+
+        def on_cell_exception(cell, cell_index=None, **kw):
+            failed.add(cell_index)
+            return cell_exception(cell, cell_index, **kw)
+
+        def on_cell_complete(cell, cell_index=None, **kw):
+            events.cell_end(cell, cell_index, 'failed' if cell_index in failed else 'ok')
+            return cell_complete(cell, cell_index, **kw)
+
+        nb_man.cell_start = on_cell_start
+        nb_man.cell_exception = on_cell_exception
+        nb_man.cell_complete = on_cell_complete
+
+        kwargs.update(stdout_file=events.stream('stdout'), stderr_file=events.stream('stderr'))
+
+        events.emit('notebook-start', n_cells=len(nb_man.nb.cells))
+        try:
+            return super().execute_managed_notebook(nb_man, kernel_name, **kwargs)
+        finally:
+            events.emit('notebook-end')
+
+
+papermill_engines.register(engine_name, EventsEngine)
+
+
+def read_events(fn, offset=0):
+    """
+    returns complete events written after byte offset, and the offset after them
+    """
+    if not os.path.exists(fn):
+        return [], offset
+
+    with open(fn, "rb") as f:
+        f.seek(offset)
+        content = f.read()
+
+    # the last line may still be written
+    complete = content[:content.rfind(b"\n") + 1]
+
+    return [json.loads(line) for line in complete.splitlines() if line.strip()], offset + len(complete)
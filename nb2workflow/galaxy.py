@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import xml.etree.ElementTree as ET
 import os
+import copy
 import re
 import shutil
 from textwrap import dedent
@@ -12,10 +13,12 @@ from typing import TypeAlias
 
 import yaml
 import json
+import rdflib
 
-from oda_api.ontology_helper import Ontology
+from oda_api.ontology_helper import Ontology, RequestNotUnderstood
 from nb2workflow.nbadapter import NotebookAdapter, find_notebooks, oda_ontology_path
 from nb2workflow.nbadapter import ontology as nba_ontology_global_var
+from nb2workflow.ontologyindex import OverlayGraph
 
 import nbformat
 from nbconvert.exporters import ScriptExporter
@@ -40,6 +43,27 @@ _success_text = '*** Job finished successfully ***'
 
 OntoPathOrObj: TypeAlias = str | os.PathLike | Ontology | None
 
+
+def with_extra_triples(onto: Ontology, extra_ttl: str | None) -> Ontology:
+    """
+    the ontology with the extra triples of one parameter or output layered over its graph,
+    the graph shared by all parameters is neither copied nor modified
+    """
+    if extra_ttl is None:
+        return onto
+
+    extra = rdflib.Graph()
+    extra.parse(data=extra_ttl)
+    try:
+        onto.parse_oda_annotations(extra)
+    except RuntimeError as e:
+        raise RequestNotUnderstood(str(e))
+
+    overlay = copy.copy(onto)
+    overlay.g = OverlayGraph(onto.g, extra)
+    return overlay
+
+
 class GalaxyParameter:
     def __init__(self, 
                  name, 
@@ -105,7 +129,8 @@ class GalaxyParameter:
         
         owl_uri = par_details['owl_type']
 
-        is_posix_path, is_file_url, is_file_ref = NotebookAdapter.check_is_file_input(owl_uri).values()
+        is_posix_path, is_file_url, is_file_ref = NotebookAdapter.check_is_file_input(
+            owl_uri, par_details.get('extra_ttl')).values()
         if is_posix_path or (is_file_ref and not is_file_url):
             is_dataset = True
             
@@ -116,9 +141,7 @@ class GalaxyParameter:
             #       (default ontology is still used in nbadapter in fact)
 
             onto = ontology if isinstance(ontology, Ontology) else Ontology(ontology)
-                        
-            if par_details.get('extra_ttl') is not None:
-                onto.parse_extra_triples(par_details['extra_ttl'])
+            onto = with_extra_triples(onto, par_details.get('extra_ttl'))
             
             label = onto.get_oda_label(owl_uri) # TODO: there are both label and description, also groups
             
@@ -203,9 +226,7 @@ class GalaxyOutput:
 
         if ontology is not None:
             onto = ontology if isinstance(ontology, Ontology) else Ontology(ontology)
-
-            if outp_details['extra_ttl'] is not None:
-                onto.parse_extra_triples(outp_details['extra_ttl'])
+            onto = with_extra_triples(onto, outp_details['extra_ttl'])
         
             if owl_uri is not None and onto.is_data_product(owl_uri, include_parameter_products=False):
                 is_oda = True
@@ -707,7 +728,7 @@ def to_galaxy(input_path,
     - Python scripts corresponding to the notebook(s) are generated in the `out_dir`.
     - Additional files, such as test data and metadata, are created as needed.
     """
-    ontology = Ontology(ontology_path) if ontology_path != oda_ontology_path else nba_ontology_global_var
+    ontology = Ontology(ontology_path) if ontology_path != oda_ontology_path else nba_ontology_global_var.load()
 
     os.makedirs(out_dir, exist_ok=True)
     
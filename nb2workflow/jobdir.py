@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import os
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from git import Repo
+
+logger = logging.getLogger(__name__)
+
+# clone: full clone of the notebook repository for every job (default)
+# reflink: copy-on-write copy of a per-commit snapshot, needs a filesystem with reflink support (btrfs, xfs, ...)
+# worktree: git worktree of a per-commit snapshot, repository objects are shared
+# auto: reflink, then worktree, then clone
+jobdir_modes = ['clone', 'reflink', 'worktree', 'auto']
+
+# snapshots kept besides those which job directories still use
+n_snapshots_kept = 3
+
+# job directories which use a snapshot, by snapshot, under the snapshot root
+leases_dir = '.leases'
+
+
+def get_jobdir_mode():
+    mode = os.getenv('NB2W_JOBDIR_MODE', 'clone')
+    if mode not in jobdir_modes:
+        raise ValueError(f"unknown job directory mode {mode}, can be {', '.join(jobdir_modes)}")
+    return mode
+
+
+def get_snapshot_root():
+    return os.getenv('NB2W_SNAPSHOTS', os.path.join(os.getenv('HOME', '/tmp'), '.cache/nb2workflow/snapshots'))
+
+
+class JobDirProvisioner:
+    def __init__(self, mode=None, snapshot_root=None):
+        self._mode = mode
+        self._snapshot_root = snapshot_root
+        self._lock = threading.Lock()
+
+    @property
+    def mode(self):
+        return self._mode or get_jobdir_mode()
+
+    @property
+    def snapshot_root(self):
+        return self._snapshot_root or get_snapshot_root()
+
+    @contextmanager
+    def _locked(self):
+        # snapshots are shared by the threads and processes of the service
+        os.makedirs(self.snapshot_root, exist_ok=True)
+        with self._lock, open(os.path.join(self.snapshot_root, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _lease_fn(self, snapshot_dir, jobdir):
+        return os.path.join(self.snapshot_root, leases_dir, os.path.basename(snapshot_dir),
+                            hashlib.md5(os.path.realpath(jobdir).encode()).hexdigest())
+
+    def _live_leases(self, snapshot_dir) -> list[str]:
+        """
+        job directories using the snapshot, leases of job directories which were removed are dropped
+        """
+        snapshot_leases_dir = os.path.join(self.snapshot_root, leases_dir, os.path.basename(snapshot_dir))
+        if not os.path.isdir(snapshot_leases_dir):
+            return []
+
+        jobdirs = []
+        for lease in os.listdir(snapshot_leases_dir):
+            lease_fn = os.path.join(snapshot_leases_dir, lease)
+            try:
+                with open(lease_fn) as f:
+                    jobdir = f.read()
+            except OSError:
+                continue
+
+            if os.path.exists(jobdir):
+                jobdirs.append(jobdir)
+            else:
+                logger.info("dropping lease of removed job directory %s on %s", jobdir, snapshot_dir)
+                os.remove(lease_fn)
+
+        return jobdirs
+
+    def snapshot(self, repo_dir, jobdir=None) -> str:
+        """
+        returns a directory with a clone of the current commit of the repository, created once per commit
+
+        If jobdir is given, the snapshot is leased to it, and is not removed until the lease is released.
+        """
+        repo = Repo(repo_dir)
+        commit = repo.head.commit.hexsha
+        repo_id = hashlib.md5(os.path.realpath(repo.working_dir).encode()).hexdigest()[:8]
+
+        snapshot_dir = os.path.join(self.snapshot_root, f"{repo_id}-{commit}")
+
+        with self._locked():
+            if not os.path.exists(snapshot_dir):
+                tmp_snapshot_dir = f"{snapshot_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+                logger.info("creating snapshot of %s at %s", repo_dir, snapshot_dir)
+                repo.clone(tmp_snapshot_dir, multi_options=["--recurse-submodules"])
+                os.rename(tmp_snapshot_dir, snapshot_dir)
+            else:
+                # recently used snapshots are kept
+                os.utime(snapshot_dir)
+
+            if jobdir is not None:
+                lease_fn = self._lease_fn(snapshot_dir, jobdir)
+                os.makedirs(os.path.dirname(lease_fn), exist_ok=True)
+                with open(lease_fn, 'w') as f:
+                    f.write(os.path.realpath(jobdir))
+
+            self._prune_snapshots(repo_id, keep=snapshot_dir)
+
+        return snapshot_dir
+
+    def release(self, jobdir):
+        """
+        drops the lease of the job directory on its snapshot, before the job directory is discarded;
+        a worktree is removed from the snapshot repository
+        """
+        if not os.path.isdir(os.path.join(self.snapshot_root, leases_dir)):
+            return
+
+        with self._locked():
+            for snapshot_name in os.listdir(os.path.join(self.snapshot_root, leases_dir)):
+                snapshot_dir = os.path.join(self.snapshot_root, snapshot_name)
+                lease_fn = self._lease_fn(snapshot_dir, jobdir)
+                if not os.path.exists(lease_fn):
+                    continue
+
+                if os.path.isfile(os.path.join(jobdir, '.git')) and os.path.isdir(snapshot_dir):
+                    subprocess.call(["git", "worktree", "remove", "--force", os.path.realpath(jobdir)],
+                                    cwd=snapshot_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                os.remove(lease_fn)
+                logger.info("released lease of %s on snapshot %s", jobdir, snapshot_dir)
+
+    def _prune_snapshots(self, repo_id, keep):
+        snapshots = sorted(
+            [os.path.join(self.snapshot_root, d) for d in os.listdir(self.snapshot_root)
+             if d.startswith(repo_id + "-") and '.tmp-' not in d],
+            key=os.path.getmtime)
+
+        for snapshot_dir in snapshots[:-n_snapshots_kept]:
+            if snapshot_dir == keep:
+                continue
+
+            jobdirs = self._live_leases(snapshot_dir)
+            if jobdirs:
+                logger.info("keeping old snapshot %s used by %s job directories", snapshot_dir, len(jobdirs))
+                continue
+
+            logger.info("removing old snapshot %s", snapshot_dir)
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            shutil.rmtree(os.path.join(self.snapshot_root, leases_dir, os.path.basename(snapshot_dir)),
+                          ignore_errors=True)
+
+    def provision(self, repo_dir, jobdir) -> str:
+        """
+        populates empty jobdir with the content of the repository, returns the mode which was used
+        """
+        mode = self.mode
+
+        if mode == 'clone':
+            Repo(repo_dir).clone(jobdir, multi_options=["--recurse-submodules"])
+            return mode
+
+        # leased while it is copied, and for as long as the job directory exists if it is a worktree
+        snapshot_dir = self.snapshot(repo_dir, jobdir=jobdir)
+
+        candidate_modes = ['reflink', 'worktree'] if mode == 'auto' else [mode]
+
+        for candidate_mode in candidate_modes:
+            try:
+                getattr(self, '_provision_' + candidate_mode)(snapshot_dir, jobdir)
+                if candidate_mode != 'worktree':
+                    self.release(jobdir)
+                return candidate_mode
+            except (OSError, subprocess.CalledProcessError, NotImplementedError) as e:
+                logger.warning("unable to provision job directory with %s: %s", candidate_mode, repr(e))
+                self._empty(jobdir)
+
+        logger.warning("falling back to clone for job directory %s", jobdir)
+        Repo(snapshot_dir).clone(jobdir, multi_options=["--recurse-submodules"])
+        self.release(jobdir)
+        return 'clone'
+
+    @staticmethod
+    def _empty(path):
+        for entry in os.listdir(path):
+            entry = os.path.join(path, entry)
+            if os.path.isdir(entry) and not os.path.islink(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                os.remove(entry)
+
+    @staticmethod
+    def _provision_reflink(snapshot_dir, jobdir):
+        subprocess.check_call(["cp", "-a", "--reflink=always", snapshot_dir + "/.", jobdir],
+                              stderr=subprocess.DEVNULL)
+
+    @staticmethod
+    def _provision_worktree(snapshot_dir, jobdir):
+        if os.path.exists(os.path.join(snapshot_dir, '.gitmodules')):
+            raise NotImplementedError("git worktree does not support submodules")
+
+        subprocess.check_call(["git", "worktree", "prune"], cwd=snapshot_dir)
+        subprocess.check_call(["git", "worktree", "add", "--detach", jobdir, "HEAD"],
+                              cwd=snapshot_dir, stdout=subprocess.DEVNULL)
+
+
+provisioner = JobDirProvisioner()
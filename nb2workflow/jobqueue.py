@@ -0,0 +1,472 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import heapq
+import queue
+import uuid
+import socket
+import sqlite3
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from nb2workflow.dependencies import DependencyRegistry
+from nb2workflow.json import CustomJSONEncoder
+from nb2workflow.jobstore import sqlite_connect
+
+logger = logging.getLogger(__name__)
+
+# jobs put by other processes sharing an SQLite queue are seen at least this often
+sqlite_queue_poll_interval_s = 0.5
+
+
+def get_job_lease_s():
+    # jobs taken by a process which stopped renewing them for this long are put back in the queue
+    return float(os.getenv('NB2W_JOB_LEASE_S', 60))
+
+
+def get_job_queue_url():
+    # memory, or sqlite:///path/to/queue.sqlite
+    return os.getenv('NB2W_JOB_QUEUE', 'memory')
+
+
+@dataclass
+class TargetQueue:
+    weight: float = 1.
+    # 0 means no limit
+    max_concurrency: int = 0
+
+    jobs: list = field(default_factory=list)
+    n_running: int = 0
+    # service received, in units of jobs divided by weight
+    virtual_time: float = 0.
+
+    @property
+    def eligible(self):
+        return len(self.jobs) > 0 and (self.max_concurrency <= 0 or self.n_running < self.max_concurrency)
+
+    @property
+    def head_priority(self):
+        return -self.jobs[0][0]
+
+
+class FairShareQueue:
+    """
+    queue of async workflows with one sub-queue per target, replacing a FIFO shared by all targets
+
+    The job with the highest priority among targets below their concurrency cap is taken first.
+    Between targets with equal priority, jobs are shared in proportion to the target weights,
+    so that a flood of requests to one target does not starve the others.
+    Within a target, jobs of equal priority are taken in order of submission.
+
+    Jobs put with a delay are held in a separate time-ordered heap until they are ready.
+    get() blocks until a job is ready, without polling. Delayed jobs waiting for another job
+    are made ready as soon as wake_waiting_for() is called with its key.
+
+    Implements the subset of queue.Queue used by the service; task_done(item) must be called
+    when a job taken with get() is finished.
+    """
+    def __init__(self):
+        self._targets: dict[str, TargetQueue] = {}
+        self._delayed: list = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._dependencies = DependencyRegistry()
+
+    def configure_target(self, target, weight=1., max_concurrency=0):
+        with self._cond:
+            tq = self._target(target)
+            tq.weight = weight
+            tq.max_concurrency = max_concurrency
+            self._cond.notify_all()
+
+    def _target(self, target) -> TargetQueue:
+        if target not in self._targets:
+            self._targets[target] = TargetQueue()
+        return self._targets[target]
+
+    def put(self, item, block=True, timeout=None, delay_s=0, waiting_for=None):
+        if waiting_for is not None:
+            self._dependencies.wait(waiting_for, item)
+
+        with self._cond:
+            if delay_s > 0:
+                heapq.heappush(self._delayed, (time.time() + delay_s, next(self._counter), item))
+                # waiting workers may need to wake up earlier
+                self._cond.notify_all()
+                return
+
+            self._enqueue(item)
+            self._cond.notify()
+
+    def _enqueue(self, item):
+        tq = self._target(item.target)
+
+        if len(tq.jobs) == 0 and tq.n_running == 0:
+            # a target becoming active does not get credit for the time it was idle
+            active = [t.virtual_time for t in self._targets.values() if len(t.jobs) > 0 or t.n_running > 0]
+            if active:
+                tq.virtual_time = max(tq.virtual_time, min(active))
+
+        heapq.heappush(tq.jobs, (-getattr(item, 'priority', 0), next(self._counter), item))
+
+    def wake(self, item) -> bool:
+        """
+        makes a delayed job ready now; returns False if it was not delayed
+        """
+        with self._cond:
+            for i, (_, _, delayed_item) in enumerate(self._delayed):
+                if delayed_item is item:
+                    self._delayed.pop(i)
+                    heapq.heapify(self._delayed)
+                    self._enqueue(item)
+                    self._cond.notify()
+                    return True
+        return False
+
+    def wake_waiting_for(self, key) -> int:
+        """
+        makes jobs waiting for the job with this key ready, returns the number of them
+        """
+        waiters = self._dependencies.complete(key)
+        for waiter in waiters:
+            if not self.wake(waiter):
+                logger.info("%s waiting for %s is not delayed anymore", waiter, key)
+        return len(waiters)
+
+    def waiting_for(self) -> dict:
+        return self._dependencies.status()
+
+    def _release_delayed(self):
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, item = heapq.heappop(self._delayed)
+            self._enqueue(item)
+
+    def _select(self) -> TargetQueue | None:
+        self._release_delayed()
+        eligible = [tq for tq in self._targets.values() if tq.eligible]
+        if not eligible:
+            return None
+        return min(eligible, key=lambda tq: (-tq.head_priority, tq.virtual_time))
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._cond:
+            while True:
+                tq = self._select()
+                if tq is not None:
+                    break
+
+                if not block:
+                    raise queue.Empty
+
+                if deadline is not None and deadline <= time.time():
+                    raise queue.Empty
+
+                # until the next delayed job is ready, or a job is put, or a running job is done
+                wake_up_times = [t for t in [deadline, self._delayed[0][0] if self._delayed else None] if t is not None]
+                if wake_up_times:
+                    self._cond.wait(max(min(wake_up_times) - time.time(), 0))
+                else:
+                    self._cond.wait()
+
+            _, _, item = heapq.heappop(tq.jobs)
+            tq.n_running += 1
+            tq.virtual_time += 1. / max(tq.weight, 1e-6)
+
+        self._dependencies.forget(item)
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self, item):
+        with self._cond:
+            tq = self._target(item.target)
+            tq.n_running = max(tq.n_running - 1, 0)
+            self._cond.notify_all()
+
+    def qsize(self, target=None) -> int:
+        with self._cond:
+            if target is not None:
+                return len(self._target(target).jobs) + len([d for d in self._delayed if d[2].target == target])
+            return sum(len(tq.jobs) for tq in self._targets.values()) + len(self._delayed)
+
+    def n_ready(self, target=None) -> int:
+        """
+        number of queued jobs which could be taken now, without those delayed or waiting for other jobs
+        """
+        with self._cond:
+            self._release_delayed()
+            if target is not None:
+                return len(self._target(target).jobs)
+            return sum(len(tq.jobs) for tq in self._targets.values())
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def status(self) -> dict:
+        with self._cond:
+            return {target: dict(queued=len(tq.jobs),
+                                 delayed=len([d for d in self._delayed if d[2].target == target]),
+                                 running=tq.n_running,
+                                 weight=tq.weight,
+                                 max_concurrency=tq.max_concurrency)
+                    for target, tq in self._targets.items()}
+
+
+class SQLiteJobQueue:
+    """
+    FairShareQueue kept in an SQLite database, shared by the processes of a multi-worker server,
+    or by service replicas mounting the same volume
+
+    Jobs are stored as records: items are put with item.to_record(), and made again with
+    from_record(record) by the process which takes them. A job is claimed in a write transaction,
+    so that it is taken once. get() is woken up by jobs put in the same process, and checks for jobs
+    put by other processes every sqlite_queue_poll_interval_s.
+
+    A job is leased to the process which takes it for lease_s, and the lease is renewed by a heartbeat
+    thread of that process until task_done(). Jobs of a process or replica which died are taken again
+    once their lease expires.
+    """
+    def __init__(self, path, from_record, lease_s=None):
+        self.path = path
+        self.from_record = from_record
+        self.lease_s = get_job_lease_s() if lease_s is None else lease_s
+        self._cond = threading.Condition()
+        self._db_pid = None
+        self._heartbeat_pid = None
+        self._instance_id = uuid.uuid4().hex[:8]
+
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs "
+                       "(id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, target TEXT, priority INTEGER, "
+                       "ready_at REAL, state TEXT, waiting_for TEXT, record TEXT, claimed_by TEXT, lease_until REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, ready_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_waiting_for ON jobs (waiting_for)")
+            db.execute("CREATE TABLE IF NOT EXISTS targets "
+                       "(target TEXT PRIMARY KEY, weight REAL DEFAULT 1, max_concurrency INTEGER DEFAULT 0, "
+                       "virtual_time REAL DEFAULT 0)")
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # connections are not inherited by forked workers
+        if self._db_pid != os.getpid():
+            self._connection = sqlite_connect(self.path)
+            self._db_pid = os.getpid()
+        return self._connection
+
+    @property
+    def owner(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}:{self._instance_id}"
+
+    @contextmanager
+    def _transaction(self):
+        with self._cond:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def configure_target(self, target, weight=1., max_concurrency=0):
+        with self._transaction() as db:
+            db.execute("INSERT INTO targets (target, weight, max_concurrency) VALUES (?, ?, ?) "
+                       "ON CONFLICT (target) DO UPDATE SET weight = excluded.weight, "
+                       "max_concurrency = excluded.max_concurrency",
+                       (target, weight, max_concurrency))
+
+    def put(self, item, block=True, timeout=None, delay_s=0, waiting_for=None):
+        with self._transaction() as db:
+            target_active, = db.execute("SELECT COUNT(*) FROM jobs WHERE target = ?", (item.target,)).fetchone()
+            if target_active == 0:
+                # a target becoming active does not get credit for the time it was idle
+                min_active, = db.execute("SELECT MIN(virtual_time) FROM targets "
+                                         "WHERE target IN (SELECT target FROM jobs)").fetchone()
+                db.execute("INSERT INTO targets (target, virtual_time) VALUES (?, ?) "
+                           "ON CONFLICT (target) DO UPDATE SET virtual_time = MAX(virtual_time, excluded.virtual_time)",
+                           (item.target, min_active or 0))
+
+            db.execute("INSERT INTO jobs (key, target, priority, ready_at, state, waiting_for, record) "
+                       "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                       (getattr(item, 'key', None), item.target, getattr(item, 'priority', 0),
+                        time.time() + delay_s, waiting_for,
+                        json.dumps(item.to_record(), cls=CustomJSONEncoder)))
+
+            self._cond.notify_all()
+
+    def wake_waiting_for(self, key) -> int:
+        """
+        makes jobs waiting for the job with this key ready, returns the number of them
+        """
+        with self._transaction() as db:
+            n_woken = db.execute("UPDATE jobs SET ready_at = 0, waiting_for = NULL "
+                                 "WHERE waiting_for = ? AND state = 'queued'", (key,)).rowcount
+            self._cond.notify_all()
+
+        if n_woken > 0:
+            logger.info("%s done, waking up %s jobs", key, n_woken)
+        return n_woken
+
+    def waiting_for(self) -> dict:
+        return dict(self._db.execute("SELECT waiting_for, COUNT(*) FROM jobs "
+                                     "WHERE waiting_for IS NOT NULL AND state = 'queued' GROUP BY waiting_for"))
+
+    def _claim(self):
+        now = time.time()
+
+        with self._transaction() as db:
+            n_expired = db.execute("UPDATE jobs SET state = 'queued', claimed_by = NULL, lease_until = NULL "
+                                   "WHERE state = 'running' AND lease_until < ?", (now,)).rowcount
+            if n_expired > 0:
+                logger.warning("requeued %s jobs with expired lease", n_expired)
+
+            heads = db.execute("SELECT id, target, priority, record FROM "
+                               "(SELECT id, target, priority, record, ROW_NUMBER() OVER "
+                               " (PARTITION BY target ORDER BY priority DESC, id) AS n "
+                               " FROM jobs WHERE state = 'queued' AND ready_at <= ?) "
+                               "WHERE n = 1", (now,)).fetchall()
+            if not heads:
+                return None
+
+            targets = {target: (weight, max_concurrency, virtual_time) for target, weight, max_concurrency, virtual_time
+                       in db.execute("SELECT target, weight, max_concurrency, virtual_time FROM targets")}
+            running = dict(db.execute("SELECT target, COUNT(*) FROM jobs WHERE state = 'running' GROUP BY target"))
+
+            eligible = [head for head in heads
+                        if targets.get(head[1], (1, 0, 0))[1] <= 0
+                        or running.get(head[1], 0) < targets[head[1]][1]]
+            if not eligible:
+                return None
+
+            job_id, target, _, record = min(eligible, key=lambda head: (-head[2], targets.get(head[1], (1, 0, 0))[2]))
+            weight = targets.get(target, (1, 0, 0))[0]
+
+            db.execute("UPDATE jobs SET state = 'running', claimed_by = ?, lease_until = ? WHERE id = ?",
+                       (self.owner, now + self.lease_s, job_id))
+            db.execute("INSERT INTO targets (target, virtual_time) VALUES (?, ?) "
+                       "ON CONFLICT (target) DO UPDATE SET virtual_time = virtual_time + excluded.virtual_time",
+                       (target, 1. / max(weight, 1e-6)))
+
+        self._start_heartbeat()
+
+        item = self.from_record(json.loads(record))
+        item._queue_job_id = job_id
+        return item
+
+    def heartbeat(self) -> int:
+        """
+        renews leases of jobs taken by this process, returns the number of them
+        """
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET lease_until = ? WHERE state = 'running' AND claimed_by = ?",
+                              (time.time() + self.lease_s, self.owner)).rowcount
+
+    def _start_heartbeat(self):
+        def renew_leases():
+            while True:
+                time.sleep(self.lease_s / 3)
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logger.error("unable to renew job leases: %s", repr(e))
+
+        # threads are not inherited by forked workers either
+        with self._cond:
+            if self._heartbeat_pid != os.getpid():
+                self._heartbeat_pid = os.getpid()
+                threading.Thread(target=renew_leases, name='nb2w-job-leases', daemon=True).start()
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            item = self._claim()
+            if item is not None:
+                return item
+
+            if not block:
+                raise queue.Empty
+
+            now = time.time()
+            if deadline is not None and deadline <= now:
+                raise queue.Empty
+
+            next_ready, = self._db.execute("SELECT MIN(ready_at) FROM jobs WHERE state = 'queued'").fetchone()
+            wake_up_times = [t for t in [deadline, next_ready, now + sqlite_queue_poll_interval_s] if t is not None]
+
+            with self._cond:
+                self._cond.wait(max(min(wake_up_times) - now, 0))
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self, item):
+        with self._transaction() as db:
+            # unless it was taken again after the lease expired
+            db.execute("DELETE FROM jobs WHERE id = ? AND claimed_by = ?", (item._queue_job_id, self.owner))
+            self._cond.notify_all()
+
+    def qsize(self, target=None) -> int:
+        if target is not None:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND target = ?",
+                                    (target,)).fetchone()[0]
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    def n_ready(self, target=None) -> int:
+        """
+        number of queued jobs which could be taken now, without those delayed or waiting for other jobs
+        """
+        if target is not None:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND ready_at <= ? AND target = ?",
+                                    (time.time(), target)).fetchone()[0]
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND ready_at <= ?",
+                                (time.time(),)).fetchone()[0]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def status(self) -> dict:
+        now = time.time()
+
+        status = {target: dict(queued=0, delayed=0, running=0, weight=weight, max_concurrency=max_concurrency)
+                  for target, weight, max_concurrency
+                  in self._db.execute("SELECT target, weight, max_concurrency FROM targets")}
+
+        for target, state, delayed, n in self._db.execute(
+                "SELECT target, state, ready_at > ?, COUNT(*) FROM jobs GROUP BY target, state, ready_at > ?",
+                (now, now)):
+            target_status = status.setdefault(target, dict(queued=0, delayed=0, running=0, weight=1, max_concurrency=0))
+            if state == 'running':
+                target_status['running'] += n
+            elif delayed:
+                target_status['delayed'] += n
+            else:
+                target_status['queued'] += n
+
+        return status
+
+
+def open_job_queue(url=None, from_record=None, **kwargs):
+    if url is None:
+        url = get_job_queue_url()
+
+    if url == 'memory':
+        return FairShareQueue()
+
+    if url.startswith('sqlite://'):
+        path = url[len('sqlite://'):]
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SQLiteJobQueue(path, from_record=from_record, **kwargs)
+
+    raise ValueError(f"unknown job queue {url}, can be memory or sqlite:///path")
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections.abc import MutableMapping
+
+from nb2workflow.json import CustomJSONEncoder
+
+logger = logging.getLogger(__name__)
+
+# jobs in these states are referenced by the queue, they are never evicted
+in_progress_statuses = ['submitted', 'started']
+
+# eviction is checked at most this often
+eviction_interval_s = 60
+
+
+def get_job_store_url():
+    # memory, or sqlite:///path/to/jobs.sqlite
+    return os.getenv('NB2W_JOB_STORE', 'memory')
+
+
+def get_sqlite_journal_mode():
+    # WAL needs shared memory between processes: it does not work for replicas on different nodes
+    # sharing a network volume, which need DELETE
+    return os.getenv('NB2W_SQLITE_JOURNAL_MODE', 'WAL')
+
+
+def sqlite_connect(path) -> sqlite3.Connection:
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    db.execute(f"PRAGMA journal_mode={get_sqlite_journal_mode()}")
+    return db
+
+
+def get_job_store_ttl_s():
+    return float(os.getenv('NB2W_JOB_STORE_TTL_S', 7 * 24 * 3600))
+
+
+def get_job_store_max_entries():
+    return int(os.getenv('NB2W_JOB_STORE_MAX_ENTRIES', 10000))
+
+
+class JobStore(MutableMapping):
+    """
+    state of async jobs by key: a status string, or the result once the job is done
+
+    A small index of statuses and update times is kept apart from the results, so that listing
+    and counting does not touch them. Entries expire ttl_s after the last update, and the oldest are
+    evicted above max_entries; jobs in progress are kept.
+
+    Stores of other values by job key, such as job directories, are indexed with the fixed value_status
+    instead, so that their values are not taken for job statuses.
+    """
+    def __init__(self, ttl_s=None, max_entries=None, value_status=None):
+        self.ttl_s = get_job_store_ttl_s() if ttl_s is None else ttl_s
+        self.max_entries = get_job_store_max_entries() if max_entries is None else max_entries
+        self.value_status = value_status
+
+        self._lock = threading.RLock()
+        # key: (status, update time)
+        self._index: dict[str, tuple[str, float]] = {}
+        self._last_eviction = 0
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def _store(self, key, value, updated):
+        raise NotImplementedError
+
+    def _remove(self, keys):
+        raise NotImplementedError
+
+    def status_of(self, value) -> str:
+        if self.value_status is not None:
+            return self.value_status
+        return value if isinstance(value, str) else 'done'
+
+    def _entry(self, key) -> tuple[str, float] | None:
+        return self._index.get(key)
+
+    def _entries(self) -> dict[str, tuple[str, float]]:
+        return dict(self._index)
+
+    def _index_put(self, key, status, updated):
+        self._index[key] = (status, updated)
+
+    def _index_remove(self, keys):
+        for key in keys:
+            self._index.pop(key, None)
+
+    def __getitem__(self, key):
+        with self._lock:
+            if self._entry(key) is None:
+                raise KeyError(key)
+            return self._load(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            updated = time.time()
+            self._store(key, value, updated)
+            self._index_put(key, self.status_of(value), updated)
+
+            if updated - self._last_eviction > eviction_interval_s:
+                self.evict()
+
+    def add(self, key, value) -> bool:
+        """
+        sets the value unless the key is already there, returns True if it was set
+        """
+        with self._lock:
+            if self._entry(key) is not None:
+                return False
+            self[key] = value
+            return True
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self._entry(key) is None:
+                raise KeyError(key)
+            self._remove([key])
+            self._index_remove([key])
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries()))
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries())
+            self._remove(keys)
+            self._index_remove(keys)
+
+    def status(self, key, default=None):
+        entry = self._entry(key)
+        return default if entry is None else entry[0]
+
+    def count(self, statuses=None) -> int:
+        with self._lock:
+            entries = self._entries()
+            if statuses is None:
+                return len(entries)
+            return len([s for s, _ in entries.values() if s in statuses])
+
+    def page(self, offset=0, limit=100) -> list[tuple[str, str, float]]:
+        """
+        (key, status, update time) of jobs, most recently updated first
+        """
+        with self._lock:
+            entries = sorted(self._entries().items(), key=lambda kv: kv[1][1], reverse=True)
+        return [(key, status, updated) for key, (status, updated) in entries[offset:offset + limit]]
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            self._last_eviction = now
+
+            entries = self._entries()
+            evictable = sorted([(updated, key) for key, (status, updated) in entries.items()
+                                if status not in in_progress_statuses])
+
+            evicted = [key for updated, key in evictable if self.ttl_s > 0 and now - updated > self.ttl_s]
+
+            n_over = len(entries) - len(evicted) - self.max_entries
+            if self.max_entries > 0 and n_over > 0:
+                evicted += [key for updated, key in evictable if key not in evicted][:n_over]
+
+            if len(evicted) > 0:
+                logger.info("evicting %s jobs from job store", len(evicted))
+                self._remove(evicted)
+                self._index_remove(evicted)
+
+
+class MemoryJobStore(JobStore):
+    def __init__(self, ttl_s=None, max_entries=None, value_status=None):
+        super().__init__(ttl_s=ttl_s, max_entries=max_entries, value_status=value_status)
+        self._values = {}
+
+    def _load(self, key):
+        return self._values[key]
+
+    def _store(self, key, value, updated):
+        self._values[key] = value
+
+    def _remove(self, keys):
+        for key in keys:
+            self._values.pop(key, None)
+
+
+class SQLiteJobStore(JobStore):
+    """
+    job store surviving restarts and shared by processes, or by replicas mounting the same volume:
+    the index is kept in an SQLite database, results of done jobs are written to files next to it
+    and read when requested
+
+    With recover=True, jobs left in progress by a previous process are dropped, since they were lost
+    with its queue; this is not done when the queue is persistent too.
+    """
+    def __init__(self, path, table='jobs', ttl_s=None, max_entries=None, recover=True, value_status=None):
+        super().__init__(ttl_s=ttl_s, max_entries=max_entries, value_status=value_status)
+
+        self.path = path
+        self.table = table
+        self.results_dir = f"{path}.{table}"
+        os.makedirs(self.results_dir, exist_ok=True)
+
+        self._db_pid = None
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                         f"(key TEXT PRIMARY KEY, status TEXT, value TEXT, updated REAL)")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_updated ON {table} (updated)")
+
+        if recover:
+            self._recover()
+
+        logger.info("job store %s: %s jobs", self.path, len(self))
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # connections are not inherited by forked workers
+        if self._db_pid != os.getpid():
+            self._connection = sqlite_connect(self.path)
+            self._db_pid = os.getpid()
+        return self._connection
+
+    def _recover(self):
+        # jobs in progress were lost with the queue of the previous process, they will be resubmitted
+        with self._lock:
+            placeholders = ", ".join("?" * len(in_progress_statuses))
+            n_lost = self._db.execute(f"DELETE FROM {self.table} WHERE status IN ({placeholders})",
+                                      in_progress_statuses).rowcount
+            if n_lost > 0:
+                logger.info("dropped %s jobs in progress before restart", n_lost)
+
+    def add(self, key, value) -> bool:
+        # atomic for all processes sharing the database
+        if not isinstance(value, str):
+            return super().add(key, value)
+
+        with self._lock:
+            return self._db.execute(f"INSERT OR IGNORE INTO {self.table} (key, status, value, updated) "
+                                    f"VALUES (?, ?, ?, ?)",
+                                    (key, self.status_of(value), value, time.time())).rowcount == 1
+
+    def _entry(self, key):
+        return self._db.execute(f"SELECT status, updated FROM {self.table} WHERE key = ?", (key,)).fetchone()
+
+    def _entries(self):
+        return {key: (status, updated)
+                for key, status, updated in self._db.execute(f"SELECT key, status, updated FROM {self.table}")}
+
+    def _index_put(self, key, status, updated):
+        pass
+
+    def _index_remove(self, keys):
+        pass
+
+    def count(self, statuses=None) -> int:
+        if statuses is None:
+            return self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        statuses = list(statuses)
+        placeholders = ", ".join("?" * len(statuses))
+        return self._db.execute(f"SELECT COUNT(*) FROM {self.table} WHERE status IN ({placeholders})",
+                                statuses).fetchone()[0]
+
+    def page(self, offset=0, limit=100) -> list[tuple[str, str, float]]:
+        return [tuple(row) for row in self._db.execute(
+            f"SELECT key, status, updated FROM {self.table} ORDER BY updated DESC LIMIT ? OFFSET ?",
+            (limit, offset))]
+
+    def _result_fn(self, key):
+        return os.path.join(self.results_dir, key + ".json")
+
+    def _load(self, key):
+        row = self._db.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            # removed by another process
+            raise KeyError(key)
+
+        if row[0] is not None:
+            return row[0]
+
+        with open(self._result_fn(key)) as f:
+            return json.load(f)
+
+    def _store(self, key, value, updated):
+        if isinstance(value, str):
+            inline_value = value
+        else:
+            inline_value = None
+            fn = self._result_fn(key)
+            with open(f"{fn}.{os.getpid()}.tmp", "w") as f:
+                json.dump(value, f, cls=CustomJSONEncoder)
+            os.replace(f"{fn}.{os.getpid()}.tmp", fn)
+
+        self._db.execute(f"INSERT OR REPLACE INTO {self.table} (key, status, value, updated) VALUES (?, ?, ?, ?)",
+                         (key, self.status_of(value), inline_value, updated))
+
+    def _remove(self, keys):
+        for key in keys:
+            self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            if os.path.exists(self._result_fn(key)):
+                os.remove(self._result_fn(key))
+
+
+def open_job_store(url=None, table='jobs', recover=True, **kwargs) -> JobStore:
+    if url is None:
+        url = get_job_store_url()
+
+    if url == 'memory':
+        return MemoryJobStore(**kwargs)
+
+    if url.startswith('sqlite://'):
+        path = url[len('sqlite://'):]
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SQLiteJobStore(path, table=table, recover=recover, **kwargs)
+
+    raise ValueError(f"unknown job store {url}, can be memory or sqlite:///path")
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import time
+import queue
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+from jupyter_client.manager import KernelManager
+
+logger = logging.getLogger(__name__)
+
+
+class KernelPool:
+    """
+    Keeps `size` kernels started and idle, so that an execution can lease one
+    instead of waiting for a new kernel to boot.
+
+    Kernels are never reused: a leased kernel is shut down after the job and
+    a replacement is started in the background as soon as it is leased.
+    """
+
+    def __init__(self, kernel_name='python3', size=1, startup_timeout=60):
+        self.kernel_name = kernel_name
+        self.size = size
+        self.startup_timeout = startup_timeout
+
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = dict(hits=0, misses=0, failed_starts=0)
+
+    def start(self):
+        logger.info("starting kernel pool of %s %s kernels", self.size, self.kernel_name)
+        for _ in range(self.size):
+            self._replenish()
+
+        atexit.register(self.shutdown)
+
+    @property
+    def idle(self):
+        return self._ready.qsize()
+
+    def _replenish(self):
+        if self._closed:
+            return
+
+        threading.Thread(target=self._start_kernel, daemon=True).start()
+
+    def _start_kernel(self):
+        km = KernelManager(kernel_name=self.kernel_name)
+        try:
+            km.start_kernel()
+            kc = km.client()
+            kc.start_channels()
+            try:
+                kc.wait_for_ready(timeout=self.startup_timeout)
+            finally:
+                kc.stop_channels()
+        except Exception as e:
+            logger.error("unable to start %s kernel for the pool: %s", self.kernel_name, repr(e))
+            with self._lock:
+                self.stats['failed_starts'] += 1
+            self._shutdown_kernel(km)
+            return
+
+        if self._closed:
+            self._shutdown_kernel(km)
+        else:
+            self._ready.put(km)
+
+    @staticmethod
+    def _shutdown_kernel(km):
+        try:
+            if km.has_kernel:
+                km.shutdown_kernel(now=True)
+        except Exception as e:
+            logger.warning("problem shutting down pooled kernel: %s", repr(e))
+
+    def _chdir(self, km, cwd):
+        # papermill passes cwd to kernels it starts itself; a pooled kernel was started elsewhere
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.startup_timeout)
+            reply = kc.execute_interactive(f"import os as _os; _os.chdir({cwd!r}); del _os",
+                                           silent=True,
+                                           store_history=False,
+                                           timeout=self.startup_timeout,
+                                           output_hook=lambda msg: None)
+        finally:
+            kc.stop_channels()
+
+        if reply['content']['status'] != 'ok':
+            raise RuntimeError(f"unable to change pooled kernel directory to {cwd}: {reply['content']}")
+
+    def _get(self):
+        try:
+            return self._ready.get_nowait(), True
+        except queue.Empty:
+            pass
+
+        try:
+            return self._ready.get(timeout=self.startup_timeout), False
+        except queue.Empty:
+            return None, False
+
+    @contextmanager
+    def lease(self, cwd=None):
+        """
+        yields (kernel manager, lease info); the kernel manager is None if no kernel could be
+        obtained in time, and the caller should then start its own kernel
+        """
+        t0 = time.time()
+
+        km, hit = self._get()
+        if km is not None:
+            self._replenish()
+
+            if not km.is_alive():
+                logger.warning("pooled kernel died while idle, not using it")
+                self._shutdown_kernel(km)
+                km, hit = None, False
+
+        if km is not None and cwd is not None:
+            try:
+                self._chdir(km, cwd)
+            except Exception as e:
+                logger.warning("pooled kernel can not be prepared: %s", repr(e))
+                self._shutdown_kernel(km)
+                km, hit = None, False
+
+        lease_info = dict(
+            kernel_name=self.kernel_name,
+            hit=hit,
+            wait_s=time.time() - t0,
+        )
+
+        with self._lock:
+            self.stats['hits' if hit else 'misses'] += 1
+
+        logger.info("kernel pool lease: %s", lease_info)
+
+        try:
+            yield km, lease_info
+        finally:
+            if km is not None:
+                threading.Thread(target=self._shutdown_kernel, args=(km,), daemon=True).start()
+
+    def shutdown(self):
+        self._closed = True
+
+        while True:
+            try:
+                km = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            self._shutdown_kernel(km)
@@ -26,7 +26,11 @@ import requests
 import random
 import string
 import io
+import builtins
 import threading
+import collections
+from contextlib import contextmanager
+from importlib.metadata import PackageNotFoundError
 
 import papermill as pm
 import scrapbook as sb
@@ -37,14 +41,23 @@ from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
 from . import logstash
 
+from nb2workflow import version
 from nb2workflow.sentry import sentry
 from nb2workflow.health import current_health
 from nb2workflow.logging_setup import setup_logging
 from nb2workflow.json import CustomJSONEncoder
 from nb2workflow.helpers import is_mmoda_url, serialize_workflow_exception
 from nb2workflow.semantics import understand_comment_references
+from nb2workflow.kernelpool import KernelPool
+from nb2workflow.jobdir import provisioner as jobdir_provisioner, jobdir_modes
+from nb2workflow.cellcache import cell_cache, cell_cache_tag
+from nb2workflow.dataflow import prune_cells
+from nb2workflow.events import JobEvents, events_file, engine_name as events_engine_name
+from nb2workflow.dependencies import parse_waiting_for
+from nb2workflow.ontologycache import ontology_cache, is_remote
+from nb2workflow.ontologyindex import OntologyIndex, OntologyOverlay, ODA
 
-from git import Repo, InvalidGitRepositoryError, GitCommandError
+from git import InvalidGitRepositoryError, GitCommandError
 
 import logging
 from threading import Lock
@@ -67,18 +80,39 @@ except (ModuleNotFoundError, ImportError):
             self._is_ontology_available = False
 
 
+# overlays of parameter annotations over the ontology, kept for the most recently used ones
+n_ontology_overlays_kept = 1024
+
 # TODO: will be configurable
 oda_ontology_path = "http://odahub.io/ontology/ontology.ttl"
 class ModOntology(Ontology):
     def __init__(self, ontology_path):
         self._is_ontology_available = True
-        super().__init__(ontology_path)
+        if oda_api_available and is_remote(ontology_path):
+            # parsed from the local snapshot, the remote ontology is only revalidated
+            snapshot_path, namespaces = ontology_cache.snapshot(ontology_path)
+            super().__init__(snapshot_path)
+            for prefix, namespace in namespaces:
+                self.g.bind(prefix, namespace, replace=True)
+        else:
+            super().__init__(ontology_path)
         self.lock = Lock()
+        self._index = None
+        self._overlays = collections.OrderedDict()
+
+    @property
+    def index(self) -> OntologyIndex:
+        # rebuilt after extra triples change the graph, and replaced rather than modified
+        index = self._index
+        if index is None:
+            with self.lock:
+                if self._index is None:
+                    self._index = OntologyIndex(self.g)
+                index = self._index
+        return index
 
     def get_datatype_restriction(self, param_uri):
-        self.lock.acquire()
-        dt = super()._get_datatype_restriction(param_uri)
-        self.lock.release()
+        dt = self.index.get_datatype_restriction(param_uri)
         if dt is None:
             logger.warning(f'Unknown datatype for owl_uri {param_uri}')
         return dt
@@ -86,33 +120,89 @@ class ModOntology(Ontology):
     @property
     def is_ontology_available(self):
         # TODO will be developed properly in the ontology_helper
-        return self._is_ontology_available
+        # the flag alone is not enough: the graph is not there when oda_api is not
+        return self._is_ontology_available and getattr(self, 'g', None) is not None
     
     def is_optional(self, uri):
-        self.lock.acquire()
-        res = super().is_optional(uri)
-        self.lock.release()
-        return res
+        return self.index.is_optional(uri)
     
     def parse_extra_triples(self, extra_triples, format='n3', parse_oda_annotations = True):
-        self.lock.acquire()
-        super().parse_extra_triples(
-            extra_triples,
-            format=format,
-            parse_oda_annotations=parse_oda_annotations)
-        self.lock.release()
+        with self.lock:
+            n_triples = len(self.g)
+            super().parse_extra_triples(
+                extra_triples,
+                format=format,
+                parse_oda_annotations=parse_oda_annotations)
+            if len(self.g) != n_triples:
+                self._index = None
+                self._overlays = collections.OrderedDict()
+
+    def overlay(self, extra_triples: str | None, format='n3') -> OntologyIndex:
+        """
+        the index of the ontology with the extra triples of one parameter layered over it,
+        the ontology graph itself is not modified
+        """
+        if not extra_triples:
+            return self.index
+
+        key = hashlib.sha256(f"{format}:{extra_triples}".encode()).hexdigest()
+        index = self.index
+
+        with self.lock:
+            overlay = self._overlays.get(key)
+            if overlay is not None and overlay.base is index:
+                self._overlays.move_to_end(key)
+                return overlay
+
+        graph = rdflib.Graph()
+        graph.parse(data=extra_triples, format=format)
+        overlay = OntologyOverlay(index, graph)
+
+        with self.lock:
+            # unless extra triples were parsed into the ontology meanwhile, which reset the index and overlays
+            if self._index is index:
+                self._overlays[key] = overlay
+                while len(self._overlays) > n_ontology_overlays_kept:
+                    self._overlays.popitem(last=False)
+        return overlay
 
     def get_parameter_hierarchy(self, param_uri):
-        self.lock.acquire()
-        res = super().get_parameter_hierarchy(param_uri)
-        self.lock.release()
-        return res
-    
+        return self.index.get_parameter_hierarchy(param_uri)
+
+    def is_parameter_of_class(self, param_uri, cls):
+        return self.index.is_parameter_of_class(param_uri, cls)
+
+
+class LazyOntology:
+    """
+    the ontology, loaded when it is first used rather than when the module is imported
+    """
+    def __init__(self, ontology_path):
+        object.__setattr__(self, '_ontology_path', ontology_path)
+        object.__setattr__(self, '_ontology', None)
+        object.__setattr__(self, '_load_lock', Lock())
+
+    def load(self) -> ModOntology:
+        if self._ontology is None:
+            with self._load_lock:
+                if self._ontology is None:
+                    object.__setattr__(self, '_ontology', ModOntology(self._ontology_path))
+        return self._ontology
+
+    @property
+    def is_loaded(self):
+        return self._ontology is not None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
 
-ontology = ModOntology(oda_ontology_path)
-oda_prefix = (
-    str([x[1] for x in ontology.g.namespaces() if x[0] == 'oda'][0]) 
-    if ontology.is_ontology_available else "http://odahub.io/ontology#" )
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+
+ontology = LazyOntology(oda_ontology_path)
+# as bound in the ontology, not read from it to keep it unloaded until needed
+oda_prefix = "http://odahub.io/ontology#"
 
 def run(notebook_fn, params: dict):
     nba = NotebookAdapter(notebook_fn)
@@ -125,7 +215,10 @@ def run(notebook_fn, params: dict):
     return nba.extract_output()
 
 class PapermillWorkflowIncomplete(Exception):
-    pass
+    def __init__(self, waiting_for=None):
+        # key of the upstream job, if the notebook declared it
+        self.waiting_for = waiting_for
+        super().__init__(waiting_for)
 
 def cast_parameter(x,par):
     logger.debug("cast %s %s",x,par)
@@ -237,15 +330,16 @@ def reconcile_python_type(value: Any,
     is_file_reference = False
     if owl_type is not None:
         if ontology.is_ontology_available:
-            if extra_ttl is None: 
-                extra_ttl = ''
-            ontology.parse_extra_triples(extra_ttl, parse_oda_annotations=False)
-            xsd_dt = ontology.get_datatype_restriction(owl_type)
+            # annotations of the parameter are layered over the ontology, which is shared by all notebooks
+            ontology_index = ontology.overlay(extra_ttl)
+            xsd_dt = ontology_index.get_datatype_restriction(owl_type)
             if xsd_dt:
                 owl_dt = xsd_type_to_python_type(xsd_dt) # type: ignore
-            is_optional_owl = ontology.is_optional(owl_type)
+            else:
+                logger.warning(f'Unknown datatype for owl_uri {owl_type}')
+            is_optional_owl = ontology_index.is_optional(owl_type)
             # refer tpo the comment in the cast_parameter function
-            is_file_reference = 'http://odahub.io/ontology#FileReference' in ontology.get_parameter_hierarchy(owl_type)
+            is_file_reference = ontology_index.is_parameter_of_class(owl_type, ODA.FileReference)
             if is_file_reference and value == '':
                 raise TypeCheckError(f"Empty string value is not permitted for parameter {name} of type FileReference. "
                                     "Please use None and annotate parameter as optional instead.")
@@ -332,28 +426,89 @@ class InputParameter:
 
     def as_dict(self):
         return asdict(self)
+
+
+@dataclass(frozen=True)
+class NotebookSignature:
+    """
+    what is extracted from the notebook once and shared by all its adapters, which must not modify it
+    """
+    notebook_hash: str
+    input_parameters: dict
+    system_parameters: dict
+    output_declarations: dict
+    # notebook-wide annotations
+    graph: rdflib.Graph
+    kernel_name: str
+    notebook_origin: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        def with_type_names(pars):
+            return {name: dict(par, python_type=None if par['python_type'] is None else par['python_type'].__name__)
+                    for name, par in pars.items()}
+
+        return dict(notebook_hash=self.notebook_hash,
+                    input_parameters=with_type_names(self.input_parameters),
+                    system_parameters=with_type_names(self.system_parameters),
+                    output_declarations=with_type_names(self.output_declarations),
+                    extra_ttl=self.graph.serialize(format='turtle'),
+                    kernel_name=self.kernel_name,
+                    notebook_origin=self.notebook_origin)
+
+    @classmethod
+    def from_dict(cls, d) -> NotebookSignature:
+        def builtin_type(name):
+            if name is None:
+                return None
+            python_type = getattr(builtins, name, None)
+            if not isinstance(python_type, type):
+                raise ValueError(f"not a builtin type: {name}")
+            return python_type
+
+        def with_types(pars):
+            return {name: dict(par, python_type=builtin_type(par['python_type'])) for name, par in pars.items()}
+
+        graph = rdflib.Graph()
+        graph.parse(data=d['extra_ttl'], format='turtle')
+
+        return cls(notebook_hash=d['notebook_hash'],
+                   input_parameters=with_types(d['input_parameters']),
+                   system_parameters=with_types(d['system_parameters']),
+                   output_declarations=with_types(d['output_declarations']),
+                   graph=graph,
+                   kernel_name=d['kernel_name'],
+                   notebook_origin=d['notebook_origin'])
         
 
 class NotebookAdapter:
     limit_output_attachment_file = None
 
-    def __init__(self, notebook_fn, tempdir_cache=None, n_download_max_tries=10, download_retry_sleep_s=.5, max_download_size=500e6):
+    def __init__(self, notebook_fn, tempdir_cache=None, n_download_max_tries=10, download_retry_sleep_s=.5, max_download_size=500e6,
+                 kernel_pool=None):
         self.notebook_fn = os.path.abspath(notebook_fn)
         self.name = notebook_short_name(notebook_fn)
         self.tempdir_cache = tempdir_cache
-        self._graph = rdflib.Graph()
+        self.kernel_pool = kernel_pool
         logger.debug("notebook adapter for %s", self.notebook_fn)
-        logger.debug(self.extract_parameters())
-        logger.debug(self.extract_output_declarations())
+
+        self.signature = signature_cache.get(self.notebook_fn, self._extract_signature)
+        # adapters may change their parameters, e.g. get_system_parameter_value pops them
+        self._input_parameters = dict(self.signature.input_parameters)
+        self.system_parameters = dict(self.signature.system_parameters)
+        if self.signature.notebook_origin is not None:
+            self._notebook_origin = self.signature.notebook_origin
         self.n_download_max_tries = n_download_max_tries
         self.download_retry_sleep_s = download_retry_sleep_s
         self.max_download_size = max_download_size
 
     @property
     def graph(self):
-        # need to populate the graph (currently only notebook-wide annotations)
-        self.extract_parameters()
-        return self._graph
+        # currently only notebook-wide annotations
+        return self.signature.graph
+
+    @property
+    def _graph(self):
+        return self.signature.graph
 
     @staticmethod
     def get_unique_filename_from_url(file_url):
@@ -362,9 +517,10 @@ class NotebookAdapter:
         file_name = f"{file_name_prefix}_{parsed_arg_par_value.path.split('/')[-1]}"
         return file_name
 
-    def new_tmpdir(self, cache_key=None):
+    def new_tmpdir(self, cache_key=None, path=None):
         logger.debug("tmpdir was "+getattr(self,'_tmpdir','unset'))
-        self._tmpdir = None
+        # path is an empty directory prepared by the caller, e.g. before the job is sent to another process
+        self._tmpdir = path
         logger.debug("tmpdir became %s", self._tmpdir)
 
         newdir = self.tmpdir
@@ -389,12 +545,20 @@ class NotebookAdapter:
     def output_notebook_fn(self):
         return os.path.join(self.tmpdir, os.path.basename(self.notebook_fn.replace(".ipynb","_output.ipynb")))
 
+    @property
+    def partial_output_notebook_fn(self):
+        return os.path.join(self.tmpdir, os.path.basename(self.notebook_fn.replace(".ipynb","_output.partial.ipynb")))
+
     def read(self):
         if not os.path.exists(self.notebook_fn):
             raise RuntimeError(f"notebook {self.notebook_fn} not found in {os.getcwd()}")
 
         return nbformat.reads(open(self.notebook_fn).read(), as_version=4)
 
+    @property
+    def kernel_name(self):
+        return self.signature.kernel_name
+
     _notebook_origin = None
 
     @property
@@ -504,7 +668,7 @@ class NotebookAdapter:
         
         return result
     
-    def extract_parameters_from_cell(self, cell):
+    def extract_parameters_from_cell(self, cell, graph):
         parameters = {}
         
         parsed_cell = self.parse_source_multiline(cell['source'])
@@ -555,19 +719,21 @@ class NotebookAdapter:
             p = understand_comment_references(cstring, base_uri=self.nb_uri)
             if p is not None:
                 try:
-                    self._graph.parse(data=p['extra_ttl'])
+                    graph.parse(data=p['extra_ttl'])
                 except Exception as e:
                     logger.warning("not a turtle: %s", p['extra_ttl'])
 
         return parameters
 
-    @lru_cache
-    def extract_parameters(self):
+    def _extract_signature(self) -> NotebookSignature:
+        """
+        reads and parses the notebook, called by signature_cache when the notebook is new or changed
+        """
         nb = self.read()
 
-        self._input_parameters = {}
-        self.system_parameters = {}
-               
+        graph = rdflib.Graph()
+        extracted = dict(input_parameters={}, system_parameters={})
+
         for cell in nb.cells:
             for tag, attr in [
                     ('parameters', 'input_parameters'),
@@ -575,18 +741,23 @@ class NotebookAdapter:
                     ('injected-parameters', 'input_parameters'),
                     ]:
                 if tag in cell.metadata.get('tags', []):
-                    pars = self.extract_parameters_from_cell(cell)
-                    pars = {**getattr(self, attr), **pars}
-                    setattr(self, attr, pars)
+                    extracted[attr] = {**extracted[attr], **self.extract_parameters_from_cell(cell, graph)}
+
+        return NotebookSignature(notebook_hash=self.notebook_hash,
+                                 input_parameters=extracted['input_parameters'],
+                                 system_parameters=extracted['system_parameters'],
+                                 output_declarations=self._extract_output_declarations(nb),
+                                 graph=graph,
+                                 kernel_name=nb.metadata.get('kernelspec', {}).get('name', 'python3'),
+                                 # if it was needed for notebook-wide annotations
+                                 notebook_origin=self._notebook_origin)
 
+    def extract_parameters(self):
         return self._input_parameters
 
     @property
     def input_parameters(self):
-        try:
-            return self._input_parameters
-        except AttributeError:
-            return self.extract_parameters()
+        return self._input_parameters
 
     @input_parameters.setter
     def input_parameters(self, value):
@@ -653,7 +824,7 @@ class NotebookAdapter:
 
         
 
-    def execute(self, parameters, progress_bar=True, log_output=True, inplace=False, tmpdir_key=None, context=None):
+    def execute(self, parameters, progress_bar=True, log_output=True, inplace=False, tmpdir_key=None, context=None, tmpdir=None):
 
         if context is None:
             context = {}
@@ -661,7 +832,7 @@ class NotebookAdapter:
         logstasher.log(dict(origin="nb2workflow.execute", event="starting", parameters=parameters, workflow_name=notebook_short_name(self.notebook_fn), health=current_health()))
 
         logger.info("starting job")
-        exceptions = self._execute(parameters, progress_bar, log_output, inplace, context=context, tmpdir_key=tmpdir_key)
+        exceptions = self._execute(parameters, progress_bar, log_output, inplace, context=context, tmpdir_key=tmpdir_key, tmpdir=tmpdir)
 
         tspent = time.time() - t0
         logstasher.log(dict(origin="nb2workflow.execute",
@@ -674,16 +845,17 @@ class NotebookAdapter:
 
         return exceptions
 
-    def _execute(self, parameters, progress_bar=True, log_output=True, inplace=False, context={}, tmpdir_key=None):
+    def _execute(self, parameters, progress_bar=True, log_output=True, inplace=False, context={}, tmpdir_key=None, tmpdir=None):
         exceptions = []
 
         if not inplace :
-            tmpdir = self.new_tmpdir(tmpdir_key)
+            tmpdir = self.new_tmpdir(tmpdir_key, path=tmpdir)
             logger.info("new tmpdir: %s", tmpdir)
             repo_dir = os.path.dirname(os.path.realpath(self.notebook_fn))
             try:
-                repo = Repo(repo_dir)
-                repo.clone(tmpdir, multi_options=["--recurse-submodules"])
+                jobdir_mode = jobdir_provisioner.provision(repo_dir, tmpdir)
+                logger.info("job directory %s provisioned with %s", tmpdir, jobdir_mode)
+                self.update_summary(jobdir_mode=jobdir_mode)
             except InvalidGitRepositoryError:
                 logger.warning(f"repository {repo_dir} is invalid, will attempt copytree")
                 os.rmdir(tmpdir)
@@ -712,46 +884,54 @@ class NotebookAdapter:
             self.update_summary(state="started", parameters=parameters)
 
             self.inject_output_gathering()
+            self.apply_cell_cache(parameters, tmpdir)
 
-            ntries = 10
-            while ntries > 0:
-                try:
-                    thread_id = threading.get_ident()
-                    process_id = os.getpid()
-                    logger.info(f'pm.execute_notebook thread id: {thread_id} ; process id: {process_id}')
+            events = JobEvents(os.path.join(tmpdir, events_file))
+
+            # written by the gather cell in the kernel working directory, may remain from a previous execution
+            self._workdir = tmpdir
+            if os.path.exists(self.outputs_fn):
+                os.remove(self.outputs_fn)
 
+            try:
+                thread_id = threading.get_ident()
+                process_id = os.getpid()
+                logger.info(f'pm.execute_notebook thread id: {thread_id} ; process id: {process_id}')
+
+                with self._lease_kernel(tmpdir) as km:
                     pm.execute_notebook(
                        self.preproc_notebook_fn,
-                       self.output_notebook_fn,
+                       self.partial_output_notebook_fn,
                        parameters = r['adapted_parameters'],
                        progress_bar = False,
                        log_output = True,
                        cwd = tmpdir,
+                       km = km,
+                       engine_name = events_engine_name,
+                       events = events,
                     )
-                except (pm.PapermillExecutionError, DeadKernelError) as e:
-                    exceptions.append([e,e.args])
-                    logger.info(e)
-                    logger.info(e.args)
-
-                    if isinstance(e, DeadKernelError):
-                        sentry.capture_exception(e)
-                        
-                    elif e.ename == "WorkflowIncomplete":
-                        logger.info("detected incomplete workflow")
-                        self.update_summary(state="incomplete dependency", dependency=repr(e))
-                        raise  PapermillWorkflowIncomplete()
-                
-                except nbformat.reader.NotJSONError:
-                    ntries -= 1
-                    logger.info("retrying... %s", ntries)
-                    time.sleep(2)
-                    continue
-                
-                except Exception as e:
-                    logger.error('Unexpected exception %s', e)
+            except (pm.PapermillExecutionError, DeadKernelError) as e:
+                exceptions.append([e,e.args])
+                logger.info(e)
+                logger.info(e.args)
+
+                if isinstance(e, DeadKernelError):
                     sentry.capture_exception(e)
                     
-                break
+                elif e.ename == "WorkflowIncomplete":
+                    waiting_for = parse_waiting_for(e.evalue)
+                    logger.info("detected incomplete workflow, waiting for %s", waiting_for)
+                    self.update_summary(state="incomplete dependency", dependency=repr(e), waiting_for=waiting_for)
+                    raise  PapermillWorkflowIncomplete(waiting_for)
+
+            except Exception as e:
+                logger.error('Unexpected exception %s', e)
+                sentry.capture_exception(e)
+
+            finally:
+                # papermill saves the notebook after every cell; readers only ever see the complete one
+                if os.path.exists(self.partial_output_notebook_fn):
+                    os.replace(self.partial_output_notebook_fn, self.output_notebook_fn)
 
         if len(exceptions) == 0:
             self.update_summary(state="done")
@@ -760,6 +940,16 @@ class NotebookAdapter:
 
         return exceptions
 
+    @contextmanager
+    def _lease_kernel(self, cwd):
+        if self.kernel_pool is None:
+            yield None
+            return
+
+        with self.kernel_pool.lease(cwd=cwd) as (km, lease_info):
+            self.update_summary(kernel_pool=lease_info)
+            yield km
+
     def _pass_context(self, workdir: str, context: dict):
         """
         save context to file .oda_api_context in the notebook dir where it can be accessed by ODA API
@@ -792,10 +982,10 @@ class NotebookAdapter:
 
         return outputs
 
-    @lru_cache
     def extract_output_declarations(self):
-        nb=self.read()
+        return dict(self.signature.output_declarations)
 
+    def _extract_output_declarations(self, nb):
         outputs = {}
 
         for cell in nb.cells:
@@ -816,7 +1006,17 @@ class NotebookAdapter:
 
         return outputs 
 
+    @property
+    def outputs_fn(self):
+        return os.path.join(getattr(self, '_workdir', self.tmpdir), outputs_file)
+
     def extract_output(self):
+        try:
+            with open(self.outputs_fn) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.info("outputs not available in %s (%s), reading output notebook", self.outputs_fn, e)
+
         return self.extract_pm_output()
 
     def download_file(self, file_url, tmpdir):
@@ -890,16 +1090,16 @@ class NotebookAdapter:
         return file_name
 
     @staticmethod
-    def check_is_file_input(owl_type: str) -> dict[str, bool]:
+    def check_is_file_input(owl_type: str, extra_ttl: str | None = None) -> dict[str, bool]:
         posix_path_with_annotations_pattern = re.compile(rf"^{re.escape(oda_prefix)}.*_POSIXPath_")
         file_url_with_annotations_pattern = re.compile(rf"^{re.escape(oda_prefix)}.*_FileURL_")
         file_reference_with_annotations_pattern = re.compile(rf"^{re.escape(oda_prefix)}.*_FileReference_")
 
         if ontology.is_ontology_available:
-            parameter_hierarchy = ontology.get_parameter_hierarchy(owl_type)
-            is_posix_path = f"{oda_prefix}POSIXPath" in parameter_hierarchy
-            is_file_url = f"{oda_prefix}FileURL" in parameter_hierarchy
-            is_file_reference = f"{oda_prefix}FileReference" in parameter_hierarchy
+            ontology_index = ontology.overlay(extra_ttl)
+            is_posix_path = ontology_index.is_parameter_of_class(owl_type, ODA.POSIXPath)
+            is_file_url = ontology_index.is_parameter_of_class(owl_type, ODA.FileURL)
+            is_file_reference = ontology_index.is_parameter_of_class(owl_type, ODA.FileReference)
         else:
             is_posix_path = f"{oda_prefix}POSIXPath" == owl_type or \
                             posix_path_with_annotations_pattern.match(owl_type) is not None
@@ -917,7 +1117,8 @@ class NotebookAdapter:
         adapted_parameters = copy.deepcopy(parameters)
         exceptions = []
         for input_par_name, input_par_obj in self.input_parameters.items():
-            is_posix_path, is_file_url, is_file_reference = self.check_is_file_input(input_par_obj['owl_type']).values()
+            is_posix_path, is_file_url, is_file_reference = self.check_is_file_input(input_par_obj['owl_type'],
+                                                                                         input_par_obj.get('extra_ttl')).values()
 
             if is_posix_path or is_file_url or is_file_reference:
                 arg_par_value = parameters.get(input_par_name, None)
@@ -956,7 +1157,64 @@ class NotebookAdapter:
             exceptions=exceptions
         )
 
+    @property
+    def notebook_hash(self):
+        return file_content_hash(self.notebook_fn)
+
+    @property
+    def preproc_cache_key(self):
+        # the gather cell depends on the notebook and on this class, nothing else
+        return hashlib.sha256(json.dumps([
+                    self.notebook_hash,
+                    nb2workflow_version(),
+                    preproc_version,
+                    self.limit_output_attachment_file,
+                ]).encode()).hexdigest()
+
     def inject_output_gathering(self):
+        cache_key = self.preproc_cache_key
+
+        cached = preproc_cache.get(cache_key)
+        if cached is None:
+            cached = preproc_cache.put(cache_key, *self.preprocess())
+        else:
+            log_nbformat_compatibility(cached['source_nbformat_minor'])
+
+        if cached.get('pruned_cells'):
+            self.update_summary(pruned_cells=cached['pruned_cells'])
+
+        if cached['path'] is None:
+            pm.iorw.write_ipynb(cached['nb'], self.preproc_notebook_fn)
+        else:
+            # a copy, not a link: the job may rewrite its notebook, the cached one is shared by all jobs
+            shutil.copyfile(cached['path'], self.preproc_notebook_fn)
+
+        logger.info("stored pre-processed notebook as %s", self.preproc_notebook_fn)
+
+    def apply_cell_cache(self, parameters, workdir):
+        nb = nbformat.read(self.preproc_notebook_fn, as_version=4)
+
+        # not popped: read on every execution
+        cache_all = bool(self.system_parameters.get('cell_cache', {}).get('default_value', False))
+
+        if not cache_all and not any(cell_cache_tag in cell.metadata.get('tags', []) for cell in nb.cells):
+            return
+
+        parameter_values = {name: par['default_value'] for name, par in self.input_parameters.items()}
+        parameter_values.update(parameters)
+
+        planned = cell_cache.plan(nb,
+                                  parameter_values,
+                                  salt=[self.notebook_origin, nb2workflow_version()],
+                                  cache_all=cache_all)
+        cell_cache_summary = cell_cache.apply(nb, planned, workdir)
+        logger.info("cell cache: %s hits, %s misses", cell_cache_summary['hits'], cell_cache_summary['misses'])
+
+        pm.iorw.write_ipynb(nb, self.preproc_notebook_fn)
+
+        self.update_summary(cell_cache=cell_cache_summary)
+
+    def preprocess(self):
         outputs = self.extract_output_declarations()
 
         output_gather_content="""
@@ -970,16 +1228,27 @@ import os
 from nb2workflow.nbadapter import denumpyfy
 from nb2workflow.json import CustomJSONEncoder
 
+_nb2w_outputs = {}
+
+def _nb2w_glue(name, value):
+    sb.glue(name, value)
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        # glued with another encoder of scrapbook, e.g. a pandas DataFrame
+        value = json.dumps(value, cls=CustomJSONEncoder)
+    _nb2w_outputs[name] = value
+
 """
         for output in outputs.keys():
             logger.debug("output: %s",output)
             output_gather_content+="""
 try:
-    sb.glue("{output}",denumpyfy({output}))
+    _nb2w_glue("{output}",denumpyfy({output}))
 except Exception as e:
     print("failed to glue {output}", {output})
     print("will glue jsonified")
-    sb.glue("{output}",json.dumps(denumpyfy({output}), cls=CustomJSONEncoder))
+    _nb2w_glue("{output}",json.dumps(denumpyfy({output}), cls=CustomJSONEncoder))
 """.format(output=output)
 
             output_gather_content += f"""
@@ -991,7 +1260,7 @@ if isinstance({output},str) and os.path.exists({output}):
     if {self.limit_output_attachment_file} is None or len(content) < {self.limit_output_attachment_file}:
         encoded = base64.b64encode(content).decode()
         print("glueing file", fn)
-        sb.glue(variable_name + "_content", encoded)
+        _nb2w_glue(variable_name + "_content", encoded)
     else:
         # TODO: make a customizable upload to different DL platforms; before that it should be enabled with caution    
         nb2w_store_base = os.getenv("NB2W_CACHE", os.getenv("HOME") + "/.cache/nb2workflow/bigoutputs")
@@ -1001,11 +1270,21 @@ if isinstance({output},str) and os.path.exists({output}):
         with open(url.replace("file://", ""), "wb") as f:
             f.write(content)
 
-        sb.glue(\"{output}_url\", url)
+        _nb2w_glue(\"{output}_url\", url)
 """
             output_gather_content+="\n".format(output=output)
 
-        nb = self.read()
+        output_gather_content += f"""
+# same outputs, readable without parsing the output notebook
+try:
+    with open("{outputs_file}.tmp", "w") as f:
+        json.dump(_nb2w_outputs, f)
+    os.replace("{outputs_file}.tmp", "{outputs_file}")
+except Exception as e:
+    print("failed to store outputs in {outputs_file}", e)
+    if os.path.exists("{outputs_file}.tmp"):
+        os.remove("{outputs_file}.tmp")
+"""
 
         newcell = nbformat.v4.new_code_cell(source=output_gather_content)
         newcell.metadata['tags'] = ['injected-gather-outputs']
@@ -1018,25 +1297,19 @@ if isinstance({output},str) and os.path.exists({output}):
                           nb.nbformat)
             raise RuntimeError("incompatabile notebook major version")
 
-        logger.info("provided notebook nbformat version minor %s while nbformat package minor version %s",
-                    nb.nbformat_minor, nbformat.current_nbformat_minor)
-                
-        if nbformat.current_nbformat_minor == nb.nbformat_minor:
-            logger.info("versions of notebook and environment match")
-        elif nbformat.current_nbformat_minor < nb.nbformat_minor:
-            logger.warn("notebook is newer than envionment package! please update your system or expect warnings")
-        elif  nbformat.current_nbformat_minor > nb.nbformat_minor:
-            logger.warning("will attempt to convert, but expect other warnings!")                            
-
-            nb = nbformat.v4.convert.upgrade(nb, from_minor=nb.nbformat_minor)
-        else:
-            raise NotImplementedError
-
+        source_nbformat_minor = nb.nbformat_minor
+        if log_nbformat_compatibility(source_nbformat_minor):
+            nb = nbformat.v4.convert.upgrade(nb, from_minor=source_nbformat_minor)
 
         nb.cells = nb.cells + [newcell] 
 
-        logger.info("stored pre-processed notebook as %s", self.preproc_notebook_fn)
-        pm.iorw.write_ipynb(nb, self.preproc_notebook_fn)
+        info = dict(source_nbformat_minor=source_nbformat_minor)
+
+        # not popped: the pre-processed notebook is built by per-request adapters
+        if self.system_parameters.get('prune_cells', {}).get('default_value', False):
+            info['pruned_cells'] = prune_cells(nb)
+
+        return nb, info
 
     def get_system_parameter_value(self, name, default):
         if name in self.system_parameters:
@@ -1048,11 +1321,265 @@ if isinstance({output},str) and os.path.exists({output}):
     def remove_tmpdir(self):
         if self._tmpdir is not None:
             logger.info("removing tmpdir %s", self._tmpdir)
+            jobdir_provisioner.release(self._tmpdir)
             shutil.rmtree(self._tmpdir)
         else:
             logger.info("no dir to remove")
 
 
+@lru_cache
+def nb2workflow_version():
+    try:
+        return version(print_it=False)
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+@lru_cache(maxsize=1024)
+def _file_sha256(path, mtime_ns, size, ino) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def file_content_hash(fn) -> str:
+    """
+    sha256 of the file content, read and hashed again only when the file is modified
+    """
+    st = os.stat(fn)
+    return _file_sha256(os.path.abspath(fn), st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def log_nbformat_compatibility(nbformat_minor) -> bool:
+    """
+    returns True if the notebook needs to be upgraded to the current minor version
+    """
+    logger.info("provided notebook nbformat version minor %s while nbformat package minor version %s",
+                nbformat_minor, nbformat.current_nbformat_minor)
+            
+    if nbformat.current_nbformat_minor == nbformat_minor:
+        logger.info("versions of notebook and environment match")
+    elif nbformat.current_nbformat_minor < nbformat_minor:
+        logger.warning("notebook is newer than envionment package! please update your system or expect warnings")
+    elif  nbformat.current_nbformat_minor > nbformat_minor:
+        logger.warning("will attempt to convert, but expect other warnings!")                            
+        return True
+    else:
+        raise NotImplementedError
+
+    return False
+
+
+class PreprocCache:
+    """
+    pre-processed notebooks (with injected output gathering) by notebook content and nb2workflow version,
+    kept in memory and in NB2W_PREPROC_CACHE directory
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = Lock()
+
+    @property
+    def cache_dir(self):
+        return os.getenv("NB2W_PREPROC_CACHE", os.path.join(os.getenv("HOME", "/tmp"), ".cache/nb2workflow/preproc"))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None and (entry['path'] is None or os.path.exists(entry['path'])):
+            return entry
+
+        path = os.path.join(self.cache_dir, key + ".ipynb")
+        try:
+            with open(path + ".json") as f:
+                entry = dict(json.load(f), path=path, nb=None)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(path):
+            return None
+
+        logger.info("found pre-processed notebook in %s", path)
+        with self._lock:
+            self._entries[key] = entry
+
+        return entry
+
+    def put(self, key, nb, info):
+        entry = dict(info, path=None, nb=nb)
+
+        path = os.path.join(self.cache_dir, key + ".ipynb")
+        tmp_suffix = f".tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = os.path.join(self.cache_dir, key + tmp_suffix + ".ipynb")
+            pm.iorw.write_ipynb(nb, tmp_path)
+            os.replace(tmp_path, path)
+            with open(path + ".json" + tmp_suffix, "w") as f:
+                json.dump(info, f)
+            os.replace(path + ".json" + tmp_suffix, path + ".json")
+            entry.update(path=path, nb=None)
+        except OSError as e:
+            logger.warning("unable to store pre-processed notebook in %s: %s", self.cache_dir, e)
+
+        with self._lock:
+            self._entries[key] = entry
+
+        return entry
+
+
+preproc_cache = PreprocCache()
+
+
+class SignatureCache:
+    """
+    notebook signatures by notebook path, so that adapters made for every request do not parse the notebook;
+    a signature is extracted again when the notebook content changes
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _stat_key(notebook_fn):
+        st = os.stat(notebook_fn)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @staticmethod
+    def _content_hash(notebook_fn):
+        with open(notebook_fn, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def get(self, notebook_fn, extract) -> NotebookSignature:
+        if not os.path.exists(notebook_fn):
+            return extract()
+
+        stat_key = self._stat_key(notebook_fn)
+
+        with self._lock:
+            entry = self._entries.get(notebook_fn)
+
+        if entry is not None:
+            if entry[0] == stat_key:
+                return entry[1]
+
+            # touched, but not changed, e.g. by a checkout
+            if entry[1].notebook_hash == self._content_hash(notebook_fn):
+                with self._lock:
+                    self._entries[notebook_fn] = (stat_key, entry[1])
+                return entry[1]
+
+        logger.debug("extracting signature of %s", notebook_fn)
+        signature = extract()
+
+        with self._lock:
+            self._entries[notebook_fn] = (stat_key, signature)
+
+        return signature
+
+    def put(self, notebook_fn, signature):
+        with self._lock:
+            self._entries[notebook_fn] = (self._stat_key(notebook_fn), signature)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+signature_cache = SignatureCache()
+
+
+# written at build time next to the notebooks by nbinspect --write-signature
+signature_file = '.nb2w_signature.json'
+
+# changes of the signature file layout
+signature_format_version = 1
+
+
+def notebook_directory(source):
+    return source if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+
+
+def write_signature_file(nbas: dict[str, NotebookAdapter], directory) -> str:
+    """
+    writes signatures of the notebooks, with the RDF signature and OpenAPI specification of the service
+    """
+    from nb2workflow import ontology
+
+    try:
+        from nb2workflow.service import workflow_specs
+        openapi = {target: workflow_specs(nba) for target, nba in nbas.items()}
+    except ImportError as e:
+        logger.warning("OpenAPI specification is not included without service dependencies: %s", e)
+        openapi = None
+
+    notebooks = {}
+    for target, nba in nbas.items():
+        entry = dict(nba.signature.to_dict(), notebook_fn=os.path.basename(nba.notebook_fn))
+
+        # e.g. tuple default values would come back as lists
+        restored = NotebookSignature.from_dict(json.loads(json.dumps(entry, cls=CustomJSONEncoder)))
+        if [restored.input_parameters, restored.system_parameters, restored.output_declarations] != \
+           [nba.signature.input_parameters, nba.signature.system_parameters, nba.signature.output_declarations]:
+            logger.warning("signature of %s does not survive serialization, it will be extracted at start", target)
+            continue
+
+        notebooks[target] = entry
+
+    fn = os.path.join(directory, signature_file)
+    with open(fn + ".tmp", "w") as f:
+        json.dump(dict(format_version=signature_format_version,
+                       nb2workflow_version=nb2workflow_version(),
+                       notebooks=notebooks,
+                       service_semantic_signature=ontology.service_semantic_signature(nbas),
+                       openapi=openapi),
+                  f, cls=CustomJSONEncoder)
+    os.replace(fn + ".tmp", fn)
+
+    logger.info("wrote signatures of %s notebooks to %s", len(notebooks), fn)
+    return fn
+
+
+def read_signature_file(directory) -> dict | None:
+    """
+    reads signatures written by write_signature_file with the same nb2workflow version; those of notebooks
+    which did not change since are put in signature_cache. up_to_date tells if all of them were.
+    """
+    fn = os.path.join(directory, signature_file)
+    try:
+        with open(fn) as f:
+            doc = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("unable to read notebook signatures from %s: %s", fn, e)
+        return None
+
+    if doc.get('format_version') != signature_format_version or doc.get('nb2workflow_version') != nb2workflow_version():
+        logger.info("notebook signatures in %s are from another nb2workflow version, ignoring", fn)
+        return None
+
+    doc['up_to_date'] = True
+    for target, entry in doc['notebooks'].items():
+        notebook_fn = os.path.join(os.path.abspath(directory), entry['notebook_fn'])
+        try:
+            if SignatureCache._content_hash(notebook_fn) != entry['notebook_hash']:
+                raise ValueError("notebook changed")
+            signature_cache.put(notebook_fn, NotebookSignature.from_dict(entry))
+        except (OSError, ValueError, KeyError) as e:
+            logger.info("signature of %s in %s is not used: %s", target, fn, e)
+            doc['up_to_date'] = False
+
+    return doc
+
+
+# written by the injected gather cell, relative to the kernel working directory
+outputs_file = '.nb2w_outputs.json'
+
+# changes of pre-processing not reflected in nb2workflow version, e.g. during development
+preproc_version = 2
+
+
 def notebook_short_name(ipynb_fn):
     return os.path.basename(ipynb_fn).replace(".ipynb","")
 
@@ -1093,8 +1620,8 @@ def find_notebooks(source, tests=False, pattern = r'.*') -> dict[str, NotebookAd
 
     return notebook_adapters
 
-def nbinspect(nb_source, out=True, machine_readable=False):
-    nbas = find_notebooks(nb_source)
+def nbinspect(nb_source, out=True, machine_readable=False, write_signature=False, pattern=r'.*'):
+    nbas = find_notebooks(nb_source, pattern=pattern)
 
     # class CustomEncoder(json.JSONEncoder):
     #     def default(self, obj):
@@ -1113,6 +1640,9 @@ def nbinspect(nb_source, out=True, machine_readable=False):
 
     if machine_readable:
         print("WORKFLOW-NB-SIGNATURE:", json.dumps(summary, cls=CustomJSONEncoder))
+
+    if write_signature:
+        write_signature_file(nbas, notebook_directory(nb_source))
     
 
 def nbreduce(nb_source, max_size_mb):
@@ -1234,7 +1764,7 @@ def validate_oda_dispatcher(nba: NotebookAdapter, optional=True, machine_readabl
         
     
 
-def nbrun(nb_source, inp, inplace=False, optional_dispather=True, machine_readable=False):
+def nbrun(nb_source, inp, inplace=False, optional_dispather=True, machine_readable=False, kernel_pool_size=0):
 
     nbas = find_notebooks(nb_source)
 
@@ -1256,7 +1786,16 @@ def nbrun(nb_source, inp, inplace=False, optional_dispather=True, machine_readab
 
     logging.info("found parameters %s", repr(pars))
 
-    exceptions = nba.execute(pars, inplace=inplace)
+    if kernel_pool_size > 0:
+        # the kernel boots while the job directory is prepared
+        nba.kernel_pool = KernelPool(nba.kernel_name, size=kernel_pool_size)
+        nba.kernel_pool.start()
+
+    try:
+        exceptions = nba.execute(pars, inplace=inplace)
+    finally:
+        if nba.kernel_pool is not None:
+            nba.kernel_pool.shutdown()
 
     if len(exceptions) == 0:
         logging.info("execution SUCCESSFUL!")
@@ -1355,12 +1894,17 @@ def main_inspect():
     parser.add_argument('notebook', metavar='notebook', type=str)
     parser.add_argument('--debug', action="store_true")
     parser.add_argument('--machine-readable', action="store_true")        
+    parser.add_argument('--write-signature', action="store_true",
+                        help=f'write signatures of the notebooks to {signature_file} next to them, '
+                             'for nb2service to start without parsing the notebooks')
+    parser.add_argument('--pattern', type=str, default=r'.*')
     
     args = parser.parse_args()
 
     setup_logging(args.debug)
 
-    nbinspect(args.notebook, machine_readable=args.machine_readable)
+    nbinspect(args.notebook, machine_readable=args.machine_readable, write_signature=args.write_signature,
+              pattern=args.pattern)
 
 
 def main():
@@ -1370,6 +1914,8 @@ def main():
     parser.add_argument('--inplace', action="store_true")
     parser.add_argument('--mmoda-validation', action="store_true")        
     parser.add_argument('--machine-readable', action="store_true")        
+    parser.add_argument('--kernel-pool-size', metavar='N', type=int, default=0)
+    parser.add_argument('--jobdir-mode', choices=jobdir_modes, default=None)
     
     parser.add_argument('inputs', nargs=argparse.REMAINDER)
 
@@ -1383,7 +1929,11 @@ def main():
         
     setup_logging(args.debug)
 
-    nbrun(args.notebook, inputs, inplace=args.inplace, optional_dispather=not args.mmoda_validation, machine_readable=args.machine_readable)
+    if args.jobdir_mode is not None:
+        os.environ['NB2W_JOBDIR_MODE'] = args.jobdir_mode
+
+    nbrun(args.notebook, inputs, inplace=args.inplace, optional_dispather=not args.mmoda_validation, machine_readable=args.machine_readable,
+          kernel_pool_size=args.kernel_pool_size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import rdflib
+import requests
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for the ontology server before falling back to the cached copy
+ontology_fetch_timeout_s = 10
+
+
+def get_ontology_cache_dir():
+    return os.getenv('NB2W_ONTOLOGY_CACHE', os.path.join(os.getenv('HOME', '/tmp'), '.cache/nb2workflow/ontology'))
+
+
+def get_ontology_max_age_s():
+    # the cached copy is used without asking the server for this long, then revalidated with its ETag
+    return float(os.getenv('NB2W_ONTOLOGY_MAX_AGE_S', 24 * 3600))
+
+
+def is_remote(url) -> bool:
+    return url.startswith('http://') or url.startswith('https://')
+
+
+class OntologyCache:
+    """
+    local copies of remote ontologies, keyed by url and revalidated with their ETag
+
+    Every ontology is kept as fetched, and as an N-Triples snapshot which parses faster, along with
+    its namespace bindings which the snapshot does not keep. When the server can not be reached,
+    the cached copy is used however old it is, so that services and image builds work offline once
+    the cache is populated.
+    """
+    def __init__(self, directory=None):
+        self._directory = directory
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        return self._directory or get_ontology_cache_dir()
+
+    def _path(self, url, suffix):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest()[:16] + suffix)
+
+    def _read_meta(self, url) -> dict | None:
+        try:
+            with open(self._path(url, '.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get('url') != url or not os.path.exists(self._path(url, '.ttl')):
+            return None
+        return meta
+
+    def _write(self, url, suffix, content, mode='w'):
+        # written aside and renamed, concurrent readers see the old or the new version
+        fn = self._path(url, suffix)
+        tmp_fn = f'{fn}.{os.getpid()}.tmp'
+        with open(tmp_fn, mode) as f:
+            f.write(content)
+        os.replace(tmp_fn, fn)
+
+    def fetch(self, url) -> str:
+        """
+        path of the up-to-date local copy of the ontology
+        """
+        meta = self._read_meta(url)
+
+        if meta is not None and time.time() - meta['checked_at'] < get_ontology_max_age_s():
+            return self._path(url, '.ttl')
+
+        headers = {}
+        if meta is not None and meta.get('etag') is not None:
+            headers['If-None-Match'] = meta['etag']
+
+        try:
+            response = requests.get(url, headers=headers, timeout=ontology_fetch_timeout_s)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except requests.RequestException as e:
+            if meta is None:
+                raise
+            logger.warning("unable to revalidate ontology %s, using the copy cached at %s: %s",
+                           url, time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(meta['fetched_at'])), repr(e))
+            return self._path(url, '.ttl')
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        if response.status_code == 304:
+            logger.info("cached ontology %s is up to date", url)
+            meta['checked_at'] = time.time()
+        else:
+            logger.info("fetched ontology %s, etag %s", url, response.headers.get('ETag'))
+            self._write(url, '.ttl', response.content, mode='wb')
+            meta = dict(
+                url=url,
+                etag=response.headers.get('ETag'),
+                content_hash=hashlib.sha256(response.content).hexdigest(),
+                fetched_at=time.time(),
+                checked_at=time.time(),
+            )
+
+        self._write(url, '.json', json.dumps(meta))
+        return self._path(url, '.ttl')
+
+    def snapshot(self, url) -> tuple[str, list[tuple[str, str]]]:
+        """
+        path of the N-Triples snapshot of the ontology, and its namespace bindings
+        """
+        with self._lock:
+            self.fetch(url)
+            meta = self._read_meta(url)
+
+            snapshot = meta.get('snapshot')
+            if snapshot is not None and snapshot['content_hash'] == meta['content_hash'] \
+                    and os.path.exists(self._path(url, '.nt')):
+                return self._path(url, '.nt'), [tuple(ns) for ns in snapshot['namespaces']]
+
+            t0 = time.time()
+            g = rdflib.Graph()
+            g.parse(self._path(url, '.ttl'), format='turtle')
+            self._write(url, '.nt', g.serialize(format='nt'))
+
+            namespaces = [(prefix, str(namespace)) for prefix, namespace in g.namespaces()]
+            meta['snapshot'] = dict(content_hash=meta['content_hash'], namespaces=namespaces)
+            self._write(url, '.json', json.dumps(meta))
+
+            logger.info("made snapshot of ontology %s, %s triples in %.2f s", url, len(g), time.time() - t0)
+            return self._path(url, '.nt'), namespaces
+
+
+ontology_cache = OntologyCache()
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import time
+import logging
+
+import rdflib
+from rdflib.graph import ReadOnlyGraphAggregate
+from rdflib.namespace import RDF, RDFS, OWL, XSD
+from rdflib.paths import Path
+
+logger = logging.getLogger(__name__)
+
+ODA = rdflib.Namespace("http://odahub.io/ontology#")
+
+# memberships of parameter hierarchies which are looked up for every parameter
+indexed_parameter_classes = [ODA.FileReference, ODA.POSIXPath, ODA.FileURL]
+
+
+def graph_edges(graph: rdflib.Graph) -> tuple[dict, dict, dict]:
+    """
+    direct superclasses, types, and datatypes of oda:value restrictions, of every node of the graph
+    """
+    direct_superclasses: dict = {}
+    for subclass, superclass in graph.subject_objects(RDFS.subClassOf):
+        direct_superclasses.setdefault(subclass, set()).add(superclass)
+
+    direct_types: dict = {}
+    for instance, cls in graph.subject_objects(RDF.type):
+        direct_types.setdefault(instance, set()).add(cls)
+
+    value_restrictions: dict = {}
+    for restriction in graph.subjects(OWL.onProperty, ODA.value):
+        for dt in graph.objects(restriction, OWL.allValuesFrom):
+            value_restrictions.setdefault(restriction, set()).add(dt)
+
+    return tuple({node: frozenset(targets) for node, targets in edges.items()}  # type: ignore
+                 for edges in (direct_superclasses, direct_types, value_restrictions))
+
+
+def merge_edges(base: dict, extra: dict) -> dict:
+    merged = dict(base)
+    for node, targets in extra.items():
+        merged[node] = merged.get(node, frozenset()) | targets
+    return merged
+
+
+def is_xsd(node) -> bool:
+    return isinstance(node, rdflib.URIRef) and str(node).startswith(str(XSD))
+
+
+class OntologyIndex:
+    """
+    answers to the ontology queries made for every notebook parameter, precomputed from one version of
+    the ontology graph: transitive superclasses, datatype restrictions, optional classes and
+    parameter hierarchies
+
+    The index is plain frozen data, never modified after it is built, and is read by concurrent requests
+    without locking. Answers are those of the SPARQL queries of oda_api Ontology.
+    """
+    def __init__(self, graph: rdflib.Graph):
+        t0 = time.time()
+
+        self._namespaces = {prefix: str(namespace) for prefix, namespace in graph.namespaces()}
+        self.direct_superclasses, self.direct_types, self.value_restrictions = graph_edges(graph)
+
+        nodes = set(self.direct_superclasses) | set(self.direct_types)
+        for targets in list(self.direct_superclasses.values()) + list(self.direct_types.values()):
+            nodes |= targets
+
+        # rdfs:subClassOf+
+        self.superclasses = {node: self._reachable(node, self.direct_superclasses) for node in nodes}
+        # (rdfs:subClassOf|a)*
+        self.ancestors = {node: self._reachable(node, self.direct_superclasses, self.direct_types) | {node}
+                          for node in nodes}
+
+        classes = [node for node in nodes if isinstance(node, rdflib.URIRef)]
+        self.datatypes = {node: self._compute_datatypes(node) for node in classes}
+        self.parameter_hierarchies = {node: self._compute_hierarchy(node, ODA.WorkflowParameter) for node in classes}
+
+        logger.info("indexed ontology, %s triples and %s classes in %.2f s", len(graph), len(nodes), time.time() - t0)
+
+    @staticmethod
+    def _reachable(node, *edges) -> frozenset:
+        reachable = set()
+        to_visit = [target for e in edges for target in e.get(node, ())]
+        while to_visit:
+            target = to_visit.pop()
+            if target not in reachable:
+                reachable.add(target)
+                to_visit.extend(t for e in edges for t in e.get(target, ()))
+        return frozenset(reachable)
+
+    def _compute_datatypes(self, node) -> frozenset:
+        superclasses = self.superclasses_of(node)
+        return frozenset(
+            {dt for superclass in superclasses for dt in self.value_restrictions.get(superclass, ()) if is_xsd(dt)} |
+            {superclass for superclass in superclasses if is_xsd(superclass)}
+        )
+
+    def _compute_hierarchy(self, node, base) -> tuple[str, ...]:
+        # classes of the node which are the base or below it, most specific first
+        def is_below_base(n):
+            return n == base or base in self.superclasses_of(n)
+
+        mids = [mid for mid in self.ancestors_of(node) if is_below_base(mid)]
+        depth = {mid: sum(1 for mid2 in self.superclasses_of(mid) | {mid} if is_below_base(mid2)) for mid in mids}
+
+        return tuple(str(mid) for mid in sorted(mids, key=lambda mid: (-depth[mid], str(mid))))
+
+    def superclasses_of(self, node) -> frozenset:
+        return self.superclasses.get(node, frozenset())
+
+    def ancestors_of(self, node) -> frozenset:
+        return self.ancestors.get(node, frozenset([node]))
+
+    def datatypes_of(self, node) -> frozenset:
+        return self.datatypes.get(node, frozenset())
+
+    def parameter_hierarchy_of(self, node) -> tuple[str, ...]:
+        return self.parameter_hierarchies.get(node, ())
+
+    def expand(self, uri: str) -> rdflib.URIRef:
+        if not uri.startswith("http"):
+            prefix, _, name = uri.partition(':')
+            if prefix in self._namespaces:
+                return rdflib.URIRef(self._namespaces[prefix] + name)
+        return rdflib.URIRef(uri)
+
+    def get_datatype_restriction(self, uri: str) -> rdflib.URIRef | None:
+        uri_ref = self.expand(uri)
+
+        datatypes = self.datatypes_of(uri_ref)
+        if is_xsd(uri_ref):
+            datatypes = datatypes | {uri_ref}
+
+        if len(datatypes) > 1:
+            raise RuntimeError("Ambiguous datatype of %s", uri)
+        return next(iter(datatypes), None)
+
+    def is_optional(self, uri: str) -> bool:
+        # rdfs:subClassOf?
+        uri_ref = self.expand(uri)
+        return uri_ref == ODA.optional or ODA.optional in self.direct_superclasses.get(uri_ref, ())
+
+    def get_parameter_hierarchy(self, uri: str) -> list[str]:
+        hierarchy = self.parameter_hierarchy_of(self.expand(uri))
+        if not hierarchy:
+            logger.warning("%s is not in ontology or not an %s", uri, ODA.WorkflowParameter)
+            return [uri]
+        return list(hierarchy)
+
+    def is_parameter_of_class(self, uri: str, cls: rdflib.URIRef) -> bool:
+        """
+        whether the class is in the parameter hierarchy of the uri, as get_parameter_hierarchy, without warnings
+        """
+        uri_ref = self.expand(uri)
+        return str(cls) in (self.parameter_hierarchy_of(uri_ref) or (str(uri_ref),))
+
+
+class OntologyOverlay(OntologyIndex):
+    """
+    the index of a base ontology with extra triples layered over it, such as the annotations of one notebook
+
+    Neither the base graph nor its index are modified. Answers are computed when first asked for, from the
+    edges of the base and of the extra triples, and kept for the lifetime of the overlay.
+    """
+    def __init__(self, base: OntologyIndex, graph: rdflib.Graph):
+        self.base = base
+        self._namespaces = {**base._namespaces,
+                            **{prefix: str(namespace) for prefix, namespace in graph.namespaces()}}
+
+        direct_superclasses, direct_types, value_restrictions = graph_edges(graph)
+        self.direct_superclasses = merge_edges(base.direct_superclasses, direct_superclasses)
+        self.direct_types = merge_edges(base.direct_types, direct_types)
+        self.value_restrictions = merge_edges(base.value_restrictions, value_restrictions)
+
+        # memoized answers, by query and node; concurrent first queries compute the same answer
+        self._answers: dict = {}
+
+    def _memoized(self, query, node, compute):
+        try:
+            return self._answers[query, node]
+        except KeyError:
+            return self._answers.setdefault((query, node), compute())
+
+    def superclasses_of(self, node) -> frozenset:
+        return self._memoized('superclasses', node, lambda: self._reachable(node, self.direct_superclasses))
+
+    def ancestors_of(self, node) -> frozenset:
+        return self._memoized('ancestors', node,
+                              lambda: self._reachable(node, self.direct_superclasses, self.direct_types) | {node})
+
+    def datatypes_of(self, node) -> frozenset:
+        return self._memoized('datatypes', node, lambda: self._compute_datatypes(node))
+
+    def parameter_hierarchy_of(self, node) -> tuple[str, ...]:
+        return self._memoized('parameter_hierarchy', node,
+                              lambda: self._compute_hierarchy(node, ODA.WorkflowParameter))
+
+
+class OverlayGraph(ReadOnlyGraphAggregate):
+    """
+    read-only view of a base graph with a small graph of extra triples over it, for SPARQL queries of one
+    annotated parameter; the base graph is shared, not copied, and not modified
+
+    Unlike ReadOnlyGraphAggregate, property paths are evaluated once over the whole view and triples present
+    in both graphs are seen once, so that queries do not return duplicate answers. Prefixes are those of
+    the base graph.
+    """
+    def __init__(self, base: rdflib.Graph, extra: rdflib.Graph):
+        super().__init__([base, extra])
+        self.base = base
+        self.extra = extra
+        self.namespace_manager = base.namespace_manager
+
+    def triples(self, triple):  # type: ignore[override]
+        s, p, o = triple
+        if isinstance(p, Path):
+            for s1, o1 in p.eval(self, s, o):
+                yield s1, p, o1
+            return
+
+        yield from self.base.triples(triple)
+        for extra_triple in self.extra.triples(triple):
+            if extra_triple not in self.base:
+                yield extra_triple
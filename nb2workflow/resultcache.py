@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+
+from diskcache import Cache
+from git import Repo, InvalidGitRepositoryError, NoSuchPathError
+
+logger = logging.getLogger(__name__)
+
+# results requested less often are not refreshed ahead of time
+refresh_ahead_min_hits = 2
+
+
+def get_result_cache_dir():
+    # no result cache unless set, or requested by the notebook
+    return os.getenv('NB2W_RESULT_CACHE')
+
+
+def get_default_result_cache_dir():
+    return os.path.join(os.getenv('HOME', '/tmp'), '.cache/nb2workflow/results')
+
+
+def get_result_cache_size_limit():
+    return int(float(os.getenv('NB2W_RESULT_CACHE_SIZE_MB', 1024)) * 1024 * 1024)
+
+
+@lru_cache(maxsize=256)
+def _find_repo(path) -> Repo | None:
+    # looked up once per notebook directory, the current commit is read on every request
+    try:
+        return Repo(path, search_parent_directories=True)
+    except (InvalidGitRepositoryError, NoSuchPathError):
+        return None
+
+
+def git_revision(path) -> str | None:
+    repo = _find_repo(path)
+    if repo is None:
+        return None
+    try:
+        return repo.head.commit.hexsha
+    except ValueError:
+        return None
+
+
+class ResultCache:
+    """
+    outputs of successful notebook executions, keyed by notebook content, repository revision,
+    complete parameter values and nb2workflow version
+
+    Kept in an LRU disk cache, which can be shared by workers and replicas mounting the same volume.
+    Notebooks opt out with system parameter result_cache = False.
+
+    Results are fresh for cache_timeout seconds (forever if 0). With stale_while_revalidate, they are
+    served for that many seconds longer as stale, while the service refreshes them. With refresh_ahead,
+    results requested at least refresh_ahead_min_hits times are refreshed that many seconds before they
+    become stale. Either system parameter enables the cache for the notebook, even without NB2W_RESULT_CACHE.
+    """
+    def __init__(self, directory=None, size_limit=None):
+        self._directory = directory
+        self._size_limit = size_limit
+        self._caches = {}
+        self._lock = threading.Lock()
+        self._hits = {}
+
+    @property
+    def directory(self):
+        return self._directory or get_result_cache_dir()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def enabled_for(self, nba):
+        return self.enabled or (self._system_parameter(nba, 'stale_while_revalidate', 0) > 0
+                                or self._system_parameter(nba, 'refresh_ahead', 0) > 0)
+
+    def _cache(self) -> Cache:
+        directory = self.directory or get_default_result_cache_dir()
+        with self._lock:
+            if directory not in self._caches:
+                self._caches[directory] = Cache(directory,
+                                                size_limit=self._size_limit or get_result_cache_size_limit(),
+                                                eviction_policy='least-recently-used')
+            return self._caches[directory]
+
+    @staticmethod
+    def _system_parameter(nba, name, default):
+        return nba.system_parameters.get(name, {}).get('default_value', default)
+
+    def key(self, nba, parameters, token=None) -> str | None:
+        """
+        None if results of the notebook are not cached; the token is passed to the notebook and
+        may change what it can access, results obtained with different tokens are not shared
+        """
+        parameter_values = {name: par['default_value'] for name, par in nba.input_parameters.items()}
+        parameter_values.update(parameters)
+
+        if not self.enabled_for(nba) or not self._system_parameter(nba, 'result_cache', True):
+            return None
+
+        from nb2workflow.nbadapter import nb2workflow_version
+
+        return hashlib.sha256(json.dumps([
+            nba.notebook_hash,
+            git_revision(os.path.dirname(os.path.realpath(nba.notebook_fn))),
+            parameter_values,
+            nb2workflow_version(),
+            None if token is None else hashlib.sha256(token.encode()).hexdigest(),
+        ], sort_keys=True, default=repr).encode()).hexdigest()
+
+    def get(self, key) -> tuple[dict | None, str]:
+        """
+        returns the output and its state: miss, fresh, refresh (fresh, but should be refreshed ahead), or stale
+        """
+        if key is None:
+            return None, 'miss'
+
+        entry = self._cache().get(key)
+        if entry is None:
+            return None, 'miss'
+
+        now = time.time()
+        with self._lock:
+            hits = self._hits[key] = self._hits.get(key, 0) + 1
+
+        if entry['fresh_until'] is None or now < entry['fresh_until'] - entry['refresh_ahead']:
+            state = 'fresh'
+        elif now < entry['fresh_until']:
+            state = 'refresh' if hits >= refresh_ahead_min_hits else 'fresh'
+        elif now < entry['stale_until']:
+            state = 'stale'
+        else:
+            return None, 'miss'
+
+        logger.info("result restored from cache: %s, %s", key, state)
+        return entry['output'], state
+
+    def put(self, key, nba, output):
+        if key is None:
+            return
+
+        cache_timeout = self._system_parameter(nba, 'cache_timeout', 0)
+        stale_while_revalidate = self._system_parameter(nba, 'stale_while_revalidate', 0)
+
+        now = time.time()
+        entry = dict(
+            output=output,
+            stored_at=now,
+            fresh_until=now + cache_timeout if cache_timeout > 0 else None,
+            stale_until=now + cache_timeout + stale_while_revalidate if cache_timeout > 0 else None,
+            refresh_ahead=self._system_parameter(nba, 'refresh_ahead', 0),
+        )
+
+        with self._lock:
+            self._hits.pop(key, None)
+
+        try:
+            self._cache().set(key, entry, expire=cache_timeout + stale_while_revalidate if cache_timeout > 0 else None)
+        except Exception as e:
+            logger.warning("unable to store result in cache: %s", repr(e))
+
+
+result_cache = ResultCache()
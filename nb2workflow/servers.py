@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+servers = ['flask', 'waitress', 'gunicorn']
+
+# each gunicorn worker process serves requests in this many threads
+gunicorn_threads_per_worker = 4
+
+
+def serve(app, server='flask', host='127.0.0.1', port=9191, workers=1, on_worker_start=lambda: None):
+    """
+    serves the app with the development server of flask, or with a production server from the
+    service extra: waitress, with workers threads in this process, or gunicorn, with workers processes
+
+    on_worker_start() is called in every process serving requests, before it does: in forked
+    gunicorn workers, or here for the other servers.
+    """
+    if server == 'flask':
+        if workers > 1:
+            logger.warning("flask development server does not use --workers, consider --server gunicorn")
+        on_worker_start()
+        app.run(host=host, port=port)
+
+    elif server == 'waitress':
+        try:
+            import waitress
+        except ImportError:
+            raise RuntimeError("waitress is not installed, install nb2workflow[service]")
+
+        on_worker_start()
+        waitress.serve(app, host=host, port=port, threads=workers)
+
+    elif server == 'gunicorn':
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            raise RuntimeError("gunicorn is not installed, install nb2workflow[service]")
+
+        class Application(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{host}:{port}')
+                self.cfg.set('workers', workers)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('threads', gunicorn_threads_per_worker)
+                # sync requests last as long as the notebook execution
+                self.cfg.set('timeout', 0)
+                self.cfg.set('post_fork', lambda server, worker: on_worker_start())
+
+            def load(self):
+                return app
+
+        Application().run()
+
+    else:
+        raise ValueError(f"unknown server {server}, can be one of {servers}")
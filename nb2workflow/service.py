@@ -15,7 +15,6 @@ import base64
 import hashlib
 import datetime
 import tempfile
-import nbformat
 import yaml
 import traceback
 from dataclasses import dataclass, field
@@ -25,7 +24,18 @@ from werkzeug.exceptions import MethodNotAllowed, NotFound
 
 import queue
 from nb2workflow import ontology, publish, schedule
-from nb2workflow.nbadapter import NotebookAdapter, find_notebooks, PapermillWorkflowIncomplete
+from nb2workflow.nbadapter import (NotebookAdapter, find_notebooks, PapermillWorkflowIncomplete,
+                                   read_signature_file, notebook_directory)
+from nb2workflow.kernelpool import KernelPool
+from nb2workflow.jobdir import jobdir_modes
+from nb2workflow.events import events_file, read_events
+from nb2workflow.admission import admission, AdmissionRejected, resource_status
+from nb2workflow.jobstore import JobStore, MemoryJobStore, open_job_store, in_progress_statuses
+from nb2workflow.jobqueue import FairShareQueue, open_job_queue
+from nb2workflow.workerpool import WorkerPool, autoscale_interval_s
+from nb2workflow.singleflight import SingleFlight
+from nb2workflow.resultcache import result_cache
+from nb2workflow.servers import serve, servers
 
 from io import BytesIO
 from bs4 import BeautifulSoup
@@ -39,8 +49,12 @@ from flasgger import LazyString, Swagger, swag_from
 
 from nb2workflow.helpers import serialize_workflow_exception
 from nb2workflow.json import CustomJSONEncoder
+from nb2workflow.logging_setup import setup_logging
 
 import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 verify_tls = False
 
@@ -48,7 +62,20 @@ verify_tls = False
 logger = logging.getLogger('nb2workflow.service')
 
 
-async_queue = queue.Queue()
+# replaced by a queue shared by the worker processes of a multi-worker server
+async_queue = FairShareQueue()
+
+# identical sync requests running at the same time share one execution
+sync_flights = SingleFlight()
+
+# background refresh of cached results waits for requests
+refresh_priority = -1
+
+# on responses restored from result cache, these are not cached by flask
+result_cache_header = 'X-NB2W-Result-Cache'
+
+# at most this many jobs are listed by one /async/list request
+max_async_list_limit = 1000
 
 
 class CustomJSONProvider(DefaultJSONProvider):
@@ -80,54 +107,70 @@ blprint = Blueprint('nb2w', __name__)
 
 @dataclass
 class WfStateGlobalVarStorage:
-    async_workflows: dict[str, dict | str] = field(default_factory=dict)
-    async_workflow_jobdirs: dict[str, str] = field(default_factory=dict)
+    async_workflows: JobStore = field(default_factory=MemoryJobStore)
+    # job directories by job key, their paths are not job statuses
+    async_workflow_jobdirs: JobStore = field(default_factory=lambda: MemoryJobStore(value_status='stored'))
     service_semantic_signature: str = ''
     notebook_adapters: dict[str, NotebookAdapter] = field(default_factory=dict)
+    # as written by nbinspect --write-signature, by target
+    openapi_specs: dict[str, dict] = field(default_factory=dict)
 
     _lock: threading.RLock = field(default_factory=threading.RLock)
 
     def reset(self):
-        self.async_workflows = {}
-        self.async_workflow_jobdirs = {}
+        self.async_reset()
         self.service_semantic_signature = ''
         self.notebook_adapters = {}
+        self.openapi_specs = {}
 
     def async_reset(self):
         with self._lock:
-            self.async_workflows = {}
-            self.async_workflow_jobdirs = {}
+            self.async_workflows.clear()
+            self.async_workflow_jobdirs.clear()
+
+    def open_job_stores(self, url=None, recover=True):
+        with self._lock:
+            self.async_workflows = open_job_store(url, table='jobs', recover=recover)
+            self.async_workflow_jobdirs = open_job_store(url, table='jobdirs', recover=recover,
+                                                         value_status='stored')
 
 
 wfstore = WfStateGlobalVarStorage()
 
 
 
-def setup_routes(app: Flask):
-    for target, nba in wfstore.notebook_adapters.items():
-        target_specs = {
-            "parameters": [
-                {
-                    "name": p_name,
-                    "in": "query",
-                    "schema": {
-                        "type": to_oapi_type(p_data['python_type']),
-                        "nullable": p_data.get('is_optional', False)
-                        # strictly speaking, there is no way to set query parameter to null
-                        # we define a convention in which '%00' string represents null
-                        },
-                    "required": False,
-                    "default": p_data['default_value'],
-                    "description": p_data['comment']+" "+p_data['owl_type'],
-                }
-                for p_name, p_data in nba.extract_parameters().items()
-            ],
-            "responses": {
-                "200": {
-                    "description": repr(nba.extract_output_declarations()),
-                }
+def workflow_specs(nba: NotebookAdapter) -> dict:
+    """
+    OpenAPI specification of the workflow endpoint
+    """
+    return {
+        "parameters": [
+            {
+                "name": p_name,
+                "in": "query",
+                "schema": {
+                    "type": to_oapi_type(p_data['python_type']),
+                    "nullable": p_data.get('is_optional', False)
+                    # strictly speaking, there is no way to set query parameter to null
+                    # we define a convention in which '%00' string represents null
+                    },
+                "required": False,
+                "default": p_data['default_value'],
+                "description": p_data['comment']+" "+p_data['owl_type'],
+            }
+            for p_name, p_data in nba.extract_parameters().items()
+        ],
+        "responses": {
+            "200": {
+                "description": repr(nba.extract_output_declarations()),
             }
         }
+    }
+
+
+def setup_routes(app: Flask):
+    for target, nba in wfstore.notebook_adapters.items():
+        target_specs = wfstore.openapi_specs.get(target) or workflow_specs(nba)
 
         endpoint = 'endpoint_'+target
 
@@ -139,7 +182,10 @@ def setup_routes(app: Flask):
         logger.debug("target: %s with endpoint %s", target, endpoint)
 
         def response_filter(rv):
-            if isinstance(rv, tuple) and isinstance(rv[0], Response) and rv[1] != 200:
+            if result_cache_header in getattr(rv[0] if isinstance(rv, tuple) else rv, 'headers', {}):
+                logger.info("NOT caching response restored from result cache")
+                return False
+            elif isinstance(rv, tuple) and isinstance(rv[0], Response) and rv[1] != 200:
                 logger.info("NOT caching response %s", rv[1])
                 return False
             elif isinstance(rv, Response) and rv.status != 200:
@@ -180,6 +226,21 @@ def setup_routes(app: Flask):
             schedule.schedule_callable(schedulable, schedule_interval)
 
 
+def setup_kernel_pools(default_size=0):
+    for target, nba in wfstore.notebook_adapters.items():
+        pool_size = nba.get_system_parameter_value('kernel_pool_size', default_size)
+        if pool_size > 0:
+            nba.kernel_pool = KernelPool(nba.kernel_name, size=pool_size)
+            nba.kernel_pool.start()
+
+
+def setup_async_queue():
+    for target, nba in wfstore.notebook_adapters.items():
+        async_queue.configure_target(target,
+                                     weight=nba.get_system_parameter_value('queue_weight', 1),
+                                     max_concurrency=nba.get_system_parameter_value('max_concurrency', 0))
+
+
 def create_app():
     app = Flask(__name__)
 
@@ -220,29 +281,145 @@ def create_app():
 
 
 class AsyncWorker(threading.Thread):
-    def __init__(self, worker_id):
+    def __init__(self, worker_id, pool=None):
         self.worker_id = worker_id
+        self.pool = pool
         super(AsyncWorker, self).__init__()
 
     def run(self):
-        while True:
-            self.run_one()
-            time.sleep(5)
+        if self.pool is None:
+            while True:
+                self.run_one()
+
+        # idle workers check if the pool shrinks
+        while not self.pool.should_stop(self.worker_id):
+            self.run_one(timeout=autoscale_interval_s)
+
+    def run_one(self, timeout=None):
+        try:
+            async_workflow = async_queue.get(block=True, timeout=timeout)
+        except queue.Empty:
+            return
 
-    def run_one(self):
         logger.info("worker_id %s", self.worker_id)
-        async_workflow = async_queue.get(block=True)
-        async_workflow.run()
+        try:
+            if self.pool is None:
+                async_workflow.run()
+            else:
+                with self.pool.working(self.worker_id):
+                    async_workflow.run()
+        finally:
+            async_queue.task_done(async_workflow)
+
+
+worker_pool = None
+
+def execute_job(notebook_fn, adapter_kwargs, parameters, context=None, tmpdir_key=None, tmpdir=None, refresh=False):
+    """
+    executes notebook for an async workflow, in a worker thread or in a worker process
+    returns the result as stored in wfstore.async_workflows
+    """
+    nba = NotebookAdapter(notebook_fn, **adapter_kwargs)
+
+    result_key = result_cache.key(nba, parameters, token=(context or {}).get('token'))
+    if not refresh:
+        output, state = result_cache.get(result_key)
+        if state in ['fresh', 'refresh']:
+            return dict(output=output, exceptions=[], jobdir=None)
+
+    exceptions = nba.execute(parameters, context=context, tmpdir_key=tmpdir_key, tmpdir=tmpdir)
+
+    logger.info("exceptions: %s", repr(exceptions))
+
+    if len(exceptions) > 0:
+        output = 'incomplete'
+        logger.error("exceptions: %s", repr(exceptions))
+    else:
+        output = nba.extract_output()
+        logger.info("completed, output length %s", len(output))
+        result_cache.put(result_key, nba, output)
+
+    return dict(output=output, exceptions=list(
+        map(serialize_workflow_exception, exceptions)), jobdir=nba.tmpdir)
+
+
+class ProcessBackend:
+    """
+    runs async jobs in a pool of worker processes, so that notebook orchestration does not share
+    the interpreter with the HTTP front end
+    """
+    def __init__(self, max_workers, debug=False):
+        self.max_workers = max_workers
+        self.debug = debug
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                logger.info("starting pool of %s worker processes", self.max_workers)
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=setup_logging,
+                                                     initargs=(self.debug,))
+            return self._executor
+
+    def run(self, fn, *args, **kwargs):
+        executor = self._get_executor()
+        try:
+            return executor.submit(fn, *args, **kwargs).result()
+        except BrokenProcessPool:
+            logger.error("worker process died, restarting the pool")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            raise
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+process_backend = None
+
+# incomplete workflows are retried with exponential backoff, or earlier when the job they wait for is done
+incomplete_retry_delay_s = 10
+incomplete_retry_max_delay_s = 600
+
 
 class AsyncWorkflow:
-    def __init__(self, key, target, params, context={}):
+    def __init__(self, key, target, params, context={}, priority=0, refresh=False):
         self.key = key
         self.target = target
         self.params = params
         self.context = context
+        self.priority = priority
+        # re-execute even if the result is cached
+        self.refresh = refresh
+        self.n_incomplete = 0
 
         logger.info("%s initializing callback %s", self, self.callback)
 
+    def to_record(self) -> dict:
+        return dict(key=self.key,
+                    target=self.target,
+                    params=self.params,
+                    context=self.context,
+                    priority=self.priority,
+                    refresh=self.refresh,
+                    n_incomplete=self.n_incomplete)
+
+    @classmethod
+    def from_record(cls, record) -> AsyncWorkflow:
+        record = dict(record)
+        n_incomplete = record.pop('n_incomplete', 0)
+        async_workflow = cls(**record)
+        async_workflow.n_incomplete = n_incomplete
+        return async_workflow
+
     @property
     def callback(self):
         return self.context.get('callback', None)
@@ -258,6 +435,7 @@ class AsyncWorkflow:
                     output={}, 
                     exceptions=[serialize_workflow_exception(e)]
                 )
+            notify_done(self.key)
 
     def note(self, *args, **kwargs):
         if not hasattr(self, 'notes'):
@@ -268,23 +446,12 @@ class AsyncWorkflow:
             data=(args, kwargs),
         ))
 
-    blocked_until = 0
-
     def _run(self):
-        if self.blocked_until > time.time():
-            logger.info("workflow still blocked, waiting %i",
-                        self.blocked_until - time.time())
-            async_queue.put(self)
-            with wfstore._lock:
-                wfstore.async_workflows[self.key] = 'submitted'
-            return
-
         with wfstore._lock:
             template_nba = wfstore.notebook_adapters.get(self.target)
-            nba = NotebookAdapter(template_nba.notebook_fn, tempdir_cache=wfstore.async_workflow_jobdirs,
-                                n_download_max_tries=template_nba.n_download_max_tries,
-                                download_retry_sleep_s=template_nba.download_retry_sleep_s,
-                                max_download_size=template_nba.max_download_size)
+            adapter_kwargs = dict(n_download_max_tries=template_nba.n_download_max_tries,
+                                  download_retry_sleep_s=template_nba.download_retry_sleep_s,
+                                  max_download_size=template_nba.max_download_size)
             
             wfstore.async_workflows[self.key] = 'started'
         self.perform_callback(action='progress')
@@ -293,51 +460,55 @@ class AsyncWorkflow:
             thread_id = threading.get_ident()
             process_id = os.getpid()
             logger.info(f'nba.execute thread id: {thread_id} ; process id: {process_id}')
-            exceptions = nba.execute(self.params['request_parameters'], context=self.context, tmpdir_key=self.key)
+
+            with admission.running():
+                if process_backend is None:
+                    result = execute_job(template_nba.notebook_fn,
+                                         dict(adapter_kwargs,
+                                              tempdir_cache=wfstore.async_workflow_jobdirs,
+                                              kernel_pool=template_nba.kernel_pool),
+                                         self.params['request_parameters'],
+                                         context=self.context,
+                                         tmpdir_key=self.key,
+                                         refresh=self.refresh)
+                else:
+                    tmpdir = tempfile.mkdtemp(prefix="nb2w-")
+                    with wfstore._lock:
+                        wfstore.async_workflow_jobdirs[self.key] = tmpdir
+
+                    result = process_backend.run(execute_job,
+                                                 template_nba.notebook_fn,
+                                                 adapter_kwargs,
+                                                 self.params['request_parameters'],
+                                                 context=self.context,
+                                                 tmpdir=tmpdir,
+                                                 refresh=self.refresh)
         except PapermillWorkflowIncomplete as e:
             logger.info("found incomplete workflow: %s, rescheduling", repr(e))
 
-            self.note("rescheduled")
-
-            self.blocked_until = time.time() + 10
+            self.note("rescheduled", waiting_for=e.waiting_for)
 
-            async_queue.put(self)
             with wfstore._lock:
                 wfstore.async_workflows[self.key] = 'submitted'
-            return
 
-        logger.info("exceptions: %s", repr(exceptions))
+            self.n_incomplete += 1
+            async_queue.put(self,
+                            delay_s=min(incomplete_retry_delay_s * 2 ** (self.n_incomplete - 1),
+                                        incomplete_retry_max_delay_s),
+                            waiting_for=e.waiting_for)
 
-        if len(exceptions) > 0:
-            output = 'incomplete'
-            logger.error("exceptions: %s", repr(exceptions))
-        else:
-            nretry = 10
-            while nretry > 0:
-                try:
-                    output = nba.extract_output()
-                    logger.info("completed, output length %s", len(output))
-                    if len(output) == 0:
-                        logger.debug(
-                            "output from notebook is empty, something failed, attempts left: %s", nretry)
-                    else:
-                        break
-                except nbformat.reader.NotJSONError as e:
-                    logger.debug(
-                        "output notebook incomplete %s attempts left: %s", e, nretry)
-                except Exception as e:
-                    logger.debug(
-                        "output notebook incomplte or does not exist %s attempts left: %s", e, nretry)
+            # the upstream job may have been done before the registration
+            if e.waiting_for is not None and wfstore.async_workflows.status(e.waiting_for) == 'done':
+                notify_done(e.waiting_for)
+            return
 
-                nretry -= 1
-                time.sleep(1)
-
-        logger.debug("output: %s", output)
+        logger.debug("output: %s", result['output'])
 
         logger.info("updating key %s", self.key)
         with wfstore._lock:
-            wfstore.async_workflows[self.key] = dict(output=output, exceptions=list(
-                map(serialize_workflow_exception, exceptions)), jobdir=nba.tmpdir)
+            wfstore.async_workflows[self.key] = result
+
+        notify_done(self.key)
 
         self.perform_callback()
 
@@ -365,6 +536,48 @@ class AsyncWorkflow:
             raise NotImplementedError
 
 
+def notify_done(key) -> int:
+    """
+    wakes up async workflows waiting for the job, returns the number of them
+    """
+    return async_queue.wake_waiting_for(key)
+
+
+def schedule_refresh(target, interpreted_parameters, result_key, token=None):
+    """
+    re-executes the workflow in the background to update a cached result, once at a time
+    """
+    key = 'refresh-' + result_key
+
+    with wfstore._lock:
+        if wfstore.async_workflows.status(key) in in_progress_statuses:
+            return
+
+        logger.info("refreshing cached result %s of %s", result_key, target)
+        wfstore.async_workflows[key] = 'submitted'
+
+    async_queue.put(AsyncWorkflow(key=key,
+                                  target=target,
+                                  params=interpreted_parameters,
+                                  context=dict(token=token),
+                                  priority=refresh_priority,
+                                  refresh=True))
+
+
+def restore_cached(target, nba, interpreted_parameters, token=None):
+    """
+    returns the cached output, if any, and its state; stale results and results about to
+    become stale are refreshed in the background
+    """
+    result_key = result_cache.key(nba, interpreted_parameters['request_parameters'], token=token)
+    output, state = result_cache.get(result_key)
+
+    if state in ['refresh', 'stale']:
+        schedule_refresh(target, interpreted_parameters, result_key, token=token)
+
+    return result_key, output, state
+
+
 def workflow(target, background=False, async_request=False):
     issues = []
 
@@ -373,6 +586,12 @@ def workflow(target, background=False, async_request=False):
     token = request.args.get("_token", None)
     context = dict(callback=async_request_callback, token=token)
 
+    try:
+        priority = int(request.args.get('_priority', 0))
+    except ValueError:
+        priority = 0
+        issues.append("_priority should be an integer, got %s" % request.args.get('_priority'))
+
     logger.debug("target %s", target)
 
     if not background:
@@ -384,7 +603,8 @@ def workflow(target, background=False, async_request=False):
         nba = NotebookAdapter(template_nba.notebook_fn,
                             n_download_max_tries=template_nba.n_download_max_tries,
                             download_retry_sleep_s=template_nba.download_retry_sleep_s,
-                            max_download_size=template_nba.max_download_size)
+                            max_download_size=template_nba.max_download_size,
+                            kernel_pool=template_nba.kernel_pool)
 
         if nba is None:
             interpreted_parameters = None
@@ -417,28 +637,53 @@ def workflow(target, background=False, async_request=False):
             print('cache key/value', key, value)
 
             if value is None:
+                _, output, state = restore_cached(target, nba, interpreted_parameters, token=token)
+                if output is not None:
+                    value = wfstore.async_workflows[key] = dict(output=output, exceptions=[], jobdir=None)
+                    notify_done(key)
+                    r = make_response(jsonify(workflow_status="done",
+                                              data=value,
+                                              comment="restored from result cache"),
+                                      200)
+                    r.headers[result_cache_header] = state
+                    return r
+
+                try:
+                    admitted = admission.admit(qsize=async_queue.n_ready(), queued=True)
+                except AdmissionRejected as e:
+                    return rejected_response(e)
+
                 async_task = AsyncWorkflow(key=key,
                                         target=target,
                                         params=interpreted_parameters,
-                                        context=context
+                                        context=context,
+                                        priority=priority
                                         )
                 
-                wfstore.async_workflows[key] = 'submitted'
-                async_queue.put(async_task)
+                # replicas sharing the job store submit the job once
+                with admitted:
+                    if wfstore.async_workflows.add(key, 'submitted'):
+                        async_queue.put(async_task)
 
                 return make_response(jsonify(workflow_status="submitted",
-                                            comment="task created"),
+                                            comment="task created",
+                                            job_key=key,
+                                            events_url=url_for('nb2w.job_events', key=key)),
                                     201)
 
             elif value == 'submitted':
                 return make_response(jsonify(workflow_status=value,
-                                            comment=f"task is {value}"),
+                                            comment=f"task is {value}",
+                                            job_key=key,
+                                            events_url=url_for('nb2w.job_events', key=key)),
                                     201)
 
             elif value == 'started':
                 return make_response(jsonify(workflow_status=value,
                                             comment=f"task is {value}",
-                                            jobdir=wfstore.async_workflow_jobdirs.get(key)),
+                                            jobdir=wfstore.async_workflow_jobdirs.get(key),
+                                            job_key=key,
+                                            events_url=url_for('nb2w.job_events', key=key)),
                                     201)
 
             else:
@@ -450,26 +695,37 @@ def workflow(target, background=False, async_request=False):
     if len(issues) > 0:
         return make_response(jsonify(issues=issues), 400)
     else:
-        exceptions = nba.execute(interpreted_parameters['request_parameters'], context=context)
+        # the token is passed to the notebook, requests with different tokens are not shared
+        flight_key = hashlib.sha224(json.dumps(
+            dict(target=target, params=interpreted_parameters, token=token)).encode('utf-8')).hexdigest()
 
-        if not os.path.exists(nba.output_notebook_fn):
-            output = {}
-        else:
-            nretry = 10
-            while nretry > 0:
-                try:
-                    output = nba.extract_output()
-                    if len(output) == 0:
-                        logger.debug(
-                            "output from notebook is empty, something failed, attempts left: %s", nretry)
-                    else:
-                        break
-                except nbformat.reader.NotJSONError as e:
-                    logger.debug(
-                        "output notebook incomplte %s attempts left: %s", e, nretry)
+        result_key, output, state = restore_cached(target, nba, interpreted_parameters, token=token)
+        if output is not None:
+            r = jsonify(dict(output=output, exceptions=[], jobdir=None))
+            r.headers[result_cache_header] = state
+            return r, 200
+
+        def execute_sync():
+            exceptions = nba.execute(interpreted_parameters['request_parameters'], context=context)
+
+            if not os.path.exists(nba.output_notebook_fn):
+                output = {}
+            else:
+                output = nba.extract_output()
+
+            if len(exceptions) == 0:
+                result_cache.put(result_key, nba, output)
 
-                nretry -= 1
-                time.sleep(1)
+            return dict(output=output, exceptions=exceptions, jobdir=nba.tmpdir)
+
+        try:
+            # only the request which executes is admitted, requests joining it wait for its result
+            result, _ = sync_flights.do(
+                flight_key, execute_sync,
+                on_leader=lambda: admission.admit(qsize=async_queue.n_ready(), queued=False))
+        except AdmissionRejected as e:
+            return rejected_response(e)
+        output, exceptions = result['output'], result['exceptions']
 
         logger.debug("output: %s", output)
         logger.debug("exceptions: %s", exceptions)
@@ -477,7 +733,7 @@ def workflow(target, background=False, async_request=False):
         r = jsonify(dict(
                     output=output,
                     exceptions=[repr(e) for e in exceptions],
-                    jobdir=nba.tmpdir,
+                    jobdir=result['jobdir'],
                     ))
 
         return_code = 200
@@ -487,6 +743,17 @@ def workflow(target, background=False, async_request=False):
         return r, return_code
 
 
+def rejected_response(e: AdmissionRejected):
+    logger.warning("rejecting request: %s, retry after %s s", e.reason, e.retry_after_s)
+
+    r = make_response(jsonify(workflow_status="rejected",
+                              issues=[e.reason],
+                              retry_after_s=e.retry_after_s),
+                      e.status_code)
+    r.headers['Retry-After'] = str(e.retry_after_s)
+    return r
+
+
 def to_oapi_type(in_type):
     if issubclass(in_type, bool):
         out_type = 'boolean'
@@ -610,6 +877,94 @@ def workflow_filename(mode, target, filename):
         ))
 
 
+events_poll_interval_s = 0.5
+events_heartbeat_interval_s = 15
+
+
+def format_sse(data, event=None, event_id=None):
+    message = ""
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    if event is not None:
+        message += f"event: {event}\n"
+    return message + f"data: {json.dumps(data, cls=CustomJSONEncoder)}\n\n"
+
+
+def generate_job_events(key, last_event_id=None):
+    # event ids are <job directory name>:<line>, job directory changes when the job is rescheduled
+    resume_jobdir, resume_line = None, -1
+    if last_event_id:
+        try:
+            resume_jobdir, resume_line = last_event_id.rsplit(':', 1)
+            resume_line = int(resume_line)
+        except ValueError:
+            logger.warning("unable to interpret last event id %s", last_event_id)
+            resume_jobdir, resume_line = None, -1
+
+    jobdir, offset, line = None, 0, -1
+    status = None
+    last_sent = time.time()
+
+    yield f"retry: {int(events_poll_interval_s * 4000)}\n\n"
+
+    while True:
+        # status is read first: when it is done, all events are already written
+        with wfstore._lock:
+            value = wfstore.async_workflows.get(key)
+            current_jobdir = wfstore.async_workflow_jobdirs.get(key)
+
+        if value is None:
+            yield format_sse(dict(workflow_status="unknown"), event="status")
+            return
+
+        if current_jobdir != jobdir:
+            jobdir, offset, line = current_jobdir, 0, -1
+
+        if jobdir is not None:
+            events, offset = read_events(os.path.join(jobdir, events_file), offset)
+            for event in events:
+                line += 1
+                if os.path.basename(jobdir) == resume_jobdir and line <= resume_line:
+                    continue
+                yield format_sse(event, event=event['event'], event_id=f"{os.path.basename(jobdir)}:{line}")
+                last_sent = time.time()
+
+        workflow_status = value if isinstance(value, str) else "done"
+        if workflow_status != status:
+            status = workflow_status
+            data = dict(workflow_status=status)
+            if status == "done":
+                data['n_exceptions'] = len(value.get('exceptions', []))
+            yield format_sse(data, event="status")
+            last_sent = time.time()
+
+            if status == "done":
+                return
+
+        if time.time() - last_sent > events_heartbeat_interval_s:
+            yield ": heartbeat\n\n"
+            last_sent = time.time()
+
+        time.sleep(events_poll_interval_s)
+
+
+@blprint.route('/api/v1.0/jobs/<string:key>/events', methods=['GET'])
+def job_events(key):
+    """
+    streams progress of an async job as server-sent events: status changes, cell start and end, stream output;
+    the stream ends when the job is done
+    """
+    with wfstore._lock:
+        if key not in wfstore.async_workflows:
+            return make_response(jsonify(issues=[f"job {key} is not known"]), 404)
+
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+
+    return Response(generate_job_events(key, last_event_id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @blprint.route('/api/v1.0/rdf', methods=['GET'])
 def workflow_rdf():
     with wfstore._lock:
@@ -630,11 +985,7 @@ def current_health():
     issues = []
     status = {}
 
-    statvfs = os.statvfs(".")
-    status['fs_space'] = dict(
-        size_mb=statvfs.f_frsize * statvfs.f_blocks / 1024 / 1024,
-        avail_mb=statvfs.f_frsize * statvfs.f_bavail / 1024 / 1024,
-    )
+    status.update(resource_status())
 
     if status['fs_space']['avail_mb'] < 300:
         issues.append("not enough free space: %.5lg Mb left" %
@@ -671,7 +1022,15 @@ def current_health():
 
     with wfstore._lock:
         status['async'] = dict(qsize=async_queue.qsize(),
-                               async_workflows_n=len(wfstore.async_workflows))
+                               n_ready=async_queue.n_ready(),
+                               async_workflows_n=len(wfstore.async_workflows),
+                               targets=async_queue.status(),
+                               waiting_for=async_queue.waiting_for())
+
+    status['admission'] = dict(limits=admission.limits,
+                               n_processes=admission.n_processes,
+                               n_running=admission.n_running,
+                               mean_duration_s=admission.mean_duration_s)
 
     #status['processes'] = processes
 
@@ -750,28 +1109,63 @@ def status():
             version=os.environ.get('WORKFLOW_VERSION', 'unknown'),
             started_at=current_app.config['STARTED_AT'].strftime("%s"),
             started_since=(datetime.datetime.now()-current_app.config['STARTED_AT']).seconds,
-            background_jobs=len([w for w in wfstore.async_workflows if w]),
-            stored_jobs=len(wfstore.async_workflows),
+            background_jobs=wfstore.async_workflows.count(in_progress_statuses),
+            stored_jobs=wfstore.async_workflows.count(),
+            workers=worker_pool.status() if worker_pool is not None else None,
         )
 
 @blprint.route('/async/clear')
 def async_clear():
     with wfstore._lock:
-        s = wfstore.async_workflows
+        s = {key: status for key, status, _ in wfstore.async_workflows.page(0, len(wfstore.async_workflows))}
         wfstore.async_reset()
         return jsonify(s)
 
 
 @blprint.route('/async/size')
 def async_size():
-    with wfstore._lock:
-        return jsonify({'async_size': len(wfstore.async_workflows)})
+    return jsonify({'async_size': wfstore.async_workflows.count()})
 
 
 @blprint.route('/async/list')
 def async_list():
-    with wfstore._lock:
-        return jsonify(wfstore.async_workflows)
+    """
+    jobs, most recently updated first; results of done jobs are included with include_output=yes
+    """
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return make_response(jsonify(issues=["offset and limit should be integers"]), 400)
+
+    if offset < 0 or limit < 0:
+        return make_response(jsonify(issues=["offset and limit should not be negative"]), 400)
+
+    limit = min(limit, max_async_list_limit)
+    include_output = request.args.get('include_output', 'no') == 'yes'
+
+    jobs = {}
+    for key, status, updated in wfstore.async_workflows.page(offset, limit):
+        if include_output and status not in in_progress_statuses:
+            jobs[key] = wfstore.async_workflows.get(key, status)
+        else:
+            jobs[key] = status
+
+    return jsonify(dict(jobs=jobs,
+                        offset=offset,
+                        limit=limit,
+                        total=wfstore.async_workflows.count()))
+
+
+@blprint.route('/async/notify/<key>')
+def async_notify(key):
+    """
+    called when a job is done in a peer service, for example as its callback, to wake up workflows waiting for it
+    """
+    if request.args.get('action', 'done') != 'done':
+        return jsonify(dict(woken=0))
+
+    return jsonify(dict(woken=notify_done(key)))
 
 
 @blprint.route('/async/qsize')
@@ -878,7 +1272,51 @@ def main():
     parser.add_argument('--host', metavar='host',
                         type=str, default="127.0.0.1")
     parser.add_argument('--port', metavar='port', type=int, default=9191)
-    parser.add_argument('--async-workers', metavar='N', type=int, default=3)
+    parser.add_argument('--server', choices=servers, default='flask',
+                        help='flask development server, or a production server: waitress with --workers threads, '
+                             'or gunicorn with --workers processes sharing the state in --state-dir')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='number of server threads or processes')
+    parser.add_argument('--state-dir', metavar='directory', type=str, default=os.getenv('NB2W_STATE_DIR'),
+                        help='keep job store, async queue and result cache in this directory, unless set otherwise; '
+                             'replicas on a shared volume use the same one; default is NB2W_STATE_DIR, '
+                             'or with gunicorn a new temporary directory')
+    parser.add_argument('--async-workers', metavar='N', type=int, default=3,
+                        help='number of async workers in each server process, '
+                             'the minimum if --max-async-workers is larger')
+    parser.add_argument('--max-async-workers', metavar='N', type=int, default=None,
+                        help='grow the pool of async workers up to N with queued jobs, '
+                             'as long as load average and available memory allow')
+    parser.add_argument('--worker-backend', choices=['thread', 'process'], default='thread',
+                        help='execute async workflows in worker threads of the service process, '
+                             'or in a pool of --async-workers processes')
+    parser.add_argument('--kernel-pool-size', metavar='N', type=int, default=0,
+                        help='number of idle pre-started kernels to keep for each workflow, '
+                             'can be overridden with kernel_pool_size system parameter')
+    parser.add_argument('--jobdir-mode', choices=jobdir_modes, default=None,
+                        help='how job directories are populated from the notebook repository, '
+                             'default is NB2W_JOBDIR_MODE or clone')
+    parser.add_argument('--max-queued-jobs', metavar='N', type=int, default=None,
+                        help='reject new async jobs with 429 when this many are queued, '
+                             'default is NB2W_MAX_QUEUED_JOBS or no limit')
+    parser.add_argument('--max-running-jobs', metavar='N', type=int, default=None,
+                        help='reject sync requests with 429 when this many jobs are running, shared equally by '
+                             'the --workers processes of gunicorn; default is NB2W_MAX_RUNNING_JOBS or no limit')
+    parser.add_argument('--min-free-disk-mb', metavar='MB', type=float, default=None,
+                        help='reject new jobs with 503 when less disk space is available, '
+                             'default is NB2W_MIN_FREE_DISK_MB or no limit')
+    parser.add_argument('--min-free-memory-mb', metavar='MB', type=float, default=None,
+                        help='reject new jobs with 503 when less memory is available, '
+                             'default is NB2W_MIN_FREE_MEMORY_MB or no limit')
+    parser.add_argument('--result-cache', metavar='directory', type=str, default=None,
+                        help='keep outputs of successful executions in this directory, which can be shared by '
+                             'replicas, and reuse them for identical requests; default is NB2W_RESULT_CACHE or none')
+    parser.add_argument('--job-store', metavar='url', type=str, default=None,
+                        help='where async job states and results are kept: memory, or sqlite:///path/jobs.sqlite '
+                             'to keep them across restarts; default is NB2W_JOB_STORE or memory')
+    parser.add_argument('--job-queue', metavar='url', type=str, default=None,
+                        help='where queued async jobs are kept: memory, or sqlite:///path/queue.sqlite '
+                             'to share them between processes; default is NB2W_JOB_QUEUE or memory')
     #parser.add_argument('--tmpdir', metavar='tmpdir', type=str, default=None)
     parser.add_argument('--publish', metavar='upstream-url',
                         type=str, default=None)
@@ -910,10 +1348,54 @@ def main():
         root.setLevel(logging.INFO)
         handler.setLevel(logging.INFO)
 
+    if args.jobdir_mode is not None:
+        os.environ['NB2W_JOBDIR_MODE'] = args.jobdir_mode
+
+    if args.server == 'gunicorn' and args.state_dir is None:
+        # workers do not share memory
+        args.state_dir = tempfile.mkdtemp(prefix="nb2w-state-")
+        logger.info("keeping service state in %s", args.state_dir)
+
+    if args.state_dir is not None:
+        if args.job_store is None:
+            args.job_store = 'sqlite://' + os.path.join(args.state_dir, 'jobs.sqlite')
+        if args.job_queue is None:
+            args.job_queue = 'sqlite://' + os.path.join(args.state_dir, 'queue.sqlite')
+        if args.result_cache is None and os.getenv('NB2W_RESULT_CACHE') is None:
+            args.result_cache = os.path.join(args.state_dir, 'results')
+
+    if args.result_cache is not None:
+        os.environ['NB2W_RESULT_CACHE'] = args.result_cache
+
+    # running jobs are counted by each process serving requests
+    admission.configure(n_workers=args.async_workers,
+                        n_processes=args.workers if args.server == 'gunicorn' else 1,
+                        max_queued_jobs=args.max_queued_jobs,
+                        max_running_jobs=args.max_running_jobs,
+                        min_free_disk_mb=args.min_free_disk_mb,
+                        min_free_memory_mb=args.min_free_memory_mb)
+
+    global async_queue
+    async_queue = open_job_queue(args.job_queue, from_record=AsyncWorkflow.from_record)
+    # jobs in progress are lost with an in-memory queue, they are kept in a shared one
+    recover = isinstance(async_queue, FairShareQueue)
+
     with wfstore._lock:
+        wfstore.open_job_stores(args.job_store, recover=recover)
+        # notebooks unchanged since the signatures were written are not parsed
+        precompiled = read_signature_file(notebook_directory(args.notebook))
         wfstore.notebook_adapters = find_notebooks(args.notebook, pattern=args.pattern)
-        wfstore.service_semantic_signature = ontology.service_semantic_signature(
-            wfstore.notebook_adapters)
+
+        if precompiled is not None and precompiled['up_to_date'] and \
+                set(precompiled['notebooks']) == set(wfstore.notebook_adapters):
+            logger.info("using precompiled service signature")
+            wfstore.service_semantic_signature = precompiled['service_semantic_signature']
+            wfstore.openapi_specs = precompiled['openapi'] or {}
+        else:
+            wfstore.service_semantic_signature = ontology.service_semantic_signature(
+                wfstore.notebook_adapters)
+
+        setup_async_queue()
     
         app = create_app()
         
@@ -936,11 +1418,31 @@ def main():
   #  for rule in app.url_map.iter_rules():
  #       logger.debug("==>> %s %s %s %s",rule,rule.endpoint,rule.__class__,rule.__dict__)
 
-    for worker_i in range(args.async_workers):
-        async_worker = AsyncWorker('default-%i' % worker_i)
-        async_worker.start()
+    max_async_workers = max(args.max_async_workers or args.async_workers, args.async_workers)
 
-    app.run(host=args.host, port=args.port)
+    def start_workers():
+        # in every server process: threads and kernels are not inherited by forked processes
+        with wfstore._lock:
+            setup_kernel_pools(args.kernel_pool_size)
+
+        if args.worker_backend == 'process':
+            global process_backend
+            process_backend = ProcessBackend(max_async_workers, debug=args.debug)
+
+            if args.kernel_pool_size > 0:
+                logger.warning("kernel pools are not used by the process worker backend")
+
+        global worker_pool
+        worker_pool = WorkerPool(lambda pool, worker_id: AsyncWorker(worker_id, pool=pool),
+                                 min_workers=args.async_workers,
+                                 max_workers=max_async_workers,
+                                 qsize=async_queue.n_ready,
+                                 mean_duration_s=lambda: admission.mean_duration_s)
+        worker_pool.start()
+        worker_pool.run_autoscaler()
+
+    serve(app, server=args.server, host=args.host, port=args.port, workers=args.workers,
+          on_worker_start=start_workers)
 
 
 
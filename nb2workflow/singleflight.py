@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.n_waiting = 0
+
+
+class SingleFlight:
+    """
+    concurrent calls with the same key wait for the first one and share its result (or exception)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+
+    def in_flight(self, key) -> bool:
+        with self._lock:
+            return key in self._flights
+
+    def do(self, key, fn, *args, on_leader=None, **kwargs):
+        """
+        returns the result of fn, and whether it was shared with another call
+
+        on_leader is called only by the call which executes fn, once it is the leader, and returns
+        a context manager which fn is executed in. If it raises, fn is not executed and the calls
+        waiting for it get the exception.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.n_waiting += 1
+
+        if not leader:
+            logger.info("joining execution in flight for %s", key)
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result, True
+
+        try:
+            if on_leader is None:
+                flight.result = fn(*args, **kwargs)
+            else:
+                with on_leader():
+                    flight.result = fn(*args, **kwargs)
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+            if flight.n_waiting > 0:
+                logger.info("execution for %s shared with %s requests", key, flight.n_waiting)
+
+        return flight.result, flight.n_waiting > 0
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import os
+import math
+import time
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# queued work, in seconds of job duration, which one worker is expected to absorb
+target_queue_wait_s = 30
+
+# no workers are added above this load average per cpu, and workers are removed above twice it
+max_load_per_cpu = 1.5
+
+# no workers are added below twice this available memory, and workers are removed below it
+min_free_memory_mb = 1024
+
+autoscale_interval_s = 5
+
+n_decisions_kept = 20
+
+
+class WorkerPool:
+    """
+    async workers between min_workers and max_workers, grown with the queued work and shrunk when idle,
+    within the limits of load average and available memory
+
+    Workers are threads made by worker_factory(pool, worker_id); they call pool.working() around
+    every job and leave when pool.should_stop() says so.
+    """
+    def __init__(self, worker_factory, min_workers=1, max_workers=None, qsize=lambda: 0, mean_duration_s=lambda: None):
+        self.worker_factory = worker_factory
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers or min_workers, min_workers)
+        self.qsize = qsize
+        self.mean_duration_s = mean_duration_s
+
+        self._lock = threading.Lock()
+        self._workers = {}
+        self._busy = set()
+        self._n_to_stop = 0
+        self._counter = 0
+        self.decisions = collections.deque(maxlen=n_decisions_kept)
+
+    @property
+    def n_workers(self):
+        return len(self._workers)
+
+    def _add_worker(self):
+        worker_id = f'default-{self._counter}'
+        self._counter += 1
+        worker = self.worker_factory(self, worker_id)
+        self._workers[worker_id] = worker
+        worker.start()
+
+    def start(self, n_workers=None):
+        with self._lock:
+            for _ in range(max(n_workers or self.min_workers, self.min_workers)):
+                self._add_worker()
+
+    @contextmanager
+    def working(self, worker_id):
+        with self._lock:
+            self._busy.add(worker_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._busy.discard(worker_id)
+
+    def should_stop(self, worker_id) -> bool:
+        with self._lock:
+            if self._n_to_stop > 0 and worker_id not in self._busy:
+                self._n_to_stop -= 1
+                del self._workers[worker_id]
+                logger.info("stopping worker %s, %s left", worker_id, len(self._workers))
+                return True
+            return False
+
+    @staticmethod
+    def resource_metrics():
+        return dict(
+            load_per_cpu=os.getloadavg()[0] / (os.cpu_count() or 1),
+            memory_avail_mb=psutil.virtual_memory().available / 1024 / 1024,
+        )
+
+    def desired_workers(self, metrics) -> tuple[int, str]:
+        n_busy = metrics['n_busy']
+
+        if metrics['load_per_cpu'] > 2 * max_load_per_cpu:
+            return n_busy - 1, "load too high"
+
+        if metrics['memory_avail_mb'] < min_free_memory_mb:
+            return n_busy - 1, "memory too low"
+
+        if metrics['qsize'] == 0:
+            return n_busy, "no queued jobs"
+
+        queued_work_s = metrics['qsize'] * (metrics['mean_duration_s'] or target_queue_wait_s)
+        desired = n_busy + math.ceil(queued_work_s / target_queue_wait_s)
+
+        if desired > metrics['n_workers']:
+            if metrics['load_per_cpu'] > max_load_per_cpu:
+                return metrics['n_workers'], "queued jobs, but load is high"
+            if metrics['memory_avail_mb'] < 2 * min_free_memory_mb:
+                return metrics['n_workers'], "queued jobs, but memory is low"
+
+        return desired, f"{metrics['qsize']} queued jobs"
+
+    def scale(self) -> dict:
+        """
+        adds or removes workers once, returns the decision
+        """
+        with self._lock:
+            metrics = dict(
+                n_workers=len(self._workers) - self._n_to_stop,
+                n_busy=len(self._busy),
+                qsize=self.qsize(),
+                mean_duration_s=self.mean_duration_s(),
+                **self.resource_metrics(),
+            )
+
+            desired, reason = self.desired_workers(metrics)
+            desired = min(max(desired, self.min_workers), self.max_workers)
+
+            if desired > metrics['n_workers']:
+                action = 'grow'
+                # workers which were asked to stop are kept instead
+                n_kept = min(self._n_to_stop, desired - metrics['n_workers'])
+                self._n_to_stop -= n_kept
+                for _ in range(desired - metrics['n_workers'] - n_kept):
+                    self._add_worker()
+            elif desired < metrics['n_workers']:
+                # one at a time, idle workers leave when they see it
+                action = 'shrink'
+                desired = metrics['n_workers'] - 1
+                self._n_to_stop += 1
+            else:
+                action = 'keep'
+
+            decision = dict(time=time.time(), action=action, n_workers=desired, reason=reason, metrics=metrics)
+
+            if action != 'keep':
+                logger.info("worker pool: %s to %s workers, %s", action, desired, reason)
+                self.decisions.append(decision)
+
+            return decision
+
+    def run_autoscaler(self, interval_s=autoscale_interval_s):
+        def autoscale():
+            while True:
+                time.sleep(interval_s)
+                try:
+                    self.scale()
+                except Exception as e:
+                    logger.error("unable to scale worker pool: %s", repr(e))
+
+        if self.max_workers > self.min_workers:
+            threading.Thread(target=autoscale, name='nb2w-autoscaler', daemon=True).start()
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(
+                n_workers=len(self._workers),
+                n_busy=len(self._busy),
+                n_stopping=self._n_to_stop,
+                min_workers=self.min_workers,
+                max_workers=self.max_workers,
+                decisions=list(self.decisions),
+            )
@@ -11,6 +11,7 @@ from .sentry import sentry
 from diskcache import Cache
 
 from nb2workflow import nbadapter
+from nb2workflow.resultcache import result_cache
 
 cache = Cache('.nb2workflow/cache')
 enable_cache = False
@@ -73,11 +74,20 @@ def evaluate(router, *args, **kwargs):
 
         print("calling",params)
 
-        exceptions = nba.execute(params,
-                    log_output=True,
-                    progress_bar=False)
+        result_key = result_cache.key(nba, params) if cached else None
+        output, state = result_cache.get(result_key)
 
-        output = nba.extract_output()
+        if state in ['fresh', 'refresh']:
+            exceptions = []
+        else:
+            exceptions = nba.execute(params,
+                        log_output=True,
+                        progress_bar=False)
+
+            output = nba.extract_output()
+
+            if len(exceptions) == 0:
+                result_cache.put(result_key, nba, output)
 
         result = dict(output = output, exceptions = [serialize_workflow_exception(e) for e in exceptions])
 
@@ -16,6 +16,21 @@ def test_local_dir():
                           os.path.join(os.getcwd(), "tests/testfiles/"))
 
 
+@pytest.fixture
+def code_cell():
+    """
+    makes a notebook code cell with these tags
+    """
+    import nbformat
+
+    def make(source, *tags):
+        cell = nbformat.v4.new_code_cell(source=source)
+        cell.metadata['tags'] = list(tags)
+        return cell
+
+    return make
+
+
 @pytest.fixture(scope="module")
 def test_inrepo_notebook():
     return os.environ.get('TEST_NOTEBOOK',
@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+
+def test_admission_is_atomic():
+    from nb2workflow.admission import AdmissionController, AdmissionRejected
+
+    admission = AdmissionController(limits=dict(max_queued_jobs=3, max_running_jobs=2,
+                                                min_free_disk_mb=0, min_free_memory_mb=0))
+
+    barrier = threading.Barrier(10)
+    admitted, rejected = [], []
+
+    def request():
+        barrier.wait()
+        try:
+            admitted.append(admission.admit(queued=False))
+        except AdmissionRejected as e:
+            rejected.append(e)
+
+    threads = [threading.Thread(target=request) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(admitted) == 2
+    assert len(rejected) == 8
+    assert rejected[0].status_code == 429
+
+    with admitted[0]:
+        pass
+    admitted[0].release()
+    assert admission.n_running == 1
+    assert len(admission.recent_durations_s) == 1
+
+    admitted[1].release()
+    assert admission.n_running == 0
+
+    # queue slots are reserved until the job is queued
+    slots = [admission.admit(qsize=1, queued=True) for _ in range(2)]
+    with pytest.raises(AdmissionRejected):
+        admission.admit(qsize=1, queued=True)
+
+    slots[0].release()
+    admission.admit(qsize=1, queued=True)
+
+
+def test_admission_limits_per_process():
+    from nb2workflow.admission import AdmissionController, AdmissionRejected
+
+    admission = AdmissionController(limits=dict(max_queued_jobs=3, max_running_jobs=4,
+                                                min_free_disk_mb=0, min_free_memory_mb=0))
+    admission.configure(n_processes=2)
+
+    # each process takes its part of the running jobs, the queue is shared
+    assert admission.limits['max_running_jobs'] == 2
+    assert admission.limits['max_queued_jobs'] == 3
+
+    admitted = [admission.admit(queued=False) for _ in range(2)]
+    with pytest.raises(AdmissionRejected):
+        admission.admit(queued=False)
+
+    for a in admitted:
+        a.release()
+
+    admission.configure(n_processes=8)
+    assert admission.limits['max_running_jobs'] == 1
@@ -0,0 +1,95 @@
+import os
+import yaml
+import nbformat
+
+
+def test_analyze_cell():
+    from nb2workflow.dataflow import analyze_cell
+
+    flow = analyze_cell("import numpy as np\n"
+                        "x = np.arange(n)\n"
+                        "def f(y):\n"
+                        "    z = y + k\n"
+                        "    return z\n"
+                        "q = [i * w for i in x]\n"
+                        "d['a'] = 1\n")
+
+    assert flow.writes == {'np', 'x', 'f', 'q', 'd'}
+    assert {'np', 'n', 'k', 'w', 'x', 'd'} <= flow.reads
+    assert not {'y', 'z', 'i'} & flow.reads
+    assert not flow.opaque
+
+    assert analyze_cell("%matplotlib inline\nplot(x)").has_magics
+    assert analyze_cell("from os import *").opaque
+
+
+def test_cell_cache_execute(tmp_path, monkeypatch, code_cell):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    monkeypatch.setenv("NB2W_CELL_CACHE", str(tmp_path / "cells"))
+
+    nb = nbformat.v4.new_notebook()
+    nb.metadata['kernelspec'] = dict(name='python3', display_name='Python 3', language='python')
+    nb.cells = [
+        code_cell("n = 3\nother = 1", 'parameters'),
+        code_cell("import time\nsquares = [i * i for i in range(n)]\nstamp = time.time()", 'cached'),
+        code_cell("total = sum(squares) + other"),
+        code_cell("result = total\nresult_stamp = stamp", 'outputs'),
+    ]
+    nb_dir = tmp_path / "nb"
+    nb_dir.mkdir()
+    nbformat.write(nb, str(nb_dir / "memo.ipynb"))
+
+    def run(**parameters):
+        nba = NotebookAdapter(str(nb_dir / "memo.ipynb"))
+        assert nba.execute(parameters) == []
+        summary = yaml.load(open(os.path.join(nba.tmpdir, "summary.yaml")), Loader=yaml.Loader)
+        return nba.extract_output(), summary['cell_cache']
+
+    output, summary = run(n=3)
+    assert output['result'] == 6
+    assert summary['misses'] == 1 and summary['hits'] == 0
+
+    # parameter which the cached cell does not read
+    output_hit, summary = run(n=3, other=2)
+    assert output_hit['result'] == 7
+    assert output_hit['result_stamp'] == output['result_stamp']
+    assert summary['hits'] == 1 and summary['hit_rate'] == 1
+
+    output, summary = run(n=4)
+    assert output['result'] == 15
+    assert summary['misses'] == 1
+
+
+def test_cell_cache_all_side_effects(tmp_path, monkeypatch, code_cell):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    monkeypatch.setenv("NB2W_CELL_CACHE", str(tmp_path / "cells"))
+
+    nb = nbformat.v4.new_notebook()
+    nb.metadata['kernelspec'] = dict(name='python3', display_name='Python 3', language='python')
+    nb.cells = [
+        code_cell("n = 3", 'parameters'),
+        code_cell("cell_cache = True", 'system-parameters'),
+        code_cell("squares = [i * i for i in range(n)]"),
+        code_cell("with open('squares.txt', 'w') as f:\n    f.write(str(sum(squares)))"),
+        code_cell("result = open('squares.txt').read()", 'outputs'),
+    ]
+    nb_dir = tmp_path / "nb"
+    nb_dir.mkdir()
+    nbformat.write(nb, str(nb_dir / "memo.ipynb"))
+
+    def run(**parameters):
+        nba = NotebookAdapter(str(nb_dir / "memo.ipynb"))
+        assert nba.execute(parameters) == []
+        summary = yaml.load(open(os.path.join(nba.tmpdir, "summary.yaml")), Loader=yaml.Loader)
+        return nba.extract_output(), summary['cell_cache']
+
+    output, summary = run(n=3)
+    assert output['result'] == '5'
+    assert len(summary['cells']) == 1
+
+    # the cell writing the file is executed again
+    output, summary = run(n=3)
+    assert output['result'] == '5'
+    assert summary['hits'] == 1 and summary['misses'] == 0
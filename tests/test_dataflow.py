@@ -0,0 +1,68 @@
+import os
+import yaml
+import nbformat
+
+
+def test_prune_cells(code_cell):
+    from nb2workflow.dataflow import prune_cells
+
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        code_cell("n = 3", 'parameters'),
+        code_cell("import json\nx = list(range(n))"),
+        code_cell("x.append(10)"),
+        code_cell("print(x)\nx"),
+        code_cell("plt.plot(x)\nplt.show()"),
+        code_cell("unused = [i * 2 for i in x]"),
+        code_cell("json.dump(x, open('x.json', 'w'))"),
+        code_cell("explored = len(x)", 'keep'),
+        code_cell("%matplotlib inline"),
+        code_cell("result = sum(x)", 'outputs'),
+    ]
+
+    pruned = prune_cells(nb)
+
+    assert pruned == [3, 4, 5]
+    assert len(nb.cells) == 7
+    assert [cell.source for cell in nb.cells][-1] == "result = sum(x)"
+
+
+def test_prune_cells_opaque(code_cell):
+    from nb2workflow.dataflow import prune_cells
+
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        code_cell("unused = 1"),
+        code_cell("from os.path import *"),
+        code_cell("unused_too = 2"),
+        code_cell("result = 1", 'outputs'),
+    ]
+
+    assert prune_cells(nb) == [2]
+
+
+def test_execute_pruned(tmp_path, monkeypatch, code_cell):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    monkeypatch.setenv("NB2W_PREPROC_CACHE", str(tmp_path / "preproc"))
+
+    nb = nbformat.v4.new_notebook()
+    nb.metadata['kernelspec'] = dict(name='python3', display_name='Python 3', language='python')
+    nb.cells = [
+        code_cell("prune_cells = True", 'system-parameters'),
+        code_cell("n = 3", 'parameters'),
+        code_cell("x = list(range(n))"),
+        code_cell("explored = x[100]"),
+        code_cell("print(x)"),
+        code_cell("result = sum(x)", 'outputs'),
+    ]
+    nb_dir = tmp_path / "nb"
+    nb_dir.mkdir()
+    nbformat.write(nb, str(nb_dir / "pruned.ipynb"))
+
+    nba = NotebookAdapter(str(nb_dir / "pruned.ipynb"))
+    assert nba.execute(dict(n=4)) == []
+    assert nba.extract_output()['result'] == 6
+
+    summary = yaml.load(open(os.path.join(nba.tmpdir, "summary.yaml")), Loader=yaml.Loader)
+    assert summary['pruned_cells'] == [3, 4]
@@ -0,0 +1,27 @@
+import hashlib
+
+
+def test_parse_waiting_for():
+    from nb2workflow.dependencies import WorkflowIncomplete, parse_waiting_for
+
+    key = hashlib.sha224(b"upstream").hexdigest()
+
+    assert parse_waiting_for(str(WorkflowIncomplete(waiting_for="some-key"))) == "some-key"
+    assert parse_waiting_for(f"job {key} is still running") == key
+    assert parse_waiting_for("not ready") is None
+
+
+def test_registry():
+    from nb2workflow.dependencies import DependencyRegistry
+
+    registry = DependencyRegistry()
+    registry.wait("up", "a")
+    registry.wait("up", "a")
+    registry.wait("up", "b")
+    registry.wait("other", "b")
+
+    registry.forget("b")
+    assert registry.status() == {"up": 1}
+
+    assert registry.complete("up") == ["a"]
+    assert registry.complete("up") == []
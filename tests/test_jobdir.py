@@ -0,0 +1,130 @@
+import os
+import subprocess
+import pytest
+
+
+@pytest.fixture
+def local_git_repo(tmp_path):
+    repo_dir = tmp_path / "repo"
+    repo_dir.mkdir()
+    (repo_dir / "data.txt").write_text("original")
+
+    subprocess.check_call(["git", "init", "-q"], cwd=repo_dir)
+    subprocess.check_call(["git", "add", "data.txt"], cwd=repo_dir)
+    subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                           "commit", "-q", "-m", "init"], cwd=repo_dir)
+
+    return str(repo_dir)
+
+
+@pytest.mark.parametrize("mode", ["clone", "reflink", "worktree", "auto"])
+def test_provision(local_git_repo, tmp_path, mode):
+    from nb2workflow.jobdir import JobDirProvisioner
+
+    provisioner = JobDirProvisioner(mode=mode, snapshot_root=str(tmp_path / "snapshots"))
+
+    jobdirs = []
+    for i in range(2):
+        jobdir = tmp_path / f"job{i}"
+        jobdir.mkdir()
+        used_mode = provisioner.provision(local_git_repo, str(jobdir))
+        assert used_mode in ["clone", "reflink", "worktree"]
+        if mode != "auto":
+            assert used_mode in [mode, "clone"]
+
+        assert (jobdir / "data.txt").read_text() == "original"
+
+        (jobdir / "new.txt").write_text(f"job {i}")
+        jobdirs.append(jobdir)
+
+    assert (jobdirs[0] / "new.txt").read_text() == "job 0"
+
+    if mode != "clone":
+        snapshots = [d for d in os.listdir(tmp_path / "snapshots") if not d.startswith(".")]
+        assert len(snapshots) == 1
+        assert not os.path.exists(tmp_path / "snapshots" / snapshots[0] / "new.txt")
+
+
+def test_snapshot_leases(local_git_repo, tmp_path, monkeypatch):
+    import shutil
+    from nb2workflow import jobdir as jobdir_module
+    from nb2workflow.jobdir import JobDirProvisioner
+
+    monkeypatch.setattr(jobdir_module, "n_snapshots_kept", 1)
+
+    provisioner = JobDirProvisioner(mode="worktree", snapshot_root=str(tmp_path / "snapshots"))
+
+    def commit(content):
+        with open(os.path.join(local_git_repo, "data.txt"), "w") as f:
+            f.write(content)
+        subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                               "commit", "-q", "-am", content], cwd=local_git_repo)
+
+    jobdir = tmp_path / "job"
+    jobdir.mkdir()
+    assert provisioner.provision(local_git_repo, str(jobdir)) == "worktree"
+    first = provisioner.snapshot(local_git_repo)
+
+    # the worktree job still uses the first snapshot, which is not removed
+    commit("updated")
+    second = provisioner.snapshot(local_git_repo)
+    assert os.path.exists(first)
+    assert (jobdir / "data.txt").read_text() == "original"
+
+    # once released, the worktree is removed from the snapshot repository, and the snapshot can be removed
+    provisioner.release(str(jobdir))
+    shutil.rmtree(jobdir, ignore_errors=True)
+    assert subprocess.check_output(["git", "worktree", "list"], cwd=first).decode().count("\n") == 1
+
+    commit("updated again")
+    provisioner.snapshot(local_git_repo)
+    assert not os.path.exists(first)
+    assert not os.path.exists(second)
+
+    # leases of job directories removed without release are dropped
+    jobdir = tmp_path / "job2"
+    jobdir.mkdir()
+    provisioner.provision(local_git_repo, str(jobdir))
+    shutil.rmtree(jobdir)
+    third = provisioner.snapshot(local_git_repo)
+    commit("updated once more")
+    provisioner.snapshot(local_git_repo)
+    assert not os.path.exists(third)
+
+
+def test_snapshot_per_commit(local_git_repo, tmp_path):
+    from nb2workflow.jobdir import JobDirProvisioner
+
+    provisioner = JobDirProvisioner(mode="worktree", snapshot_root=str(tmp_path / "snapshots"))
+    first = provisioner.snapshot(local_git_repo)
+    assert provisioner.snapshot(local_git_repo) == first
+
+    with open(os.path.join(local_git_repo, "data.txt"), "w") as f:
+        f.write("updated")
+    subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                           "commit", "-q", "-am", "update"], cwd=local_git_repo)
+
+    second = provisioner.snapshot(local_git_repo)
+    assert second != first
+    assert open(os.path.join(second, "data.txt")).read() == "updated"
+
+
+def test_execute_with_jobdir_mode(test_local_dir, local_git_repo, tmp_path, monkeypatch):
+    import shutil
+    import yaml
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    shutil.copy(os.path.join(test_local_dir, "testbool.ipynb"), local_git_repo)
+    subprocess.check_call(["git", "add", "testbool.ipynb"], cwd=local_git_repo)
+    subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                           "commit", "-q", "-m", "notebook"], cwd=local_git_repo)
+
+    monkeypatch.setenv("NB2W_JOBDIR_MODE", "worktree")
+    monkeypatch.setenv("NB2W_SNAPSHOTS", str(tmp_path / "snapshots"))
+
+    nba = NotebookAdapter(os.path.join(local_git_repo, "testbool.ipynb"))
+    assert nba.execute(dict(boolpar=False)) == []
+    assert nba.extract_output()['output'] == 'boolean False'
+
+    summary = yaml.load(open(os.path.join(nba.tmpdir, "summary.yaml")), Loader=yaml.Loader)
+    assert summary['jobdir_mode'] == 'worktree'
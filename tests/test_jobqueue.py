@@ -0,0 +1,189 @@
+import queue
+import pytest
+from dataclasses import dataclass, asdict
+
+
+@dataclass
+class Job:
+    target: str
+    name: str
+    priority: int = 0
+
+    def to_record(self):
+        return asdict(self)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def job_queue_url(request, tmp_path):
+    if request.param == "memory":
+        return "memory"
+    return "sqlite://" + str(tmp_path / "state" / "queue.sqlite")
+
+
+@pytest.fixture
+def make_queue(job_queue_url):
+    from nb2workflow.jobqueue import open_job_queue
+
+    return lambda: open_job_queue(job_queue_url, from_record=lambda record: Job(**record))
+
+
+def drain(q, n=None):
+    taken = []
+    while n is None or len(taken) < n:
+        try:
+            job = q.get(block=False)
+        except queue.Empty:
+            break
+        taken.append(job.name)
+        q.task_done(job)
+    return taken
+
+
+def test_fair_share(make_queue):
+    q = make_queue()
+
+    for i in range(10):
+        q.put(Job('bulk', f'bulk{i}'))
+    q.put(Job('interactive', 'interactive0'))
+    q.put(Job('interactive', 'interactive1'))
+
+    assert q.qsize() == 12
+    assert drain(q, 4) == ['bulk0', 'interactive0', 'bulk1', 'interactive1']
+    assert drain(q) == [f'bulk{i}' for i in range(2, 10)]
+
+
+def test_weights_and_priority(make_queue):
+    q = make_queue()
+    q.configure_target('a', weight=2)
+
+    for i in range(4):
+        q.put(Job('a', f'a{i}'))
+        q.put(Job('b', f'b{i}'))
+    q.put(Job('b', 'urgent', priority=10))
+
+    assert drain(q, 6) == ['urgent', 'a0', 'a1', 'a2', 'b0', 'a3']
+
+
+def test_max_concurrency(make_queue):
+    q = make_queue()
+    q.configure_target('a', max_concurrency=1)
+
+    q.put(Job('a', 'a0'))
+    q.put(Job('a', 'a1'))
+
+    first = q.get(block=False)
+    assert first.name == 'a0'
+
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.1)
+
+    q.task_done(first)
+    assert q.get(timeout=1).name == 'a1'
+    assert q.status()['a'] == dict(queued=0, delayed=0, running=1, weight=1, max_concurrency=1)
+
+
+def test_delayed(make_queue):
+    import time
+    import threading
+    q = make_queue()
+    q.put(Job('a', 'later'), delay_s=0.3)
+    q.put(Job('a', 'now'))
+
+    assert q.qsize() == 2
+    # delayed jobs are queued, but not ready to be taken
+    assert q.n_ready() == 1
+    assert q.n_ready('a') == 1 and q.n_ready('b') == 0
+    assert drain(q) == ['now']
+    assert q.qsize() == 1 and q.n_ready() == 0
+
+    t0 = time.time()
+    assert q.get(timeout=5).name == 'later'
+    assert 0.2 < time.time() - t0 < 1
+
+    # a blocked worker is woken up by a job delayed less than the one it is waiting for
+    q.put(Job('a', 'last'), delay_s=10)
+    threading.Timer(0.1, lambda: q.put(Job('b', 'first'), delay_s=0.1)).start()
+
+    t0 = time.time()
+    assert q.get(timeout=5).name == 'first'
+    assert time.time() - t0 < 1
+    assert q.status()['a']['delayed'] == 1
+
+
+def test_waiting_for(make_queue):
+    q = make_queue()
+    q.put(Job('a', 'downstream'), delay_s=10, waiting_for='upstream-key')
+
+    assert q.waiting_for() == {'upstream-key': 1}
+    assert drain(q) == []
+
+    assert q.wake_waiting_for('other-key') == 0
+    assert q.wake_waiting_for('upstream-key') == 1
+    assert drain(q) == ['downstream']
+    assert q.waiting_for() == {}
+
+
+def test_sqlite_queue_shared(tmp_path):
+    from nb2workflow.jobqueue import open_job_queue, sqlite_queue_poll_interval_s
+
+    url = "sqlite://" + str(tmp_path / "queue.sqlite")
+    from_record = lambda record: Job(**record)
+
+    # as in two worker processes
+    q1 = open_job_queue(url, from_record=from_record)
+    q2 = open_job_queue(url, from_record=from_record)
+
+    q1.configure_target('a', max_concurrency=1)
+    q1.put(Job('a', 'a0'))
+    q1.put(Job('a', 'a1'))
+    q1.put(Job('b', 'b0'))
+
+    assert q2.qsize() == 3
+
+    first = q2.get(block=False)
+    assert first == Job('a', 'a0')
+    assert q1.get(block=False).name == 'b0'
+
+    # a1 waits for a0 to be done in the other process
+    with pytest.raises(queue.Empty):
+        q1.get(timeout=0.1)
+    q2.task_done(first)
+    assert q1.get(timeout=sqlite_queue_poll_interval_s * 4).name == 'a1'
+
+    assert q2.status()['a'] == dict(queued=0, delayed=0, running=1, weight=1, max_concurrency=1)
+
+
+
+def test_sqlite_queue_lease(tmp_path, monkeypatch):
+    import time
+    from nb2workflow.jobqueue import open_job_queue, SQLiteJobQueue
+
+    url = "sqlite://" + str(tmp_path / "queue.sqlite")
+    from_record = lambda record: Job(**record)
+
+    live = open_job_queue(url, from_record=from_record, lease_s=0.5)
+    live.put(Job('a', 'a0'))
+
+    # a replica which dies with the job does not renew the lease
+    with monkeypatch.context() as m:
+        m.setattr(SQLiteJobQueue, '_start_heartbeat', lambda self: None)
+        dead = open_job_queue(url, from_record=from_record, lease_s=0.2)
+        lost = dead.get(block=False)
+
+    with pytest.raises(queue.Empty):
+        live.get(block=False)
+
+    time.sleep(0.3)
+    taken = live.get(block=False)
+    assert taken.name == 'a0'
+
+    # the lease of the live replica is renewed while the job runs
+    time.sleep(1)
+    assert dead.status()['a']['running'] == 1
+    assert live.heartbeat() == 1
+
+    dead.task_done(lost)
+    assert live.qsize() == 0 and live.status()['a']['running'] == 1
+
+    live.task_done(taken)
+    assert live.status()['a']['running'] == 0
@@ -0,0 +1,82 @@
+import os
+import time
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def job_store_url(request, tmp_path):
+    if request.param == "memory":
+        return "memory"
+    return "sqlite://" + str(tmp_path / "state" / "jobs.sqlite")
+
+
+def test_job_store(job_store_url):
+    from nb2workflow.jobstore import open_job_store
+
+    store = open_job_store(job_store_url)
+
+    store['a'] = 'submitted'
+    store['b'] = dict(output=dict(x=1), exceptions=[])
+    store['a'] = 'started'
+
+    assert store['a'] == 'started'
+    assert store['b'] == dict(output=dict(x=1), exceptions=[])
+    assert store.get('c') is None
+    assert store.status('b') == 'done'
+    assert len(store) == 2
+    assert store.count(['started']) == 1
+
+    assert [key for key, _, _ in store.page(0, 1)] == ['a']
+    assert [key for key, _, _ in store.page(1, 10)] == ['b']
+
+    del store['b']
+    assert 'b' not in store
+
+    assert store.add('b', 'submitted')
+    assert not store.add('b', 'started')
+    assert store['b'] == 'submitted'
+
+    store.clear()
+    assert len(store) == 0
+
+
+def test_job_store_restart(tmp_path):
+    from nb2workflow.jobstore import open_job_store
+
+    url = "sqlite://" + str(tmp_path / "jobs.sqlite")
+
+    store = open_job_store(url)
+    store['done'] = dict(output=dict(x=[1, 2]), exceptions=[])
+    store['lost'] = 'started'
+
+    jobdirs = open_job_store(url, table='jobdirs', value_status='stored')
+    jobdirs['done'] = '/tmp/nb2w-done'
+    assert jobdirs.add('other', '/tmp/nb2w-other')
+    assert jobdirs.status('done') == jobdirs.status('other') == 'stored'
+    assert jobdirs.count(['stored']) == 2
+
+    assert len(os.listdir(store.results_dir)) == 1
+
+    store = open_job_store(url)
+    assert list(store) == ['done']
+    assert store['done']['output'] == dict(x=[1, 2])
+
+    assert open_job_store(url, table='jobdirs')['done'] == '/tmp/nb2w-done'
+
+
+def test_job_store_eviction(job_store_url):
+    from nb2workflow.jobstore import open_job_store
+
+    store = open_job_store(job_store_url, ttl_s=3600, max_entries=3)
+
+    for i in range(4):
+        store[f'job{i}'] = dict(output={}, exceptions=[])
+    store['running'] = 'started'
+
+    store.evict()
+    assert sorted(store) == ['job2', 'job3', 'running']
+
+    store.ttl_s = 1e-3
+    time.sleep(0.01)
+    store.evict()
+    assert list(store) == ['running']
@@ -0,0 +1,70 @@
+import os
+import time
+import yaml
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def wait_idle(pool, n=1, timeout=60):
+    t0 = time.time()
+    while pool.idle < n:
+        assert time.time() - t0 < timeout, "pool did not start kernels in time"
+        time.sleep(0.1)
+
+
+def test_kernel_pool_execute(test_local_dir):
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.kernelpool import KernelPool
+
+    pool = KernelPool('python3', size=1)
+    pool.start()
+
+    try:
+        nba = NotebookAdapter(os.path.join(test_local_dir, "testbool.ipynb"), kernel_pool=pool)
+
+        for boolpar in [False, True]:
+            wait_idle(pool)
+
+            exceptions = nba.execute(dict(boolpar=boolpar))
+            assert exceptions == []
+            assert nba.extract_output()['output'] == f'boolean {boolpar}'
+
+            summary = yaml.load(open(os.path.join(nba.tmpdir, "summary.yaml")), Loader=yaml.Loader)
+            assert summary['kernel_pool']['hit'] is True
+            assert summary['kernel_pool']['kernel_name'] == 'python3'
+
+        assert pool.stats['hits'] == 2
+        assert pool.stats['misses'] == 0
+    finally:
+        pool.shutdown()
+
+
+def test_kernel_pool_lease_cwd(tmp_path):
+    from nb2workflow.kernelpool import KernelPool
+
+    pool = KernelPool('python3', size=1)
+    pool.start()
+
+    try:
+        with pool.lease(cwd=str(tmp_path)) as (km, lease_info):
+            assert km is not None
+            assert lease_info['wait_s'] >= 0
+
+            kc = km.client()
+            kc.start_channels()
+            try:
+                kc.wait_for_ready(timeout=60)
+                reply = kc.execute_interactive("import os; open('cwd.txt', 'w').write(os.getcwd())",
+                                               timeout=60, output_hook=lambda msg: None)
+                assert reply['content']['status'] == 'ok'
+            finally:
+                kc.stop_channels()
+
+        assert open(tmp_path / 'cwd.txt').read() == str(tmp_path)
+
+        # leased kernel is replaced, not reused
+        wait_idle(pool)
+        assert pool.idle == 1
+    finally:
+        pool.shutdown()
@@ -243,3 +243,188 @@ def test_multiline_parameters():
     outp = nba.extract_output_declarations()
 
     assert outp['static']['value'] == "Just a static\n            but multiline string"
+
+
+def test_preproc_cache(test_local_dir, tmp_path, monkeypatch):
+    from nb2workflow.nbadapter import NotebookAdapter, PreprocCache
+    import nb2workflow.nbadapter
+
+    monkeypatch.setenv("NB2W_PREPROC_CACHE", str(tmp_path / "preproc"))
+    monkeypatch.setattr(nb2workflow.nbadapter, "preproc_cache", PreprocCache())
+
+    nba = NotebookAdapter(os.path.join(test_local_dir, "testbool.ipynb"))
+    cache_key = nba.preproc_cache_key
+
+    for boolpar in [False, True]:
+        assert nba.execute(dict(boolpar=boolpar)) == []
+        assert nba.extract_output()['output'] == f'boolean {boolpar}'
+
+    assert sorted(os.listdir(tmp_path / "preproc")) == [cache_key + ".ipynb", cache_key + ".ipynb.json"]
+
+    # a new process finds the notebook on disk
+    entry = PreprocCache().get(cache_key)
+    assert entry['path'] == str(tmp_path / "preproc" / (cache_key + ".ipynb"))
+    assert 'injected-gather-outputs' in open(entry['path']).read()
+
+    # jobs get their own copy, which they may rewrite
+    assert not os.path.samefile(nba.preproc_notebook_fn, entry['path'])
+
+    # the notebook is hashed again only when it changes
+    hits = nb2workflow.nbadapter._file_sha256.cache_info().hits
+    assert nba.preproc_cache_key == cache_key
+    assert nb2workflow.nbadapter._file_sha256.cache_info().hits == hits + 1
+
+
+@pytest.mark.parametrize("notebook,parameters", [("testbool", dict(boolpar=False)),
+                                                  ("raising", dict(exception_type="runtime"))])
+def test_output_notebook_published(test_local_dir, notebook, parameters):
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    nba = NotebookAdapter(os.path.join(test_local_dir, f"{notebook}.ipynb"))
+
+    exceptions = nba.execute(parameters)
+    assert (len(exceptions) > 0) == (notebook == "raising")
+
+    assert os.path.exists(nba.output_notebook_fn)
+    assert not os.path.exists(nba.partial_output_notebook_fn)
+
+    if notebook == "testbool":
+        assert nba.extract_output()['output'] == 'boolean False'
+
+
+def test_outputs_sidecar(tmp_path):
+    import nbformat
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    nb = nbformat.v4.new_notebook()
+    nb.metadata['kernelspec'] = dict(name='python3', display_name='Python 3', language='python')
+    nb.cells = [nbformat.v4.new_code_cell(source=source) for source in [
+        "n = 3",
+        "import numpy as np\n"
+        "open('out.txt', 'w').write('file content')",
+        "values = np.arange(n)\n"
+        "structure = {'a': [1, 2], 'b': None}\n"
+        "file_output = 'out.txt'",
+    ]]
+    nb.cells[0].metadata['tags'] = ['parameters']
+    nb.cells[-1].metadata['tags'] = ['outputs']
+    nbformat.write(nb, str(tmp_path / "sidecar.ipynb"))
+
+    nba = NotebookAdapter(str(tmp_path / "sidecar.ipynb"))
+    assert nba.execute(dict(n=4)) == []
+
+    assert os.path.exists(nba.outputs_fn)
+    output = nba.extract_output()
+    assert output == nba.extract_pm_output()
+    assert output['values'] == [0, 1, 2, 3]
+    assert 'file_output_content' in output
+
+
+def test_outputs_sidecar_dataframe(tmp_path):
+    import json
+    import nbformat
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.json import CustomJSONEncoder
+
+    nb = nbformat.v4.new_notebook()
+    nb.metadata['kernelspec'] = dict(name='python3', display_name='Python 3', language='python')
+    nb.cells = [nbformat.v4.new_code_cell(source=source) for source in [
+        "n = 3",
+        "import pandas as pd\n"
+        "table = pd.DataFrame(dict(x=range(n)))\n"
+        "value = n",
+    ]]
+    nb.cells[0].metadata['tags'] = ['parameters']
+    nb.cells[-1].metadata['tags'] = ['outputs']
+    nbformat.write(nb, str(tmp_path / "dataframe.ipynb"))
+
+    nba = NotebookAdapter(str(tmp_path / "dataframe.ipynb"))
+    assert nba.execute(dict(n=2)) == []
+
+    # values which are not JSON are stored as glued when scrapbook can not, and do not spoil the others
+    assert os.path.exists(nba.outputs_fn)
+    assert not os.path.exists(nba.outputs_fn + ".tmp")
+
+    with open(nba.outputs_fn) as f:
+        output = json.load(f)
+    assert output['value'] == 2
+    assert output['table'] == json.dumps(nba.extract_pm_output()['table'], cls=CustomJSONEncoder)
+
+
+def test_signature_cache(tmp_path):
+    import nbformat
+    from nb2workflow.nbadapter import NotebookAdapter
+
+    fn = str(tmp_path / "signature.ipynb")
+
+    def write(n_default):
+        nb = nbformat.v4.new_notebook()
+        nb.cells = [nbformat.v4.new_code_cell(source=source) for source in [
+            f"n = {n_default}",
+            "cache_timeout = 60",
+            "result = n",
+        ]]
+        for cell, tag in zip(nb.cells, ['parameters', 'system-parameters', 'outputs']):
+            cell.metadata['tags'] = [tag]
+        nbformat.write(nb, fn)
+
+    write(3)
+    nba = NotebookAdapter(fn)
+    other = NotebookAdapter(fn)
+
+    assert other.signature is nba.signature
+    assert nba.input_parameters['n']['default_value'] == 3
+    assert list(nba.extract_output_declarations()) == ['result']
+
+    # parameters popped from one adapter are still there for the others
+    assert nba.get_system_parameter_value('cache_timeout', 0) == 60
+    assert nba.get_system_parameter_value('cache_timeout', 0) == 0
+    assert other.get_system_parameter_value('cache_timeout', 0) == 60
+
+    # touched, but not changed
+    os.utime(fn, ns=(0, 0))
+    assert NotebookAdapter(fn).signature is nba.signature
+
+    write(5)
+    changed = NotebookAdapter(fn)
+    assert changed.signature is not nba.signature
+    assert changed.input_parameters['n']['default_value'] == 5
+
+
+def test_signature_file(tmp_path_factory, monkeypatch):
+    import shutil
+    from nb2workflow.nbadapter import (NotebookAdapter, find_notebooks, signature_cache, read_signature_file,
+                                       write_signature_file)
+
+    test_dir = os.path.join(os.path.dirname(__file__), 'testfiles')
+    # notebooks in paths with /test_ are taken for tests
+    repo_dir = tmp_path_factory.mktemp('repo')
+    for name in ['testbool', 'structured_input']:
+        shutil.copy(os.path.join(test_dir, name + '.ipynb'), repo_dir)
+
+    nbas = find_notebooks(str(repo_dir))
+    write_signature_file(nbas, str(repo_dir))
+
+    signature_cache.clear()
+
+    def no_extraction(self):
+        raise AssertionError("notebook parsed")
+
+    with monkeypatch.context() as m:
+        m.setattr(NotebookAdapter, '_extract_signature', no_extraction)
+
+        precompiled = read_signature_file(str(repo_dir))
+        assert precompiled['up_to_date']
+        assert set(precompiled['notebooks']) == {'testbool', 'structured_input'}
+        assert precompiled['service_semantic_signature'] != ''
+
+        restored = find_notebooks(str(repo_dir))
+        for name, nba in nbas.items():
+            assert restored[name].input_parameters == nba.input_parameters
+            assert restored[name].extract_output_declarations() == nba.extract_output_declarations()
+
+    # a changed notebook is parsed again
+    with open(repo_dir / 'testbool.ipynb', 'a') as f:
+        f.write('\n')
+    signature_cache.clear()
+    assert not read_signature_file(str(repo_dir))['up_to_date']
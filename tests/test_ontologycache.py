@@ -0,0 +1,88 @@
+import pytest
+import requests
+
+
+ttl = """
+@prefix oda: <http://odahub.io/ontology#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+oda:Energy rdfs:subClassOf oda:Float .
+"""
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"", etag=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {} if etag is None else {'ETag': etag}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+
+def test_ontology_cache(tmp_path, monkeypatch):
+    import rdflib
+    from nb2workflow import ontologycache
+    from nb2workflow.ontologycache import OntologyCache
+
+    url = "http://odahub.io/ontology/ontology.ttl"
+    requested = []
+
+    def get(url, headers, timeout):
+        requested.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return FakeResponse(304)
+        return FakeResponse(200, ttl.encode(), etag='"v1"')
+
+    monkeypatch.setattr(ontologycache.requests, "get", get)
+
+    cache = OntologyCache(directory=str(tmp_path))
+    snapshot_path, namespaces = cache.snapshot(url)
+
+    g = rdflib.Graph()
+    g.parse(snapshot_path, format='nt')
+    assert len(g) == 1
+    assert ('oda', 'http://odahub.io/ontology#') in namespaces
+    assert requested == [{}]
+
+    # fresh copy is used without asking the server
+    assert cache.snapshot(url) == (snapshot_path, namespaces)
+    assert requested == [{}]
+
+    # then revalidated
+    monkeypatch.setenv("NB2W_ONTOLOGY_MAX_AGE_S", "0")
+    assert cache.snapshot(url) == (snapshot_path, namespaces)
+    assert requested == [{}, {'If-None-Match': '"v1"'}]
+
+    # and used offline
+    def get_offline(url, headers, timeout):
+        raise requests.ConnectionError("offline")
+
+    monkeypatch.setattr(ontologycache.requests, "get", get_offline)
+    assert cache.snapshot(url) == (snapshot_path, namespaces)
+
+    with pytest.raises(requests.ConnectionError):
+        OntologyCache(directory=str(tmp_path / "empty")).fetch(url)
+
+
+def test_lazy_ontology(monkeypatch):
+    from nb2workflow import nbadapter
+
+    loaded = []
+
+    class FakeOntology:
+        def __init__(self, ontology_path):
+            loaded.append(ontology_path)
+            self._is_ontology_available = True
+
+    monkeypatch.setattr(nbadapter, "ModOntology", FakeOntology)
+
+    lazy = nbadapter.LazyOntology("ontology.ttl")
+    assert not lazy.is_loaded
+    assert loaded == []
+
+    assert lazy._is_ontology_available
+    lazy._is_ontology_available = False
+    assert not lazy._is_ontology_available
+    assert loaded == ["ontology.ttl"]
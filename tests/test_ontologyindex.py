@@ -0,0 +1,168 @@
+import pytest
+import rdflib
+
+
+ttl = """
+@prefix oda: <http://odahub.io/ontology#> .
+@prefix owl: <http://www.w3.org/2002/07/owl#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+oda:Float rdfs:subClassOf oda:WorkflowParameter, [
+    a owl:Restriction ;
+    owl:onProperty oda:value ;
+    owl:allValuesFrom xsd:float
+] .
+oda:Energy rdfs:subClassOf oda:Float .
+oda:Energy_keV rdfs:subClassOf oda:Energy .
+
+oda:String rdfs:subClassOf oda:WorkflowParameter, xsd:string .
+oda:FileReference rdfs:subClassOf oda:String .
+oda:POSIXPath rdfs:subClassOf oda:FileReference .
+oda:FileURL rdfs:subClassOf oda:FileReference .
+oda:OptionalPath rdfs:subClassOf oda:POSIXPath, oda:optional .
+
+oda:Ambiguous rdfs:subClassOf oda:Float, xsd:integer .
+"""
+
+
+@pytest.fixture
+def index():
+    from nb2workflow.ontologyindex import OntologyIndex
+
+    g = rdflib.Graph()
+    g.parse(data=ttl, format='turtle')
+    return OntologyIndex(g)
+
+
+def test_ontology_index_datatype(index):
+    from rdflib.namespace import XSD
+
+    assert index.get_datatype_restriction("http://odahub.io/ontology#Energy_keV") == XSD.float
+    assert index.get_datatype_restriction("oda:Float") == XSD.float
+    assert index.get_datatype_restriction("http://odahub.io/ontology#POSIXPath") == XSD.string
+    assert index.get_datatype_restriction(str(XSD.integer)) == XSD.integer
+    assert index.get_datatype_restriction("http://odahub.io/ontology#Unknown") is None
+
+    with pytest.raises(RuntimeError):
+        index.get_datatype_restriction("http://odahub.io/ontology#Ambiguous")
+
+
+def test_ontology_index_parameter_classes(index):
+    from nb2workflow.ontologyindex import ODA
+
+    assert index.is_optional("http://odahub.io/ontology#OptionalPath")
+    assert index.is_optional("http://odahub.io/ontology#optional")
+    assert not index.is_optional("http://odahub.io/ontology#POSIXPath")
+
+    assert index.get_parameter_hierarchy("http://odahub.io/ontology#OptionalPath")[:4] == [
+        "http://odahub.io/ontology#OptionalPath",
+        "http://odahub.io/ontology#POSIXPath",
+        "http://odahub.io/ontology#FileReference",
+        "http://odahub.io/ontology#String",
+    ]
+    assert index.get_parameter_hierarchy("http://odahub.io/ontology#Unknown") == ["http://odahub.io/ontology#Unknown"]
+
+    assert index.is_parameter_of_class("http://odahub.io/ontology#OptionalPath", ODA.POSIXPath)
+    assert index.is_parameter_of_class("http://odahub.io/ontology#FileURL", ODA.FileReference)
+    assert not index.is_parameter_of_class("http://odahub.io/ontology#FileURL", ODA.POSIXPath)
+    assert not index.is_parameter_of_class("http://odahub.io/ontology#Energy", ODA.FileReference)
+
+
+def test_ontology_overlay(index):
+    from rdflib.namespace import XSD
+    from nb2workflow.ontologyindex import ODA, OntologyOverlay
+
+    extra = rdflib.Graph()
+    extra.parse(data="""
+        @prefix oda: <http://odahub.io/ontology#> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+        oda:MyPath rdfs:subClassOf oda:POSIXPath, oda:optional .
+        oda:Energy_keV rdfs:subClassOf oda:optional .
+    """, format='n3')
+
+    overlay = OntologyOverlay(index, extra)
+
+    assert overlay.is_parameter_of_class("http://odahub.io/ontology#MyPath", ODA.FileReference)
+    assert overlay.is_optional("http://odahub.io/ontology#MyPath")
+    assert overlay.get_datatype_restriction("http://odahub.io/ontology#MyPath") == XSD.string
+    assert overlay.get_parameter_hierarchy("http://odahub.io/ontology#MyPath")[:2] == [
+        "http://odahub.io/ontology#MyPath",
+        "http://odahub.io/ontology#POSIXPath",
+    ]
+    assert overlay.is_optional("http://odahub.io/ontology#Energy_keV")
+    assert overlay.get_datatype_restriction("http://odahub.io/ontology#Energy_keV") == XSD.float
+
+    # the base is not modified
+    assert not index.is_parameter_of_class("http://odahub.io/ontology#MyPath", ODA.FileReference)
+    assert not index.is_optional("http://odahub.io/ontology#Energy_keV")
+
+
+def test_overlay_graph():
+    from nb2workflow.ontologyindex import OverlayGraph
+
+    base = rdflib.Graph()
+    base.parse(data=ttl, format='turtle')
+    n_base = len(base)
+
+    extra = rdflib.Graph()
+    extra.parse(data="""
+        @prefix oda: <http://odahub.io/ontology#> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+        oda:MyEnergy rdfs:subClassOf oda:Energy_keV .
+        oda:Energy rdfs:subClassOf oda:Float .
+    """, format='n3')
+
+    overlay = OverlayGraph(base, extra)
+
+    # answers are not repeated, neither for property paths nor for triples in both graphs
+    hierarchy = [str(row[0]) for row in overlay.query(
+        "SELECT ?mid WHERE { oda:MyEnergy rdfs:subClassOf* ?mid . ?mid rdfs:subClassOf* oda:WorkflowParameter . }")]
+    assert sorted(hierarchy) == sorted(f"http://odahub.io/ontology#{c}"
+                                       for c in ["MyEnergy", "Energy_keV", "Energy", "Float", "WorkflowParameter"])
+    assert len(list(overlay.query("SELECT ?c WHERE { oda:Energy rdfs:subClassOf ?c . }"))) == 1
+
+    # the base graph is shared, not copied, and not modified
+    assert overlay.base is base
+    assert len(base) == n_base
+    assert (rdflib.URIRef("http://odahub.io/ontology#MyEnergy"), None, None) not in base
+
+
+def test_mod_ontology_overlays():
+    import collections
+    import threading
+    from nb2workflow.nbadapter import ModOntology
+
+    onto = ModOntology.__new__(ModOntology)
+    onto._is_ontology_available = True
+    onto.lock = threading.Lock()
+    onto._index = None
+    onto._overlays = collections.OrderedDict()
+
+    # forced available, but without a graph
+    assert not onto.is_ontology_available
+
+    onto.g = rdflib.Graph()
+    onto.g.parse(data=ttl, format='turtle')
+    assert onto.is_ontology_available
+
+    extra = """
+        @prefix oda: <http://odahub.io/ontology#> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+        oda:MyPath rdfs:subClassOf oda:POSIXPath .
+    """
+    overlay = onto.overlay(extra)
+    assert onto.overlay(extra) is overlay
+    assert overlay.base is onto.index
+
+    # as when extra triples are parsed into the ontology
+    onto._index = None
+    onto._overlays = collections.OrderedDict()
+
+    new_overlay = onto.overlay(extra)
+    assert new_overlay is not overlay
+    assert new_overlay.base is onto.index
+    assert onto.overlay(extra) is new_overlay
@@ -0,0 +1,151 @@
+import os
+
+
+def test_result_cache_key(test_local_dir, tmp_path, monkeypatch):
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.resultcache import ResultCache
+
+    nba = NotebookAdapter(os.path.join(test_local_dir, "testbool.ipynb"))
+
+    assert ResultCache().key(nba, dict(boolpar=False)) is None
+
+    cache = ResultCache(directory=str(tmp_path / "results"))
+
+    default_value = nba.input_parameters['boolpar']['default_value']
+    key = cache.key(nba, dict(boolpar=not default_value))
+    assert key == cache.key(nba, dict(boolpar=not default_value))
+    assert key != cache.key(nba, dict(boolpar=default_value))
+    # defaults are filled in
+    assert cache.key(nba, {}) == cache.key(nba, dict(boolpar=default_value))
+    assert key != cache.key(nba, dict(boolpar=not default_value), token="token")
+
+    assert cache.get(key) == (None, 'miss')
+    cache.put(key, nba, dict(output="boolean"))
+    assert ResultCache(directory=str(tmp_path / "results")).get(key) == (dict(output="boolean"), 'fresh')
+
+
+def test_result_cache_shared(test_local_dir, tmp_path):
+    import threading
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.resultcache import ResultCache, _find_repo
+
+    cache = ResultCache(directory=str(tmp_path / "results"))
+
+    barrier = threading.Barrier(8)
+    caches = []
+
+    def open_cache():
+        barrier.wait()
+        caches.append(cache._cache())
+
+    threads = [threading.Thread(target=open_cache) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # one handle for all request threads
+    assert len(set(map(id, caches))) == 1
+
+    # the repository of the notebook is looked up once
+    nba = NotebookAdapter(os.path.join(test_local_dir, "testbool.ipynb"))
+    cache.key(nba, {})
+    misses = _find_repo.cache_info().misses
+    cache.key(nba, {})
+    assert _find_repo.cache_info().misses == misses
+
+
+def test_result_cache_stale(test_local_dir, tmp_path, monkeypatch):
+    import time
+    from nb2workflow.nbadapter import NotebookAdapter
+    from nb2workflow.resultcache import ResultCache
+
+    nba = NotebookAdapter(os.path.join(test_local_dir, "testbool.ipynb"))
+    nba.input_parameters
+    nba.system_parameters.update(cache_timeout=dict(default_value=0.5),
+                                 stale_while_revalidate=dict(default_value=0.5),
+                                 refresh_ahead=dict(default_value=0.3))
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    cache = ResultCache()
+
+    # enabled by the notebook, in the default directory
+    key = cache.key(nba, {})
+    assert key is not None
+
+    cache.put(key, nba, dict(output="boolean"))
+    assert cache.get(key)[1] == 'fresh'
+
+    time.sleep(0.3)
+    # hot results are refreshed ahead
+    assert cache.get(key)[1] == 'refresh'
+
+    time.sleep(0.3)
+    assert cache.get(key) == (dict(output="boolean"), 'stale')
+
+    time.sleep(0.5)
+    assert cache.get(key) == (None, 'miss')
+
+
+def test_service_result_cache(client, tmp_path, monkeypatch):
+    import nb2workflow.service
+    from nb2workflow.service import AsyncWorker, wfstore
+
+    monkeypatch.setenv('NB2W_RESULT_CACHE', str(tmp_path / "results"))
+    wfstore.async_reset()
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=False))
+    assert r.status_code == 200
+    assert r.json['jobdir'] is not None
+
+    def not_executed(*args, **kwargs):
+        raise AssertionError("should be restored from cache")
+
+    monkeypatch.setattr(nb2workflow.service.NotebookAdapter, 'execute', not_executed)
+
+    # different query string, same parameter values
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar='false'))
+    assert r.status_code == 200
+    assert r.json['output']['output'] == 'boolean False'
+    assert r.json['jobdir'] is None
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=False, _async_request='yes'))
+    assert r.status_code == 200
+    assert r.json['workflow_status'] == 'done'
+    assert r.json['data']['output']['output'] == 'boolean False'
+
+
+def test_service_stale_while_revalidate(client, tmp_path, monkeypatch):
+    import time
+    from nb2workflow.service import AsyncWorker, async_queue, wfstore, result_cache_header
+    from nb2workflow.resultcache import ResultCache
+
+    system_parameter = ResultCache._system_parameter
+    policy = dict(cache_timeout=0.5, stale_while_revalidate=600)
+
+    monkeypatch.setattr(ResultCache, '_system_parameter',
+                        staticmethod(lambda nba, name, default: policy.get(name, system_parameter(nba, name, default))))
+    monkeypatch.setenv('NB2W_RESULT_CACHE', str(tmp_path / "results"))
+    wfstore.async_reset()
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=True))
+    assert r.status_code == 200
+    assert result_cache_header not in r.headers
+
+    time.sleep(0.6)
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar='true'))
+    assert r.status_code == 200
+    assert r.headers[result_cache_header] == 'stale'
+    assert r.json['output']['output'] == 'boolean True'
+    assert async_queue.qsize() == 1
+
+    # refreshed once
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar='True'))
+    assert r.headers[result_cache_header] == 'stale'
+    assert async_queue.qsize() == 1
+
+    AsyncWorker('test-worker').run_one()
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=1))
+    assert r.headers[result_cache_header] == 'fresh'
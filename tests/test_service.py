@@ -1,4 +1,5 @@
 import os
+import json
 import threading
 import base64
 import time
@@ -170,3 +171,196 @@ def test_service_async_repo(client_nb_repo):
         
     open("output.png","wb").write(base64.b64decode(r.json['data']['output']['spectrum_png_content']))
     
+
+
+def test_service_async_process_backend(client):
+    import nb2workflow.service
+    from nb2workflow.service import AsyncWorker, ProcessBackend
+
+    nb2workflow.service.process_backend = ProcessBackend(1)
+
+    try:
+        query_string = dict(boolpar=False, _async_request='yes')
+
+        r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+        assert r.status_code == 201
+
+        r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+        assert r.json['workflow_status'] == 'submitted'
+
+        AsyncWorker('test-worker').run_one()
+
+        r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+        assert r.json['workflow_status'] == 'done'
+        assert r.json['data']['exceptions'] == []
+        assert r.json['data']['output']['output'] == 'boolean False'
+        assert os.path.exists(os.path.join(r.json['data']['jobdir'], 'summary.yaml'))
+    finally:
+        nb2workflow.service.process_backend.shutdown()
+        nb2workflow.service.process_backend = None
+
+
+def test_service_async_events(client):
+    from nb2workflow.service import AsyncWorker
+
+    query_string = dict(boolpar=True, _async_request='yes')
+
+    r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+    assert r.status_code == 201
+    events_url = r.json['events_url']
+    assert r.json['job_key'] in events_url
+
+    AsyncWorker('test-worker').run_one()
+
+    def parse(text):
+        events = []
+        for message in text.strip().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in message.split("\n") if not line.startswith(":"))
+            if 'data' in fields:
+                events.append(dict(fields, data=json.loads(fields['data'])))
+        return events
+
+    events = parse(client.get(events_url).data.decode())
+
+    event_types = [e['event'] for e in events]
+    assert event_types[0] == 'notebook-start'
+    assert 'cell-start' in event_types
+    assert event_types[-1] == 'status'
+    assert events[-1]['data'] == dict(workflow_status='done', n_exceptions=0)
+
+    cell_ends = [e for e in events if e['event'] == 'cell-end']
+    assert all(e['data']['status'] == 'ok' for e in cell_ends)
+
+    event_ids = [e['id'] for e in events if 'id' in e]
+    resumed = parse(client.get(events_url, headers={'Last-Event-ID': cell_ends[0]['id']}).data.decode())
+    assert [e['id'] for e in resumed if 'id' in e] == event_ids[event_ids.index(cell_ends[0]['id']) + 1:]
+
+    assert client.get('/api/v1.0/jobs/unknown/events').status_code == 404
+
+
+def test_service_admission(client, monkeypatch):
+    from nb2workflow.service import AsyncWorker, async_queue, wfstore
+
+    wfstore.async_reset()
+    monkeypatch.setenv('NB2W_MAX_QUEUED_JOBS', str(async_queue.qsize() + 1))
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=True, _async_request='yes'))
+    assert r.status_code == 201
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=False, _async_request='yes'))
+    assert r.status_code == 429
+    assert r.json['workflow_status'] == 'rejected'
+    assert int(r.headers['Retry-After']) >= 1
+
+    # status of accepted jobs is still available
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=True, _async_request='yes'))
+    assert r.status_code == 201
+
+    AsyncWorker('test-worker').run_one()
+
+    monkeypatch.setenv('NB2W_MIN_FREE_MEMORY_MB', str(1e12))
+
+    r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=False))
+    assert r.status_code == 503
+    assert 'memory' in r.json['issues'][0]
+    assert 'Retry-After' in r.headers
+
+
+def test_service_async_list(client):
+    from nb2workflow.service import AsyncWorker, wfstore
+
+    wfstore.async_reset()
+
+    for boolpar in [True, False]:
+        r = client.get('/api/v1.0/get/testbool', query_string=dict(boolpar=boolpar, _async_request='yes'))
+        assert r.status_code == 201
+
+    AsyncWorker('test-worker').run_one()
+
+    r = client.get('/async/list', query_string=dict(limit=1))
+    assert r.json['total'] == 2
+    assert len(r.json['jobs']) == 1
+
+    for query_string in [dict(limit='x'), dict(offset=-1), dict(limit=-1)]:
+        assert client.get('/async/list', query_string=query_string).status_code == 400
+
+    assert client.get('/async/list', query_string=dict(limit=10**6)).json['limit'] == 1000
+
+    r = client.get('/async/list', query_string=dict(include_output='yes'))
+    statuses = sorted(v if isinstance(v, str) else 'done' for v in r.json['jobs'].values())
+    assert statuses == ['done', 'submitted']
+
+    assert client.get('/status').json['background_jobs'] == 1
+    assert client.get('/async/size').json['async_size'] == 2
+
+    AsyncWorker('test-worker').run_one()
+
+
+def test_service_async_dependency(client, monkeypatch):
+    import time
+    import nb2workflow.service
+    from nb2workflow.service import AsyncWorker, async_queue, wfstore
+    from nb2workflow.nbadapter import PapermillWorkflowIncomplete
+
+    wfstore.async_reset()
+
+    def execute_incomplete(*args, **kwargs):
+        raise PapermillWorkflowIncomplete('upstream-key')
+
+    monkeypatch.setattr(nb2workflow.service, 'execute_job', execute_incomplete)
+
+    query_string = dict(boolpar=True, _async_request='yes')
+    r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+    assert r.status_code == 201
+
+    AsyncWorker('test-worker').run_one()
+
+    r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+    assert r.json['workflow_status'] == 'submitted'
+    assert async_queue.qsize() == 1
+
+    monkeypatch.undo()
+
+    r = client.get('/async/notify/upstream-key')
+    assert r.json['woken'] == 1
+
+    t0 = time.time()
+    AsyncWorker('test-worker').run_one()
+    assert time.time() - t0 < nb2workflow.service.incomplete_retry_delay_s
+
+    r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+    assert r.json['workflow_status'] == 'done'
+
+
+def test_service_async_shared_state(client, monkeypatch, tmp_path):
+    import nb2workflow.service
+    from nb2workflow.service import AsyncWorker, AsyncWorkflow, wfstore
+    from nb2workflow.jobqueue import open_job_queue
+    from nb2workflow.jobstore import open_job_store
+
+    # as set up by nb2service --server gunicorn --state-dir
+    job_store_url = "sqlite://" + str(tmp_path / "jobs.sqlite")
+    job_queue_url = "sqlite://" + str(tmp_path / "queue.sqlite")
+
+    monkeypatch.setattr(nb2workflow.service, 'async_queue',
+                        open_job_queue(job_queue_url, from_record=AsyncWorkflow.from_record))
+    monkeypatch.setattr(wfstore, 'async_workflows', open_job_store(job_store_url, table='jobs', recover=False))
+    monkeypatch.setattr(wfstore, 'async_workflow_jobdirs', open_job_store(job_store_url, table='jobdirs', recover=False))
+
+    query_string = dict(boolpar=True, _async_request='yes')
+    r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+    assert r.status_code == 201
+    key = r.json['job_key']
+
+    # another server process sees the job, and takes it from the queue
+    other_queue = open_job_queue(job_queue_url, from_record=AsyncWorkflow.from_record)
+    assert other_queue.qsize() == 1
+    assert open_job_store(job_store_url, recover=False).status(key) == 'submitted'
+
+    AsyncWorker('test-worker').run_one(timeout=5)
+
+    assert open_job_store(job_store_url, recover=False)[key]['output']['output'] == 'boolean True'
+    assert other_queue.qsize() == 0
+
+    r = client.get('/api/v1.0/get/testbool', query_string=query_string)
+    assert r.json['workflow_status'] == 'done'
@@ -0,0 +1,101 @@
+import pytest
+import time
+import threading
+
+
+def test_single_flight():
+    from nb2workflow.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.3)
+        return x * 2
+
+    results = []
+
+    def request(key, x):
+        results.append((key, flights.do(key, slow, x)))
+
+    threads = [threading.Thread(target=request, args=("a", 1)) for _ in range(5)]
+    threads.append(threading.Thread(target=request, args=("b", 2)))
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+
+    assert sorted(calls) == [1, 2]
+    assert sorted(r for key, (r, shared) in results if key == "a") == [2] * 5
+    assert [shared for key, (r, shared) in results if key == "b"] == [False]
+    assert not flights.in_flight("a")
+
+    # later calls execute again
+    assert flights.do("a", slow, 3) == (6, False)
+
+
+def test_single_flight_exception():
+    from nb2workflow.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    errors = []
+
+    def failing():
+        time.sleep(0.2)
+        raise RuntimeError("failed")
+
+    def request():
+        try:
+            flights.do("a", failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=request) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 3
+    assert len(set(map(id, errors))) == 1
+
+
+def test_single_flight_on_leader():
+    from contextlib import contextmanager
+    from nb2workflow.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    entered = []
+
+    @contextmanager
+    def admit():
+        entered.append(True)
+        yield
+
+    def slow():
+        time.sleep(0.3)
+        return 1
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("a", slow, on_leader=admit)))
+               for _ in range(3)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+
+    # only the call executing is admitted
+    assert entered == [True]
+    assert sorted(results) == [(1, True)] * 3
+
+    def reject():
+        raise RuntimeError("rejected")
+
+    executed = []
+    with pytest.raises(RuntimeError):
+        flights.do("a", executed.append, 1, on_leader=reject)
+    assert executed == []
+    assert not flights.in_flight("a")
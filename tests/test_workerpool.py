@@ -0,0 +1,81 @@
+class FakeWorker:
+    def __init__(self, pool, worker_id):
+        self.pool = pool
+        self.worker_id = worker_id
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+
+def make_pool(monkeypatch, qsize, load_per_cpu=0.1, memory_avail_mb=1e5, **kwargs):
+    from nb2workflow.workerpool import WorkerPool
+
+    monkeypatch.setattr(WorkerPool, "resource_metrics",
+                        staticmethod(lambda: dict(load_per_cpu=load_per_cpu, memory_avail_mb=memory_avail_mb)))
+
+    return WorkerPool(FakeWorker, qsize=lambda: qsize[0], mean_duration_s=lambda: 60, **kwargs)
+
+
+def test_grow_and_shrink(monkeypatch):
+    qsize = [0]
+    pool = make_pool(monkeypatch, qsize, min_workers=1, max_workers=4)
+    pool.start()
+    assert pool.n_workers == 1
+
+    assert pool.scale()['action'] == 'keep'
+
+    qsize[0] = 10
+    with pool.working('default-0'):
+        decision = pool.scale()
+        assert decision['action'] == 'grow'
+        assert pool.n_workers == 4
+
+        qsize[0] = 0
+        assert pool.scale()['action'] == 'shrink'
+        # busy workers finish their job
+        assert not pool.should_stop('default-0')
+
+    assert pool.should_stop('default-3')
+    assert pool.n_workers == 3
+
+    status = pool.status()
+    assert [d['action'] for d in status['decisions']] == ['grow', 'shrink']
+
+
+def test_limited_by_resources(monkeypatch):
+    qsize = [10]
+    pool = make_pool(monkeypatch, qsize, load_per_cpu=2, min_workers=2, max_workers=4)
+    pool.start()
+
+    decision = pool.scale()
+    assert decision['action'] == 'keep'
+    assert 'load' in decision['reason']
+
+    pool = make_pool(monkeypatch, qsize, memory_avail_mb=10, min_workers=1, max_workers=4)
+    pool.start(3)
+    assert pool.scale()['action'] == 'shrink'
+
+
+def test_async_worker_leaves_pool(monkeypatch):
+    import nb2workflow.service
+    from nb2workflow.service import AsyncWorker
+    from nb2workflow.workerpool import WorkerPool
+
+    monkeypatch.setattr(nb2workflow.service, "autoscale_interval_s", 0.1)
+
+    pool = WorkerPool(lambda pool, worker_id: AsyncWorker(worker_id, pool=pool), min_workers=1, max_workers=2)
+    pool.start(2)
+    workers = list(pool._workers.values())
+
+    pool._n_to_stop = 1
+    for worker in workers:
+        worker.join(timeout=1)
+
+    assert pool.n_workers == 1
+    assert len([w for w in workers if w.is_alive()]) == 1
+
+    pool._n_to_stop = 1
+    for worker in workers:
+        worker.join(timeout=1)
+        assert not worker.is_alive()